@@ -0,0 +1,340 @@
+# Replay the k6 scenarios against a local stack and report throughput and latency as JSON.
+#
+# --stack compose brings up benchmark/docker-compose.yml (MySQL and all four services,
+# plus a MySQL read replica with --replica),
+# --stack local runs the services under gunicorn from their directories against the
+# MySQL in the DB_* environment variables, and --stack none targets whatever is already
+# listening on the --gateway/--user-service/--inventory-service URLs.
+#
+#   python benchmark/run.py --stack compose --scenario k6-script --vus 20 --duration 60 \
+#       --output result.json --baseline baseline.json
+#
+# With --baseline the run exits 1 when throughput, p95/p99 or the error rate is worse
+# than the baseline by more than --tolerance.
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+from scenarios import SCENARIOS, random_item, random_user
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMPOSE_FILE = os.path.join(ROOT, 'benchmark', 'docker-compose.yml')
+REPLICA_COMPOSE_FILE = os.path.join(ROOT, 'benchmark', 'docker-compose.replica.yml')
+
+# Ports and settings match docker-compose.yml; order-service moves off 5000 so it can sit beside the gateway
+USER_ASSERTION_SECRET = os.environ.get('USER_ASSERTION_SECRET', 'benchmark')
+LOCAL_SERVICES = [
+    ('user-service', 5002, {}),
+    ('inventory-service', 5001, {}),
+    ('order-service', 5003, {'USER_SERVICE_URL': 'http://localhost:5002',
+                             'INVENTORY_SERVICE_URL': 'http://localhost:5001',
+                             'USER_ASSERTION_SECRET': USER_ASSERTION_SECRET}),
+    ('sample-app', 5000, {'ORDER_SERVICE_URL': 'http://localhost:5003',
+                          'USER_SERVICE_URL': 'http://localhost:5002',
+                          'INVENTORY_SERVICE_URL': 'http://localhost:5001',
+                          'USER_ASSERTION_SECRET': USER_ASSERTION_SECRET,
+                          'AUTH_TOKEN_SECRET': os.environ.get('AUTH_TOKEN_SECRET', 'benchmark')}),
+]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Recorder:
+    """Collects (name, elapsed, ok) for every request made during the run."""
+
+    def __init__(self):
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def add(self, name, elapsed, ok):
+        with self._lock:
+            self.samples.append((name, elapsed, ok))
+
+
+class Client:
+    """One virtual user: its own HTTP session, plus the targets and seed data the scenarios use."""
+
+    def __init__(self, args, recorder, seeded_user_ids, seeded_item_ids):
+        self.session = requests.Session()
+        self.gateway = args.gateway
+        self.users = args.user_service
+        self.inventory = args.inventory_service
+        self.seeded_user_ids = seeded_user_ids
+        self.seeded_item_ids = seeded_item_ids
+        self.recorder = recorder
+        self.timeout = args.timeout
+        self.think_time = not args.no_think_time
+        self.deadline = None
+
+    def request(self, name, method, base_url, path, json=None, auth=None, expect=(200,)):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, base_url + path, json=json, auth=auth, timeout=self.timeout)
+        except requests.RequestException:
+            self.recorder.add(name, time.perf_counter() - start, False)
+            return None
+        self.recorder.add(name, time.perf_counter() - start, response.status_code in expect)
+        return response
+
+    def sleep(self, seconds):
+        if self.think_time:
+            if self.deadline is not None:
+                seconds = min(seconds, max(0, self.deadline - time.monotonic()))
+            time.sleep(seconds)
+
+
+def wait_until_healthy(urls, timeout):
+    deadline = time.monotonic() + timeout
+    for url in urls:
+        while True:
+            try:
+                if requests.get(url, timeout=2).ok:
+                    break
+            except requests.RequestException:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{url} did not become healthy within {timeout}s")
+            time.sleep(1)
+
+
+def start_compose(args):
+    files = ['-f', COMPOSE_FILE] + (['-f', REPLICA_COMPOSE_FILE] if args.replica else [])
+    subprocess.run(['docker', 'compose', *files, 'up', '--build', '-d'], check=True)
+    return lambda: subprocess.run(['docker', 'compose', *files, 'down', '-v'], check=False)
+
+
+def start_local(args):
+    processes = []
+
+    def stop():
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    try:
+        for directory, port, extra_env in LOCAL_SERVICES:
+            env = dict(os.environ, PORT=str(port), **extra_env)
+            cwd = os.path.join(ROOT, directory)
+            if os.path.exists(os.path.join(cwd, 'migrate.py')):
+                subprocess.run([sys.executable, 'migrate.py'], cwd=cwd, env=env, check=True)
+            processes.append(subprocess.Popen(['gunicorn'], cwd=cwd, env=env))
+            # order-service's tables reference users and items, so each service is migrated and up before the next
+            if directory != 'sample-app':
+                wait_until_healthy([f'http://localhost:{port}/healthz'], args.startup_timeout)
+    except BaseException:
+        stop()
+        raise
+    return stop
+
+
+# Create the users and items in one bulk request each
+def seed(args):
+    session = requests.Session()
+
+    def bulk(url, records, key):
+        response = session.post(url, json=records, timeout=args.timeout)
+        response.raise_for_status()
+        results = response.json()['results']
+        failed = [result for result in results if result['status'] != 201]
+        if failed:
+            raise RuntimeError(f"Seeding {url} failed: {failed[0]['message']}")
+        return [result[key]['id'] for result in results]
+
+    user_ids = bulk(args.user_service + '/users/bulk', [random_user() for _ in range(args.users)], 'user')
+    item_ids = bulk(args.inventory_service + '/items/bulk',
+                    [dict(random_item(), quantity=args.stock) for _ in range(args.items)], 'item')
+    return user_ids, item_ids
+
+
+def run_vus(iteration, clients, duration):
+    deadline = time.monotonic() + duration
+
+    def loop(client):
+        client.deadline = deadline
+        while time.monotonic() < deadline:
+            iteration(client)
+
+    threads = [threading.Thread(target=loop, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+# Start iterations at a fixed rate on whichever client is free; like k6, drop an iteration when none is
+def run_arrival_rate(iteration, clients, duration, rate):
+    idle = list(clients)
+    lock = threading.Lock()
+    threads = []
+    dropped = 0
+
+    def run_one(client):
+        try:
+            iteration(client)
+        finally:
+            with lock:
+                idle.append(client)
+
+    start = time.monotonic()
+    deadline = start + duration
+    for client in clients:
+        client.deadline = deadline
+    started = 0
+    while True:
+        next_start = start + started / rate
+        if next_start >= deadline:
+            break
+        time.sleep(max(0, next_start - time.monotonic()))
+        started += 1
+        with lock:
+            client = idle.pop() if idle else None
+        if client is None:
+            dropped += 1
+            continue
+        thread = threading.Thread(target=run_one, args=(client,))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return dropped
+
+
+def latency_summary(latencies):
+    return {
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def summarise(args, samples, elapsed, dropped):
+    result = {
+        'scenario': args.scenario,
+        'vus': args.vus,
+        'duration_s': round(elapsed, 1),
+        'requests': len(samples),
+        'throughput_rps': round(len(samples) / elapsed, 1),
+        'error_rate': round(sum(1 for _, _, ok in samples if not ok) / len(samples), 4) if samples else 0,
+    }
+    if SCENARIOS[args.scenario][1] == 'arrival-rate':
+        result['rate'] = args.rate
+        result['dropped_iterations'] = dropped
+    if samples:
+        result.update(latency_summary([elapsed for _, elapsed, _ in samples]))
+    by_name = {}
+    for name, elapsed, ok in samples:
+        by_name.setdefault(name, []).append((elapsed, ok))
+    result['requests_by_name'] = {
+        name: dict(count=len(entries),
+                   error_rate=round(sum(1 for _, ok in entries if not ok) / len(entries), 4),
+                   **latency_summary([elapsed for elapsed, _ in entries]))
+        for name, entries in sorted(by_name.items())
+    }
+    return result
+
+
+# Every way the result is worse than the baseline by more than the tolerance
+def regressions(result, baseline, tolerance):
+    found = []
+
+    def slower(label, current, previous):
+        for key in ('p95_ms', 'p99_ms'):
+            if key in current and key in previous and current[key] > previous[key] * (1 + tolerance):
+                found.append(f"{label} {key} {previous[key]} -> {current[key]}")
+
+    def more_errors(label, current, previous):
+        if current.get('error_rate', 0) > previous.get('error_rate', 0) + tolerance * max(previous.get('error_rate', 0), 0.01):
+            found.append(f"{label} error_rate {previous.get('error_rate', 0)} -> {current['error_rate']}")
+
+    if result['throughput_rps'] < baseline['throughput_rps'] * (1 - tolerance):
+        found.append(f"throughput_rps {baseline['throughput_rps']} -> {result['throughput_rps']}")
+    slower('overall', result, baseline)
+    more_errors('overall', result, baseline)
+    for name, previous in baseline.get('requests_by_name', {}).items():
+        current = result['requests_by_name'].get(name)
+        if current is not None:
+            slower(name, current, previous)
+            more_errors(name, current, previous)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay the k6 scenarios against a local stack")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default='k6-script')
+    parser.add_argument("--stack", choices=['compose', 'local', 'none'], default='none',
+                        help="start the services with docker compose, as local gunicorn processes, or not at all")
+    parser.add_argument("--keep", action='store_true', help="leave the stack running afterwards")
+    parser.add_argument("--replica", action='store_true',
+                        help="with --stack compose, add a MySQL replica and send the services' reads to it")
+    parser.add_argument("--gateway", default='http://localhost:5000')
+    parser.add_argument("--user-service", default='http://localhost:5002')
+    parser.add_argument("--inventory-service", default='http://localhost:5001')
+    parser.add_argument("--startup-timeout", type=float, default=180, help="seconds to wait for the stack")
+    parser.add_argument("--users", type=int, default=10, help="users to seed before the run")
+    parser.add_argument("--items", type=int, default=10, help="items to seed before the run")
+    parser.add_argument("--stock", type=int, default=100000, help="quantity of each seeded item")
+    parser.add_argument("--vus", type=int, default=10, help="virtual users (the maximum for arrival-rate scenarios)")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run for")
+    parser.add_argument("--rate", type=float, default=50, help="iterations per second for arrival-rate scenarios")
+    parser.add_argument("--timeout", type=float, default=30, help="per-request timeout in seconds")
+    parser.add_argument("--no-think-time", action='store_true', help="skip the scenarios' sleeps between iterations")
+    parser.add_argument("--seed", type=int, help="random seed, for repeatable request mixes")
+    parser.add_argument("--output", help="also write the result to this file")
+    parser.add_argument("--baseline", help="fail if the result regresses against this result file")
+    parser.add_argument("--save-baseline", help="write the result to this file as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.users < 1 or args.items < 1:
+        parser.error("--users and --items must be at least 1")
+
+    stop = {'compose': start_compose, 'local': start_local}.get(args.stack, lambda _: None)(args)
+    try:
+        wait_until_healthy([args.user_service + '/healthz', args.inventory_service + '/healthz',
+                            args.gateway + '/healthz'], args.startup_timeout)
+        seeded_user_ids, seeded_item_ids = seed(args)
+
+        iteration, executor = SCENARIOS[args.scenario]
+        recorder = Recorder()
+        clients = [Client(args, recorder, seeded_user_ids, seeded_item_ids) for _ in range(args.vus)]
+        start = time.monotonic()
+        dropped = 0
+        if executor == 'arrival-rate':
+            dropped = run_arrival_rate(iteration, clients, args.duration, args.rate)
+        else:
+            run_vus(iteration, clients, args.duration)
+        result = summarise(args, recorder.samples, time.monotonic() - start, dropped)
+    finally:
+        if stop is not None and not args.keep:
+            stop()
+
+    output = json.dumps(result, indent=2)
+    print(output)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                f.write(output + '\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(result, json.load(f), args.tolerance)
+        for line in found:
+            print(f"Regression: {line}", file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
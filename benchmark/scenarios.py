@@ -0,0 +1,127 @@
+# The k6 scenarios in k6/, replayed from Python against a local stack.
+#
+# Every action makes one or more HTTP requests through a Client, which times each
+# request under a fixed name and checks its status against what the k6 scripts expect.
+import random
+import uuid
+
+ITEM_TEMPLATES = [
+    ('Item A', (1, 20), 100),
+    ('Item B', (1, 50), 50),
+    ('Item C', (5, 30), 75),
+    ('Item D', (2, 15), 200),
+    ('Item E', (10, 40), 30),
+]
+GATEWAY_AUTH = ('user1', 'pass1')
+MISSING_ID = 999999
+
+
+def random_item():
+    name, (low, high), max_price = random.choice(ITEM_TEMPLATES)
+    return {'name': name, 'quantity': random.randint(low, high), 'price': round(random.random() * max_price, 2)}
+
+
+def random_user():
+    first = random.choice(['John', 'Jane', 'Mike', 'Emily', 'David', 'Sarah'])
+    last = random.choice(['Doe', 'Smith', 'Johnson', 'Williams', 'Brown', 'Jones'])
+    return {'name': f'{first} {last}', 'email': f'{first}.{last}.{uuid.uuid4().hex[:12]}@example.com'.lower()}
+
+
+def add_inventory_item(client):
+    client.request('add_item', 'POST', client.inventory, '/items', json=random_item(), expect=(201,))
+
+
+def create_user(client):
+    client.request('create_user', 'POST', client.users, '/users', json=random_user(), expect=(201,))
+
+
+def get_users(client):
+    return client.request('get_users', 'GET', client.users, '/users', expect=(200,))
+
+
+def existing_ids(client):
+    users = client.request('lookup_users', 'GET', client.users, '/users', expect=(200,))
+    items = client.request('lookup_items', 'GET', client.inventory, '/items', expect=(200,))
+    user_ids = [user['id'] for user in users.json()['users']] if users is not None and users.ok else []
+    item_ids = [item['id'] for item in items.json()['items']] if items is not None and items.ok else []
+    return user_ids, item_ids
+
+
+def place_order_with(client, user_id, item_id, name='place_order', expect=(201,)):
+    client.request(name, 'POST', client.gateway, '/place_order', auth=GATEWAY_AUTH, expect=expect,
+                   json={'user_id': user_id, 'items': [{'item_id': item_id, 'quantity': random.randint(1, 5)}]})
+
+
+# k6-script.js and k6-script-2.js look up every user and item id before each order
+def place_order_after_lookup(client):
+    user_ids, item_ids = existing_ids(client)
+    if user_ids and item_ids:
+        place_order_with(client, random.choice(user_ids), random.choice(item_ids))
+
+
+# k6-script-3.js orders from the first few ids directly
+def place_order(client):
+    place_order_with(client, random.choice(client.seeded_user_ids), random.choice(client.seeded_item_ids))
+
+
+def place_invalid_user_order(client):
+    place_order_with(client, MISSING_ID, random.randint(1, 5), 'place_order_invalid_user', expect=(400,))
+
+
+def place_invalid_item_order(client):
+    place_order_with(client, random.choice(client.seeded_user_ids), MISSING_ID, 'place_order_invalid_item',
+                     expect=(404,))
+
+
+def login(client):
+    client.request('login', 'POST', client.gateway, '/login', json={'username': 'user1', 'password': 'pass1'},
+                   expect=(200,))
+
+
+def get_items(client):
+    client.request('get_items', 'GET', client.gateway, '/items', auth=GATEWAY_AUTH, expect=(200,))
+
+
+def high_error_rate(client):
+    client.request('error', 'GET', client.gateway, '/error', expect=(500,))
+
+
+def error_rate_sudden_increase(client):
+    for _ in range(5):
+        high_error_rate(client)
+
+
+def high_latency(client):
+    client.request('slow', 'GET', client.gateway, '/slow', expect=(200,))
+
+
+def latency_anomaly(client):
+    client.sleep(random.randint(1, 3))
+    client.request('get_items_unauthenticated', 'GET', client.gateway, '/items', expect=(401,))
+
+
+K6_ACTIONS = [add_inventory_item, create_user, get_users, place_order_after_lookup, place_invalid_user_order,
+              place_invalid_item_order, login, get_items]
+
+
+# k6-script.js and k6-script-2.js; they differ only in how iterations are started
+def k6_script_iteration(client):
+    random.choice(K6_ACTIONS)(client)
+    client.sleep(1)
+
+
+def k6_script_3_iteration(client):
+    if random.randint(1, 100) <= 20:
+        random.choice([high_error_rate, error_rate_sudden_increase, high_latency, latency_anomaly])(client)
+    else:
+        random.choice([add_inventory_item, create_user, get_users, place_order, login, get_items])(client)
+    client.sleep(random.randint(1, 3))
+
+
+# name -> (iteration, executor). "vus" runs iterations back to back on every virtual user,
+# like k6's ramping-vus; "arrival-rate" starts iterations at a fixed rate, like constant-arrival-rate.
+SCENARIOS = {
+    'k6-script': (k6_script_iteration, 'vus'),
+    'k6-script-2': (k6_script_iteration, 'arrival-rate'),
+    'k6-script-3': (k6_script_3_iteration, 'vus'),
+}
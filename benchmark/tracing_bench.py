@@ -0,0 +1,123 @@
+"""Micro-benchmark of per-request tracing overhead in each TRACE_MODE.
+
+Runs a small Flask app in-process with Flask's test client, once per tracing
+setup. Each request opens as many nested stage spans as create_order does, and
+exported spans are encoded as OTLP and then discarded, so the numbers include
+serialisation but not the network:
+
+    python benchmark/tracing_bench.py --requests 5000 --spans 8
+
+Results are printed as JSON: mean and p50/p99 per request in microseconds, CPU
+time per request including the exporter thread, spans exported, and the
+overhead over tracing switched off.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+SAMPLE_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sample-app')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def make_exporter():
+    from opentelemetry.exporter.otlp.proto.common.trace_encoder import encode_spans
+    from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+
+    class EncodingExporter(SpanExporter):
+        """Encodes spans as the OTLP exporter would, then drops them."""
+
+        def __init__(self):
+            self.exported = 0
+
+        def export(self, spans):
+            encode_spans(spans).SerializeToString()
+            self.exported += len(spans)
+            return SpanExportResult.SUCCESS
+
+    return EncodingExporter()
+
+
+def make_app(provider, spans):
+    from flask import Flask
+    from opentelemetry.instrumentation.flask import FlaskInstrumentor
+
+    app = Flask(__name__)
+    FlaskInstrumentor().instrument_app(app, tracer_provider=provider)
+    tracer = provider.get_tracer(__name__)
+
+    @app.route('/work')
+    def work():
+        with tracer.start_as_current_span("handler"):
+            for index in range(spans - 1):
+                with tracer.start_as_current_span(f"stage_{index}"):
+                    pass
+        return 'ok'
+
+    return app
+
+
+def run_case(tracing, mode, ratio, args):
+    provider = tracing.build_provider("tracing-bench", mode=mode, ratio=ratio)
+    exporter = None
+    if mode == "export":
+        exporter = make_exporter()
+        provider.add_span_processor(tracing.export_processor(exporter, ratio=ratio))
+    client = make_app(provider, args.spans).test_client()
+    durations = []
+    cpu_start = time.process_time()
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        client.get('/work')
+        durations.append((time.perf_counter() - start) * 1e6)
+    provider.force_flush()
+    cpu_us = (time.process_time() - cpu_start) * 1e6 / args.requests
+    provider.shutdown()
+    return durations, cpu_us, exporter.exported if exporter else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000, help="requests per case")
+    parser.add_argument("--spans", type=int, default=8, help="internal spans per request")
+    parser.add_argument("--ratio", type=float, default=0.1, help="TRACE_SAMPLE_RATIO of the sampled case")
+    args = parser.parse_args()
+
+    sys.path.insert(0, SAMPLE_APP)
+    import instrumentation
+    import tracing
+    from prometheus_client import CollectorRegistry
+    instrumentation.bind_metrics(CollectorRegistry())
+
+    cases = {
+        'off': ("off", 0),
+        'metrics': ("metrics", 0),
+        'export_all': ("export", 1),
+        f'export_{args.ratio:g}': ("export", args.ratio),
+    }
+    results = {name: run_case(tracing, mode, ratio, args) for name, (mode, ratio) in cases.items()}
+    baseline = statistics.mean(results['off'][0])
+    baseline_cpu = results['off'][1]
+    print(json.dumps({
+        name: {
+            'requests': len(durations),
+            'mean_us': round(statistics.mean(durations), 1),
+            'p50_us': round(percentile(durations, 0.5), 1),
+            'p99_us': round(percentile(durations, 0.99), 1),
+            'cpu_us': round(cpu_us, 1),
+            'spans_exported': exported,
+            'overhead_us': round(statistics.mean(durations) - baseline, 1),
+            'cpu_overhead_us': round(cpu_us - baseline_cpu, 1),
+        }
+        for name, (durations, cpu_us, exported) in results.items()
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,108 +1,114 @@
+import logging
 import os
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
 import mysql.connector
 from flask import Flask, request, jsonify
 from prometheus_flask_exporter import PrometheusMetrics
 
+import catalogue
+import changes
+import db
+import instrumentation
+import logs
+import stock
+import tracing
+import updates
+from catalogue import Catalogue
+from db import get_db_connection, get_read_connection, inserted_ids
+from streaming import query_row_chunks, record_chunks, request_records, stream_records, wants_stream
+
 # Importing OpenTelemetry modules
 from opentelemetry import trace
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.flask import FlaskInstrumentor
 from opentelemetry.instrumentation.requests import RequestsInstrumentor
 
 app = Flask(__name__)
 metrics = PrometheusMetrics(app)
+db.bind_metrics(metrics.registry)
+instrumentation.bind_metrics(metrics.registry)
+tracing.bind_metrics(metrics.registry)
+logs.bind_metrics(metrics.registry)
 
-# Configuring tracing
-resource = Resource.create(attributes={"service.name": "inventory-service"})
-trace.set_tracer_provider(TracerProvider(resource=resource))
-
-# Configuring Jaeger exporter
-jaeger_exporter = OTLPSpanExporter(
-    endpoint="http://simplest-jaeger-collector.observability.svc.cluster.local:4318/v1/traces",
-)
+# Configure tracing: sampling, export and the per-stage and per-upstream latency histograms (see tracing.py)
+tracing.configure("inventory-service")
 
-trace.get_tracer_provider().add_span_processor(
-    BatchSpanProcessor(jaeger_exporter)
-)
+# JSON log lines with trace and span ids (see logs.py)
+logs.configure("inventory-service")
 
 # Auto-instrument Flask and requests
 FlaskInstrumentor().instrument_app(app)
+logs.instrument_flask(app)
+# Consistency tokens for reads from replicas (see db.py)
+db.instrument_flask(app)
 RequestsInstrumentor().instrument()
 
 tracer = trace.get_tracer(__name__)
+logger = logging.getLogger(__name__)
 
-# Database configuration from environment variables
-DB_HOST = os.environ.get("DB_HOST")
-DB_PORT = os.environ.get("DB_PORT", "3306")
-DB_NAME = os.environ.get("DB_NAME")
-DB_USER = os.environ.get("DB_USER")
-DB_PASSWORD = os.environ.get("DB_PASSWORD")
+# Per-process setup. gunicorn runs this in each worker after fork (see gunicorn.conf.py),
+# since the span exporter's background thread and DB connections do not survive a fork.
+def init_worker():
+    # Export sampled traces (TRACE_MODE, OTEL_EXPORTER_OTLP_TRACES_ENDPOINT)
+    tracing.start_export()
+    # Write logs from a background thread
+    logs.start()
 
-def get_db_connection():
-    conn = None
-    try:
-        conn = mysql.connector.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-    except mysql.connector.Error as error:
-        print("Error connecting to database:", error)
-    return conn
-
-# Create items table if it doesn't exist
-def create_table():
+def item_record(item):
+    return {'id': item[0], 'name': item[1], 'quantity': item[2], 'price': item[3]}
+
+ITEM_NAME_MAX_LENGTH = 255
+PRICE_MAX = Decimal('99999999.99')  # items.price is DECIMAL(10, 2)
+
+# A price rounded the way items.price stores it, or None if it is not a valid price
+def parse_price(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        return None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS items (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                name VARCHAR(255) NOT NULL,
-                quantity INT NOT NULL,
-                price DECIMAL(10, 2) NOT NULL
-            )
-        ''')
-        conn.commit()
-        cursor.close()
-    except mysql.connector.Error as error:
-        print("Error creating table:", error)
-    finally:
-        if conn is not None and conn.is_connected():
-            conn.close()
+        price = Decimal(str(value))
+        if not price.is_finite():
+            return None
+        price = price.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        return None
+    return price if 0 <= price <= PRICE_MAX else None
+
+# Read the catalogue version and the items it describes; run inside one transaction by Catalogue
+def load_catalogue(cursor):
+    version = catalogue.current_version(cursor)
+    cursor.execute(f"SELECT {stock.ITEM_COLUMNS} FROM items")
+    return version, app.json.dumps({'items': [item_record(item) for item in cursor.fetchall()]})
 
-create_table()
+# Pre-serialised GET /items body, rebuilt only when the catalogue version changes
+items_catalogue = Catalogue(load_catalogue)
 
 @app.route('/items', methods=['POST'])
 @metrics.summary('add_item_latency_seconds', 'Latency of adding items')
 def add_item():
     with tracer.start_as_current_span("add_item"):
+        data = request.json
+        # The same checks as each record of a bulk import
+        error = validate_item(data)
+        if error:
+            return jsonify({'message': error}), 400
+        buckets = data.get('buckets', stock.STOCK_BUCKETS)
+        price = parse_price(data['price'])
         conn = get_db_connection()
         if conn is not None:
             cursor = conn.cursor()
-            data = request.json
-            if not data or 'name' not in data or 'quantity' not in data or 'price' not in data:
-                return jsonify({'message': 'Bad Request: name, quantity, and price are required'}), 400
             try:
-                cursor.execute("INSERT INTO items (name, quantity, price) VALUES (%s, %s, %s)", (data['name'], data['quantity'], data['price']))
-                conn.commit()
+                cursor.execute("INSERT INTO items (name, quantity, price) VALUES (%s, %s, %s)", (data['name'], data['quantity'], price))
                 item_id = cursor.lastrowid
-                cursor.execute("SELECT * FROM items WHERE id = %s", (item_id,))
-                item = cursor.fetchone()
-                item_data = {
-                    'id': item[0],
-                    'name': item[1],
-                    'quantity': item[2],
-                    'price': item[3]
-                }
-                return jsonify({'message': 'Item added successfully', 'item': item_data}), 201
+                if buckets > 1:
+                    stock.set_buckets(cursor, item_id, buckets)
+                catalogue.bump(cursor)
+                changes.record(cursor, [item_id])
+                conn.commit()
+                # The price is already rounded as stored, so the row is not read back
+                item = (item_id, data['name'], data['quantity'], price)
+                return jsonify({'message': 'Item added successfully', 'item': item_record(item)}), 201
             except mysql.connector.Error as error:
-                print("Error adding item:", error)
+                logger.error("Error adding item: %s", error)
                 conn.rollback()
                 return jsonify({'message': 'Failed to add item'}), 500
             finally:
@@ -111,34 +117,181 @@ def add_item():
         else:
             return jsonify({'message': 'Database connection failed'}), 500
 
+# Check one record of a bulk import, returning an error message or None
+def validate_item(item):
+    if not isinstance(item, dict) or 'name' not in item or 'quantity' not in item or 'price' not in item:
+        return 'Bad Request: name, quantity, and price are required'
+    if not is_bucket_count(item.get('buckets', stock.STOCK_BUCKETS)):
+        return f'Bad Request: buckets must be between 1 and {stock.STOCK_BUCKETS_MAX}'
+    return validate_item_fields(item)
+
+# Check whichever of name, quantity and price are present
+def validate_item_fields(fields):
+    if 'name' in fields and (not isinstance(fields['name'], str) or not 0 < len(fields['name']) <= ITEM_NAME_MAX_LENGTH):
+        return f'Bad Request: name must be a non-empty string of at most {ITEM_NAME_MAX_LENGTH} characters'
+    quantity = fields.get('quantity', 0)
+    if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 0:
+        return 'Bad Request: quantity must be a non-negative integer'
+    if 'price' in fields and parse_price(fields['price']) is None:
+        return f'Bad Request: price must be a number between 0 and {PRICE_MAX}'
+    return None
+
+# Insert the valid items of one chunk, returning the chunk's per-row results
+def insert_items(cursor, chunk):
+    results = []
+    rows = []
+    for index, item in chunk:
+        error = validate_item(item)
+        if error:
+            results.append({'index': index, 'status': 400, 'message': error})
+        else:
+            rows.append((index, item['name'], item['quantity'], parse_price(item['price']),
+                         item.get('buckets', stock.STOCK_BUCKETS)))
+    if not rows:
+        return results
+    cursor.executemany("INSERT INTO items (name, quantity, price) VALUES (%s, %s, %s)",
+                       [(name, quantity, price) for _, name, quantity, price, _ in rows])
+    item_ids = inserted_ids(cursor, len(rows))
+    for (index, name, quantity, price, buckets), item_id in zip(rows, item_ids):
+        if buckets > 1:
+            stock.set_buckets(cursor, item_id, buckets)
+        results.append({'index': index, 'status': 201, 'item': item_record((item_id, name, quantity, price))})
+    # One catalogue version per chunk rather than per item
+    catalogue.bump(cursor)
+    changes.record(cursor, item_ids)
+    return results
+
+# Add many items from a JSON array or an NDJSON stream, BULK_CHUNK_SIZE rows per
+# insert and commit, reporting each row's result by its position in the body
+@app.route('/items/bulk', methods=['POST'])
+def add_items_bulk():
+    with tracer.start_as_current_span("add_items_bulk"):
+        try:
+            records = request_records()
+        except ValueError as error:
+            return jsonify({'message': f'Bad Request: {error}'}), 400
+        conn = get_db_connection()
+        if conn is None:
+            return jsonify({'message': 'Database connection failed'}), 500
+        cursor = conn.cursor()
+        results = []
+        try:
+            for chunk in record_chunks(records):
+                with tracer.start_as_current_span("insert_items_chunk"):
+                    chunk_results = insert_items(cursor, chunk)
+                    conn.commit()
+                results.extend(sorted(chunk_results, key=lambda result: result['index']))
+        except mysql.connector.Error as error:
+            logger.error("Error importing items: %s", error)
+            conn.rollback()
+            # Earlier chunks stay committed; their results tell the client where to resume
+            created = sum(1 for result in results if result['status'] == 201)
+            return jsonify({'message': 'Failed to import items', 'created': created, 'results': results}), 500
+        finally:
+            cursor.close()
+            conn.close()
+        created = sum(1 for result in results if result['status'] == 201)
+        return jsonify({
+            'message': 'Bulk import processed',
+            'created': created,
+            'failed': len(results) - created,
+            'results': results
+        }), 200
+
 @app.route('/items', methods=['GET'])
 def get_items():
     with tracer.start_as_current_span("get_items"):
+        conn = get_read_connection()
+        if conn is not None and wants_stream():
+            try:
+                chunks = query_row_chunks(conn, f"SELECT {stock.ITEM_COLUMNS} FROM items")
+            except mysql.connector.Error as error:
+                logger.error("Error fetching items: %s", error)
+                return jsonify({'message': 'Failed to fetch items'}), 500
+            return stream_records('items', chunks, item_record)
+        if conn is not None:
+            try:
+                snapshot = items_catalogue.get(conn)
+            except mysql.connector.Error as error:
+                logger.error("Error fetching items: %s", error)
+                return jsonify({'message': 'Failed to fetch items'}), 500
+            finally:
+                conn.close()
+            # Clients revalidate with If-None-Match and get a 304 while the catalogue is unchanged
+            response = app.response_class(snapshot.body, mimetype='application/json')
+            response.set_etag(snapshot.etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response.make_conditional(request)
+        else:
+            return jsonify({'message': 'Database connection failed'}), 500
+
+# Items changed since a position in the change feed. Subscribers load GET /items once,
+# start from ?since= the last_seq it reports here without `since`, then apply each
+# response: upsert `items`, drop `deleted`, and ask again from its last_seq, at once
+# while `more` is true. `wait` long-polls for up to that many seconds when nothing
+# has changed. `reset` means the subscriber fell behind the compacted feed and must
+# reload GET /items before continuing from last_seq.
+@app.route('/items/changes', methods=['GET'])
+def get_item_changes():
+    with tracer.start_as_current_span("get_item_changes"):
+        since = request.args.get('since', type=int)
+        wait = request.args.get('wait', 0, type=float)
+        limit = request.args.get('limit', changes.ITEM_CHANGES_BATCH, type=int)
+        if not 0 < limit <= changes.ITEM_CHANGES_BATCH or not wait >= 0:
+            return jsonify({'message': f'Bad Request: limit must be between 1 and {changes.ITEM_CHANGES_BATCH} '
+                                       'and wait must not be negative'}), 400
+        # Read from the primary: a replica that is behind makes sequence gaps look settled
+        # that the primary may still fill, and the subscriber would skip those changes
         conn = get_db_connection()
         if conn is not None:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM items")
-            items = cursor.fetchall()
-            cursor.close()
-            conn.close()
-            item_list = [{'id': item[0], 'name': item[1], 'quantity': item[2], 'price': item[3]} for item in items]
-            return jsonify({'items': item_list})
+            try:
+                if since is None:
+                    # New subscribers start from the current position of the feed
+                    return jsonify({'items': [], 'deleted': [], 'last_seq': changes.current_seq(cursor),
+                                    'reset': False, 'more': False})
+                item_ids, last_seq, reset, more = changes.poll(conn, cursor, since, limit, wait)
+                items = []
+                if item_ids:
+                    # Read in the same snapshot as the log, so items are at least as new as last_seq
+                    placeholders = ", ".join(["%s"] * len(item_ids))
+                    cursor.execute(f"SELECT {stock.ITEM_COLUMNS} FROM items WHERE items.id IN ({placeholders})",
+                                   tuple(item_ids))
+                    items = [item_record(item) for item in cursor.fetchall()]
+                found = {item['id'] for item in items}
+                return jsonify({
+                    'items': items,
+                    'deleted': [item_id for item_id in item_ids if item_id not in found],
+                    'last_seq': last_seq,
+                    'reset': reset,
+                    'more': more
+                })
+            except mysql.connector.Error as error:
+                logger.error("Error fetching item changes: %s", error)
+                return jsonify({'message': 'Failed to fetch item changes'}), 500
+            finally:
+                conn.rollback()
+                cursor.close()
+                conn.close()
         else:
             return jsonify({'message': 'Database connection failed'}), 500
 
 @app.route('/items/<int:item_id>', methods=['GET'])
 def get_item(item_id):
     with tracer.start_as_current_span("get_item"):
-        conn = get_db_connection()
+        conn = get_read_connection()
         if conn is not None:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM items WHERE id = %s", (item_id,))
+            cursor.execute(f"SELECT {stock.ITEM_COLUMNS}, items.version FROM items WHERE id = %s", (item_id,))
             item = cursor.fetchone()
             cursor.close()
             conn.close()
             if item:
-                item_data = {'id': item[0], 'name': item[1], 'quantity': item[2], 'price': item[3]}
-                return jsonify({'item': item_data})
+                # Sent back as If-Match, the ETag makes an update conditional on this version.
+                # Only updates change it, not stock taken by orders.
+                response = jsonify({'item': item_record(item)})
+                response.set_etag(str(item[4]))
+                return response
             return jsonify({'message': 'Item not found'}), 404
         else:
             return jsonify({'message': 'Database connection failed'}), 500
@@ -146,31 +299,43 @@ def get_item(item_id):
 @app.route('/items/<int:item_id>', methods=['PUT'])
 def update_item(item_id):
     with tracer.start_as_current_span("update_item"):
+        data = request.json
+        changed = updates.changes(data, ('name', 'quantity', 'price')) if isinstance(data, dict) else {}
+        if not changed:
+            return jsonify({'message': 'Bad Request: No data provided for update'}), 400
+        error = validate_item_fields(changed)
+        if error:
+            return jsonify({'message': error}), 400
+        if 'price' in changed:
+            changed['price'] = parse_price(changed['price'])
+        try:
+            expected_version = updates.expected_version(data)
+        except ValueError as error:
+            return jsonify({'message': f'Bad Request: {error}'}), 400
         conn = get_db_connection()
         if conn is not None:
-            cursor = conn.cursor()
-            data = request.json
+            # A new quantity is written to the items row with the other fields, then moved into
+            # the item's buckets if its stock is sharded. That locks the items row and then the
+            # buckets, while a reservation can hold a bucket before it falls back to the items
+            # row, so a deadlock between the two is retried rather than answered with a 500.
+            def update(cursor):
+                version = updates.update_row(cursor, 'items', item_id, changed, expected_version, noun='Item')
+                if 'quantity' in changed:
+                    stock.spread_quantity(cursor, item_id, changed['quantity'])
+                catalogue.bump(cursor)
+                changes.record(cursor, [item_id])
+                return version
             try:
-                cursor.execute("SELECT * FROM items WHERE id = %s", (item_id,))
-                item = cursor.fetchone()
-                if item:
-                    if not data:
-                        return jsonify({'message': 'Bad Request: No data provided for update'}), 400
-                    if 'name' in data:
-                        cursor.execute("UPDATE items SET name = %s WHERE id = %s", (data['name'], item_id))
-                    if 'quantity' in data:
-                        cursor.execute("UPDATE items SET quantity = %s WHERE id = %s", (data['quantity'], item_id))
-                    if 'price' in data:
-                        cursor.execute("UPDATE items SET price = %s WHERE id = %s", (data['price'], item_id))
-                    conn.commit()
-                    return jsonify({'message': 'Item updated successfully'})
-                return jsonify({'message': 'Item not found'}), 404
+                version = stock.run_transaction(conn, update)
+                response = jsonify({'message': 'Item updated successfully', 'version': version})
+                response.set_etag(str(version))
+                return response
+            except updates.UpdateError as error:
+                return jsonify({'message': error.message}), error.status
             except mysql.connector.Error as error:
-                print("Error updating item:", error)
-                conn.rollback()
+                logger.error("Error updating item: %s", error)
                 return jsonify({'message': 'Failed to update item'}), 500
             finally:
-                cursor.close()
                 conn.close()
         else:
             return jsonify({'message': 'Database connection failed'}), 500
@@ -180,29 +345,178 @@ def delete_item(item_id):
     with tracer.start_as_current_span("delete_item"):
         conn = get_db_connection()
         if conn is not None:
-            cursor = conn.cursor()
+            # The delete cascades from the items row to its buckets, the same lock order as
+            # update_item, so it is retried on a deadlock the same way
+            def delete(cursor):
+                cursor.execute("DELETE FROM items WHERE id = %s", (item_id,))
+                if cursor.rowcount == 0:
+                    return False
+                catalogue.bump(cursor)
+                changes.record(cursor, [item_id])
+                return True
             try:
-                cursor.execute("SELECT * FROM items WHERE id = %s", (item_id,))
-                item = cursor.fetchone()
-                if item:
-                    cursor.execute("DELETE FROM items WHERE id = %s", (item_id,))
-                    conn.commit()
+                if stock.run_transaction(conn, delete):
                     return jsonify({'message': 'Item deleted successfully'})
                 return jsonify({'message': 'Item not found'}), 404
             except mysql.connector.Error as error:
-                print("Error deleting item:", error)
-                conn.rollback()
+                logger.error("Error deleting item: %s", error)
                 return jsonify({'message': 'Failed to delete item'}), 500
             finally:
-                cursor.close()
                 conn.close()
         else:
             return jsonify({'message': 'Database connection failed'}), 500
 
+def is_positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+def is_bucket_count(value):
+    return is_positive_int(value) and value <= stock.STOCK_BUCKETS_MAX
+
+# Check the items of one reservation, returning an error message or None
+def validate_reservation_items(items):
+    if not isinstance(items, list) or not items:
+        return 'Bad Request: a non-empty items list is required'
+    for item in items:
+        if not isinstance(item, dict) or not is_positive_int(item.get('item_id')) or not is_positive_int(item.get('quantity')):
+            return 'Bad Request: each item needs a positive item_id and quantity'
+    return None
+
+RESERVATIONS_BATCH_MAX = int(os.environ.get("RESERVATIONS_BATCH_MAX", "1000"))
+
+# Split an item's stock into buckets (or back into the items row with buckets=1) and rebalance it
+@app.route('/items/<int:item_id>/buckets', methods=['PUT'])
+def set_item_buckets(item_id):
+    with tracer.start_as_current_span("set_item_buckets"):
+        data = request.json
+        if not data or not is_bucket_count(data.get('buckets')):
+            return jsonify({'message': f'Bad Request: buckets must be between 1 and {stock.STOCK_BUCKETS_MAX}'}), 400
+        conn = get_db_connection()
+        if conn is None:
+            return jsonify({'message': 'Database connection failed'}), 500
+        try:
+            if not stock.run_transaction(conn, lambda cursor: stock.set_buckets(cursor, item_id, data['buckets'])):
+                return jsonify({'message': 'Item not found'}), 404
+            return jsonify({'message': 'Item stock rebalanced', 'buckets': data['buckets']})
+        except mysql.connector.Error as error:
+            logger.error("Error rebalancing item stock: %s", error)
+            return jsonify({'message': 'Failed to rebalance item stock'}), 500
+        finally:
+            conn.close()
+
+def is_reservation_key(value):
+    return isinstance(value, str) and 0 < len(value) <= stock.STOCK_RESERVATION_KEY_MAX_LENGTH
+
+# Reservations are only made by order-service, which has no use for consistency tokens.
+# Take stock for one order. The response lists where each item was taken from, for release.
+# With a reservation_key, a retry gets the same reservation and the caller can release it by
+# the key alone, e.g. when the response was lost.
+@app.route('/reservations', methods=['POST'])
+@db.without_consistency_token
+def create_reservation():
+    with tracer.start_as_current_span("create_reservation"):
+        data = request.json
+        error = validate_reservation_items(data.get('items') if data else None)
+        if error:
+            return jsonify({'message': error}), 400
+        key = data.get('reservation_key')
+        if key is not None and not is_reservation_key(key):
+            return jsonify({'message': f'Bad Request: reservation_key must be a string of at most '
+                                       f'{stock.STOCK_RESERVATION_KEY_MAX_LENGTH} characters'}), 400
+        conn = get_db_connection()
+        if conn is None:
+            return jsonify({'message': 'Database connection failed'}), 500
+        try:
+            reservation = stock.run_transaction(conn, lambda cursor: stock.reserve(cursor, data['items'], key=key))
+            return jsonify({'reservation': reservation}), 201
+        except stock.StockError as error:
+            return jsonify({'message': error.message}), error.status
+        except mysql.connector.Error as error:
+            logger.error("Error reserving stock: %s", error)
+            return jsonify({'message': 'Failed to reserve stock'}), 500
+        finally:
+            conn.close()
+
+# Take stock for several orders in one transaction, reporting each order's result. With a
+# reservation_key, the caller can release everything the batch took by the key alone.
+@app.route('/reservations/batch', methods=['POST'])
+@db.without_consistency_token
+def create_reservations_batch():
+    with tracer.start_as_current_span("create_reservations_batch"):
+        data = request.json
+        if not data or not isinstance(data.get('orders'), list) or not data['orders']:
+            return jsonify({'message': 'Bad Request: a non-empty orders list is required'}), 400
+        orders = data['orders']
+        if len(orders) > RESERVATIONS_BATCH_MAX:
+            return jsonify({'message': f'Bad Request: at most {RESERVATIONS_BATCH_MAX} orders per batch'}), 400
+        for order in orders:
+            error = validate_reservation_items(order.get('items') if isinstance(order, dict) else None)
+            if error:
+                return jsonify({'message': error}), 400
+        key = data.get('reservation_key')
+        if key is not None and not is_reservation_key(key):
+            return jsonify({'message': f'Bad Request: reservation_key must be a string of at most '
+                                       f'{stock.STOCK_RESERVATION_KEY_MAX_LENGTH} characters'}), 400
+        conn = get_db_connection()
+        if conn is None:
+            return jsonify({'message': 'Database connection failed'}), 500
+        try:
+            results = stock.run_transaction(conn, lambda cursor: stock.reserve_batch(cursor, orders, key=key))
+            return jsonify({'results': results})
+        except stock.StockError as error:
+            return jsonify({'message': error.message}), error.status
+        except mysql.connector.Error as error:
+            logger.error("Error reserving stock: %s", error)
+            return jsonify({'message': 'Failed to reserve stock'}), 500
+        finally:
+            conn.close()
+
+# Give back stock from a reservation whose order could not be stored, given either the
+# reservation's lines or the reservation_key it was made with
+@app.route('/reservations/release', methods=['POST'])
+@db.without_consistency_token
+def release_reservation():
+    with tracer.start_as_current_span("release_reservation"):
+        data = request.json
+        key = data.get('reservation_key') if data else None
+        if key is not None:
+            if not is_reservation_key(key):
+                return jsonify({'message': 'Bad Request: invalid reservation_key'}), 400
+            conn = get_db_connection()
+            if conn is None:
+                return jsonify({'message': 'Database connection failed'}), 500
+            try:
+                released = stock.run_transaction(conn, lambda cursor: stock.release_key(cursor, key))
+                return jsonify({'message': 'Reservation released' if released else 'Nothing to release'})
+            except mysql.connector.Error as error:
+                logger.error("Error releasing stock: %s", error)
+                return jsonify({'message': 'Failed to release stock'}), 500
+            finally:
+                conn.close()
+        reservation = data.get('reservation') if data else None
+        if not isinstance(reservation, list):
+            return jsonify({'message': 'Bad Request: reservation or reservation_key is required'}), 400
+        for line in reservation:
+            if (not isinstance(line, dict) or not is_positive_int(line.get('item_id'))
+                    or not is_positive_int(line.get('quantity'))
+                    or not (line.get('bucket') is None or isinstance(line.get('bucket'), int))):
+                return jsonify({'message': 'Bad Request: invalid reservation line'}), 400
+        conn = get_db_connection()
+        if conn is None:
+            return jsonify({'message': 'Database connection failed'}), 500
+        try:
+            stock.run_transaction(conn, lambda cursor: stock.release(cursor, reservation))
+            return jsonify({'message': 'Reservation released'})
+        except mysql.connector.Error as error:
+            logger.error("Error releasing stock: %s", error)
+            return jsonify({'message': 'Failed to release stock'}), 500
+        finally:
+            conn.close()
+
 # Health check endpoint
 @app.route('/healthz', methods=['GET'])
 def health_check():
     return jsonify({'status': 'ok'}), 200
 
 if __name__ == '__main__':
+    init_worker()
     app.run(host='0.0.0.0', port=5001)
\ No newline at end of file
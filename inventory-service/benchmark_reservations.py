@@ -0,0 +1,110 @@
+# Compare the stock reservation modes in stock.py under concurrent writers.
+#
+# Uses the same DB_* environment variables as the service. A few scratch items
+# are created with plenty of stock, every writer thread reserves random carts
+# against them in its own transactions, and the items are deleted afterwards.
+#
+#   DB_HOST=... DB_NAME=... DB_USER=... DB_PASSWORD=... \
+#       python benchmark_reservations.py --threads 32 --orders 200
+import argparse
+import json
+import random
+import threading
+import time
+
+import mysql.connector
+
+import db
+import stock
+
+
+def connect():
+    return mysql.connector.connect(host=db.DB_HOST, port=db.DB_PORT, database=db.DB_NAME,
+                                   user=db.DB_USER, password=db.DB_PASSWORD)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def create_items(conn, count, quantity, buckets):
+    cursor = conn.cursor()
+    item_ids = []
+    for index in range(count):
+        cursor.execute("INSERT INTO items (name, quantity, price) VALUES (%s, %s, %s)",
+                       (f"benchmark-item-{index}", quantity, 1))
+        item_ids.append(cursor.lastrowid)
+        if buckets > 1:
+            stock.set_buckets(cursor, cursor.lastrowid, buckets)
+    conn.commit()
+    cursor.close()
+    return item_ids
+
+
+def delete_items(conn, item_ids):
+    cursor = conn.cursor()
+    cursor.execute(f"DELETE FROM items WHERE id IN ({', '.join(['%s'] * len(item_ids))})", tuple(item_ids))
+    conn.commit()
+    cursor.close()
+
+
+def writer(item_ids, args, mode, latencies, errors):
+    conn = connect()
+    try:
+        for _ in range(args.orders):
+            cart = [{'item_id': item_id, 'quantity': 1}
+                    for item_id in random.sample(item_ids, min(args.cart_size, len(item_ids)))]
+            start = time.perf_counter()
+            try:
+                stock.run_transaction(conn, lambda cursor: stock.reserve(cursor, cart, mode))
+                latencies.append(time.perf_counter() - start)
+            except (mysql.connector.Error, stock.StockError) as error:
+                errors.append(str(error))
+    finally:
+        conn.close()
+
+
+def run(mode, args):
+    conn = connect()
+    item_ids = create_items(conn, args.items, args.threads * args.orders * args.cart_size, args.buckets)
+    latencies, errors = [], []
+    threads = [threading.Thread(target=writer, args=(item_ids, args, mode, latencies, errors))
+               for _ in range(args.threads)]
+    try:
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        delete_items(conn, item_ids)
+        conn.close()
+    return {
+        'mode': mode,
+        'orders': len(latencies),
+        'errors': len(errors),
+        'orders_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare stock reservation modes under concurrent writers")
+    parser.add_argument("--modes", nargs="+", choices=stock.RESERVATION_MODES, default=list(stock.RESERVATION_MODES))
+    parser.add_argument("--threads", type=int, default=16, help="concurrent writers")
+    parser.add_argument("--orders", type=int, default=200, help="orders per writer")
+    parser.add_argument("--items", type=int, default=5, help="scratch items the writers contend on")
+    parser.add_argument("--cart-size", type=int, default=1, help="items per order")
+    parser.add_argument("--buckets", type=int, default=1, help="stock buckets per scratch item")
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        print(json.dumps(run(mode, args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import hashlib
+import os
+import random
+import threading
+
+# The catalogue version is the sum of a few counter rows. Every write that changes what
+# GET /items returns bumps one random row in the same transaction, so writers rarely wait
+# on each other, and every worker and replica sees the same version.
+CATALOGUE_VERSION_SHARDS = int(os.environ.get("CATALOGUE_VERSION_SHARDS", "16"))
+
+
+def bump(cursor):
+    cursor.execute("INSERT INTO catalogue_versions (shard, version) VALUES (%s, 1) "
+                   "ON DUPLICATE KEY UPDATE version = version + 1",
+                   (random.randrange(CATALOGUE_VERSION_SHARDS),))
+
+
+def current_version(cursor):
+    cursor.execute("SELECT COALESCE(SUM(version), 0) FROM catalogue_versions")
+    return int(cursor.fetchone()[0])
+
+
+class Snapshot:
+    """The serialised GET /items body for one catalogue version, with its strong ETag."""
+
+    def __init__(self, version, body):
+        self.version = version
+        self.body = body
+        self.etag = hashlib.sha256(body.encode()).hexdigest()[:32]
+
+
+class Catalogue:
+    """Per-process cache of the latest catalogue snapshot.
+
+    load(cursor) reads the current version and the items in one transaction and
+    returns (version, body). It only runs when the version has moved on, and only
+    in one thread at a time.
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self.snapshot = None
+        self._lock = threading.Lock()
+
+    def get(self, conn):
+        cursor = conn.cursor()
+        try:
+            version = current_version(cursor)
+            conn.commit()  # End the read so the rebuild below gets a fresh consistent snapshot
+            snapshot = self.snapshot
+            if snapshot is not None and snapshot.version >= version:
+                return snapshot
+            with self._lock:
+                snapshot = self.snapshot
+                if snapshot is None or snapshot.version < version:
+                    conn.start_transaction()
+                    try:
+                        snapshot = self.snapshot = Snapshot(*self.load(cursor))
+                    finally:
+                        conn.rollback()
+                return snapshot
+        finally:
+            cursor.close()
@@ -0,0 +1,79 @@
+import os
+import random
+import threading
+import time
+
+# Sequenced log of changed items. Every write that changes an item's name, price or
+# quantity, orders included, appends the item's id in the same transaction. Subscribers
+# read GET /items/changes?since=<seq> and get the current state of the items changed
+# since then, so keeping a copy of the catalogue costs in proportion to churn rather
+# than to catalogue size. Entries older than the retention are compacted away; a
+# subscriber that falls further behind is told to reset and reload GET /items.
+ITEM_CHANGES_RETENTION = int(os.environ.get("ITEM_CHANGES_RETENTION", "3600"))  # Seconds of feed history kept
+ITEM_CHANGES_BATCH = int(os.environ.get("ITEM_CHANGES_BATCH", "1000"))  # Log entries read per response at most
+ITEM_CHANGES_MAX_WAIT = float(os.environ.get("ITEM_CHANGES_MAX_WAIT", "20"))  # Longest long-poll, in seconds
+ITEM_CHANGES_POLL_INTERVAL = float(os.environ.get("ITEM_CHANGES_POLL_INTERVAL", "0.5"))
+ITEM_CHANGES_MAX_WAITERS = int(os.environ.get("ITEM_CHANGES_MAX_WAITERS", "2"))  # Long-polls per process; others answer at once
+ITEM_CHANGES_SETTLE = float(os.environ.get("ITEM_CHANGES_SETTLE", "1"))  # Seconds a gap in the sequence may be a running transaction
+
+# Long-polls hold a worker thread, so only a few may wait at a time
+_waiters = threading.BoundedSemaphore(ITEM_CHANGES_MAX_WAITERS)
+
+
+# Log changes to the given items, inside the caller's transaction
+def record(cursor, item_ids):
+    if not item_ids:
+        return
+    cursor.executemany("INSERT INTO item_changes (item_id) VALUES (%s)", [(item_id,) for item_id in sorted(set(item_ids))])
+    if random.random() < 0.01:
+        compact(cursor)
+
+
+def compact(cursor):
+    cursor.execute("DELETE FROM item_changes WHERE created_at < NOW() - INTERVAL %s SECOND LIMIT 1000",
+                   (ITEM_CHANGES_RETENTION,))
+
+
+def current_seq(cursor):
+    cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM item_changes")
+    return int(cursor.fetchone()[0])
+
+
+# Read the log after `since`: (changed item ids, oldest first and each once, the seq they
+# bring the subscriber up to, whether it must reset, whether more entries are waiting)
+def read(cursor, since, limit=ITEM_CHANGES_BATCH):
+    cursor.execute("SELECT MIN(seq), MAX(seq) FROM item_changes")
+    first_seq, last_seq = cursor.fetchone()
+    # Entries after `since` were compacted away, so the subscriber must reload everything
+    reset = first_seq is not None and since < first_seq - 1
+    position = first_seq - 1 if reset else since
+    cursor.execute("SELECT seq, item_id, created_at > NOW(3) - INTERVAL %s SECOND FROM item_changes "
+                   "WHERE seq > %s ORDER BY seq LIMIT %s", (ITEM_CHANGES_SETTLE, position, limit))
+    item_ids = {}
+    for seq, item_id, recent in cursor.fetchall():
+        # Sequence numbers are handed out before commit, so a recent gap may be a change that
+        # is still being committed. Stop short of it rather than skip it for good.
+        if seq != position + 1 and recent:
+            break
+        item_ids.pop(item_id, None)
+        item_ids[item_id] = seq
+        position = seq
+    return list(item_ids), position, reset, position < (last_seq or 0)
+
+
+# read() until something changes or `wait` seconds pass. Each poll ends the previous
+# transaction, so the caller's reads after this one see the state the log describes.
+def poll(conn, cursor, since, limit=ITEM_CHANGES_BATCH, wait=0):
+    deadline = time.monotonic() + min(wait, ITEM_CHANGES_MAX_WAIT)
+    waiting = wait > 0 and _waiters.acquire(blocking=False)
+    try:
+        while True:
+            conn.rollback()  # A fresh snapshot for every poll
+            result = read(cursor, since, limit)
+            item_ids, position, reset, _ = result
+            if item_ids or reset or position != since or not waiting or time.monotonic() >= deadline:
+                return result
+            time.sleep(ITEM_CHANGES_POLL_INTERVAL)
+    finally:
+        if waiting:
+            _waiters.release()
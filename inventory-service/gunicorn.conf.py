@@ -0,0 +1,77 @@
+# Gunicorn settings shared by every service. gunicorn picks this file up from the
+# working directory, so the Dockerfiles only need to run `gunicorn`.
+#
+# Everything is tunable through environment variables. Send SIGHUP to the master
+# for a graceful reload: new workers are started before old ones are stopped.
+import importlib
+import math
+import os
+import shutil
+
+
+def available_cpus():
+    # Honour the container's CPU limit (cgroup v2, then v1) rather than the host's core count
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+            if quota != "max":
+                return max(1, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0:
+            return max(1, math.ceil(quota / period))
+    except (OSError, ValueError):
+        pass
+    return os.cpu_count() or 1
+
+
+wsgi_app = os.environ.get("GUNICORN_APP", "app:app")
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Worker model: sync, gthread (default), gevent (needs the gevent package) or,
+# for the asyncio gateway, aiohttp.GunicornWebWorker with GUNICORN_APP=async_app:app
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("GUNICORN_WORKERS", available_cpus() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+# Import the app once in the master so workers fork with it already loaded.
+# Per-process state (span exporter thread, DB pool, tables) is set up after fork in post_worker_init.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "true").lower() == "true"
+
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", "0"))
+
+accesslog = os.environ.get("GUNICORN_ACCESSLOG")
+errorlog = "-"
+
+if worker_class == "gevent":
+    # Must run before the app (and its socket users) is imported in the master
+    from gevent import monkey
+    monkey.patch_all()
+
+# Workers write their metrics to this directory so /metrics reports all of them, not
+# just the worker that served the scrape. It has to exist before the app is imported,
+# and is only wiped on a cold start because SIGHUP re-reads this file.
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = "/tmp/prometheus-multiproc"
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+
+def post_worker_init(worker):
+    module_name = worker.cfg.wsgi_app.split(":")[0]
+    importlib.import_module(module_name).init_worker()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
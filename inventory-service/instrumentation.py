@@ -0,0 +1,95 @@
+import time
+from urllib.parse import urlsplit
+
+from opentelemetry.sdk.trace import SpanProcessor
+from opentelemetry.trace import SpanKind
+from prometheus_client import Histogram
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# Label upstream calls by service, e.g. http://user-app.flask-app.svc.cluster.local:80/users/7 -> user-app.
+# Hosts without a service name (localhost, IPs) keep their port so local upstreams stay apart.
+def upstream_name(url):
+    parts = urlsplit(url)
+    host = parts.hostname or "unknown"
+    if "." not in host or host.replace(".", "").isdigit():
+        return parts.netloc
+    return host.split(".")[0]
+
+
+def status_class(status):
+    return f"{status // 100}xx" if isinstance(status, int) else "error"
+
+
+# Spans from the OpenTelemetry Flask/requests/aiohttp instrumentation, as opposed to the handlers' own stages
+def _is_auto_instrumented(span):
+    scope = span.instrumentation_scope
+    return scope is not None and scope.name.startswith("opentelemetry.instrumentation")
+
+
+class LatencyMetricsProcessor(SpanProcessor):
+    """Turns finished spans into Prometheus histograms.
+
+    Internal spans (the tracer.start_as_current_span stages in the handlers) are
+    recorded per stage name, and client spans from the requests/aiohttp
+    instrumentation per upstream service, method and status class. Span names
+    and upstream hosts are fixed in code, so the label sets stay small.
+    """
+
+    def on_end(self, span):
+        if _stage_histogram is None:
+            return
+        seconds = (span.end_time - span.start_time) / 1e9
+        if span.kind == SpanKind.INTERNAL and not _is_auto_instrumented(span):
+            _stage_histogram.labels(stage=span.name).observe(seconds)
+        elif span.kind == SpanKind.CLIENT:
+            attributes = span.attributes
+            url = attributes.get("http.url")
+            if url:
+                _upstream_histogram.labels(
+                    upstream=upstream_name(url),
+                    method=attributes.get("http.method", ""),
+                    status=status_class(attributes.get("http.status_code")),
+                ).observe(seconds)
+
+
+# aiohttp client trace hooks that record how long opening each upstream connection took
+def upstream_trace_config():
+    import aiohttp
+
+    async def on_request_start(session, context, params):
+        context.upstream = upstream_name(str(params.url))
+
+    async def on_connection_create_start(session, context, params):
+        context.connect_start = time.perf_counter()
+
+    async def on_connection_create_end(session, context, params):
+        observe_upstream_connect(getattr(context, "upstream", "unknown"), time.perf_counter() - context.connect_start)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    return trace_config
+
+
+def observe_upstream_connect(upstream, seconds):
+    if _upstream_connect_histogram is not None:
+        _upstream_connect_histogram.labels(upstream=upstream).observe(seconds)
+
+
+# Latency metrics, registered on the service's metrics registry by bind_metrics()
+_stage_histogram = None
+_upstream_histogram = None
+_upstream_connect_histogram = None
+
+
+def bind_metrics(registry):
+    global _stage_histogram, _upstream_histogram, _upstream_connect_histogram
+    _stage_histogram = Histogram('stage_seconds', 'Time spent in each traced stage of a request handler',
+                                 ['stage'], buckets=LATENCY_BUCKETS, registry=registry)
+    _upstream_histogram = Histogram('upstream_request_seconds', 'Latency of calls to other services',
+                                    ['upstream', 'method', 'status'], buckets=LATENCY_BUCKETS, registry=registry)
+    _upstream_connect_histogram = Histogram('upstream_connect_seconds', 'Time to open a connection to another service',
+                                            ['upstream'], buckets=LATENCY_BUCKETS, registry=registry)
@@ -0,0 +1,51 @@
+# Apply inventory-service's schema migrations. Runs once per deployment, before the pods start:
+#   DB_HOST=... DB_NAME=... DB_USER=... DB_PASSWORD=... python migrate.py [--status] [--to VERSION]
+from migrations import Migration, add_column, add_index, main
+
+SERVICE = "inventory-service"
+
+MIGRATIONS = [
+    Migration(1, "Create items, stock buckets and catalogue versions", '''
+        CREATE TABLE IF NOT EXISTS items (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            quantity INT NOT NULL,
+            price DECIMAL(10, 2) NOT NULL
+        )
+    ''', '''
+        CREATE TABLE IF NOT EXISTS item_stock_buckets (
+            item_id INT NOT NULL,
+            bucket INT NOT NULL,
+            quantity INT NOT NULL,
+            PRIMARY KEY (item_id, bucket),
+            FOREIGN KEY (item_id) REFERENCES items(id) ON DELETE CASCADE
+        )
+    ''', '''
+        CREATE TABLE IF NOT EXISTS catalogue_versions (
+            shard INT NOT NULL PRIMARY KEY,
+            version BIGINT NOT NULL
+        )
+    '''),
+    Migration(2, "Index items by name", add_index("items", "name")),
+    Migration(3, "Version items for optimistic concurrency", add_column("items", "version", "INT NOT NULL DEFAULT 1")),
+    Migration(4, "Create the item change feed", '''
+        CREATE TABLE IF NOT EXISTS item_changes (
+            seq BIGINT AUTO_INCREMENT PRIMARY KEY,
+            item_id INT NOT NULL,
+            created_at TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+            INDEX (created_at)
+        )
+    '''),
+    Migration(5, "Record keyed stock reservations", '''
+        CREATE TABLE IF NOT EXISTS stock_reservations (
+            reservation_key VARCHAR(64) NOT NULL PRIMARY KEY,
+            reservation TEXT NULL,
+            released BOOLEAN NOT NULL DEFAULT FALSE,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            INDEX (created_at)
+        )
+    '''),
+]
+
+if __name__ == '__main__':
+    main(SERVICE, MIGRATIONS)
@@ -0,0 +1,138 @@
+import argparse
+import os
+import sys
+
+import mysql.connector
+
+import db
+
+# Versioned schema migrations. Each service lists its migrations in migrate.py and applies
+# them with `python migrate.py` once per deployment, before its pods start, so service
+# processes never run DDL. All services share schema_migrations, keyed by service name.
+MIGRATIONS_LOCK = "schema_migrations"
+MIGRATIONS_LOCK_TIMEOUT = int(os.environ.get("MIGRATIONS_LOCK_TIMEOUT", "300"))  # Seconds to wait for another run
+
+
+class Migration:
+    """One schema version: a description and steps, each an SQL string or a function taking a cursor."""
+
+    def __init__(self, version, description, *steps):
+        self.version = version
+        self.description = description
+        self.steps = steps
+
+
+def create_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            service VARCHAR(64) NOT NULL,
+            version INT NOT NULL,
+            description VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (service, version)
+        )
+    ''')
+
+
+def applied_versions(cursor, service):
+    cursor.execute("SELECT version FROM schema_migrations WHERE service = %s", (service,))
+    return {row[0] for row in cursor.fetchall()}
+
+
+def column_exists(cursor, table, column):
+    cursor.execute("SELECT COUNT(*) FROM information_schema.columns "
+                   "WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s", (table, column))
+    return cursor.fetchone()[0] > 0
+
+
+# Leading columns of every index on the table
+def index_columns(cursor, table):
+    cursor.execute("SELECT index_name, column_name FROM information_schema.statistics "
+                   "WHERE table_schema = DATABASE() AND table_name = %s ORDER BY index_name, seq_in_index", (table,))
+    indexes = {}
+    for index_name, column_name in cursor.fetchall():
+        indexes.setdefault(index_name, []).append(column_name)
+    return list(indexes.values())
+
+
+# A step that adds an index unless one already starts with the same columns, as tables
+# created before migrations existed may already have it
+def add_index(table, *columns):
+    def step(cursor):
+        if any(existing[:len(columns)] == list(columns) for existing in index_columns(cursor, table)):
+            return
+        cursor.execute(f"CREATE INDEX idx_{table}_{'_'.join(columns)} ON {table} ({', '.join(columns)})")
+    return step
+
+
+# A step that adds a column unless the table already has it
+def add_column(table, column, definition):
+    def step(cursor):
+        if not column_exists(cursor, table, column):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return step
+
+
+def migrate(conn, service, migrations, target=None):
+    cursor = conn.cursor()
+    # Serialise runs, e.g. a job retried while its first pod is still going
+    cursor.execute("SELECT GET_LOCK(%s, %s)", (MIGRATIONS_LOCK, MIGRATIONS_LOCK_TIMEOUT))
+    if cursor.fetchone()[0] != 1:
+        cursor.close()
+        raise RuntimeError("Timed out waiting for another migration run to finish")
+    try:
+        create_table(cursor)
+        done = applied_versions(cursor, service)
+        applied = []
+        for migration in sorted(migrations, key=lambda migration: migration.version):
+            if target is not None and migration.version > target:
+                break
+            if migration.version in done:
+                continue
+            print(f"Applying {service} migration {migration.version}: {migration.description}")
+            # MySQL commits DDL as it goes, so steps are written to be safe to re-run if one fails
+            for step in migration.steps:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute("INSERT INTO schema_migrations (service, version, description) VALUES (%s, %s, %s)",
+                           (service, migration.version, migration.description))
+            conn.commit()
+            applied.append(migration.version)
+        return applied
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATIONS_LOCK,))
+        cursor.fetchone()
+        cursor.close()
+
+
+def main(service, migrations):
+    parser = argparse.ArgumentParser(description=f"Apply {service} schema migrations")
+    parser.add_argument("--to", type=int, help="stop after this version")
+    parser.add_argument("--status", action="store_true", help="list migrations and whether they are applied")
+    args = parser.parse_args()
+
+    try:
+        conn = mysql.connector.connect(host=db.DB_HOST, port=db.DB_PORT, database=db.DB_NAME,
+                                       user=db.DB_USER, password=db.DB_PASSWORD)
+    except mysql.connector.Error as error:
+        print("Error connecting to the database:", error)
+        sys.exit(1)
+    try:
+        if args.status:
+            cursor = conn.cursor()
+            create_table(cursor)
+            done = applied_versions(cursor, service)
+            cursor.close()
+            for migration in sorted(migrations, key=lambda migration: migration.version):
+                state = "applied" if migration.version in done else "pending"
+                print(f"{migration.version:4d} {state:8s} {migration.description}")
+            return
+        applied = migrate(conn, service, migrations, args.to)
+        print(f"{service}: {len(applied)} migration(s) applied" if applied else f"{service}: schema is up to date")
+    except (mysql.connector.Error, RuntimeError) as error:
+        print("Error applying migrations:", error)
+        sys.exit(1)
+    finally:
+        conn.close()
@@ -0,0 +1,283 @@
+import json
+import os
+import random
+
+import mysql.connector
+from mysql.connector import errorcode
+
+import catalogue
+import changes
+
+# Stock for a hot item can be split across several rows (buckets) of item_stock_buckets,
+# so concurrent orders for it lock different rows instead of queueing on one items row.
+# An item's quantity is items.quantity plus the sum of its buckets; items.quantity holds
+# all the stock of unsharded items and is 0 for sharded ones.
+STOCK_BUCKETS = int(os.environ.get("STOCK_BUCKETS", "1"))  # Buckets for new items; 1 keeps stock on the items row
+STOCK_BUCKETS_MAX = 64
+STOCK_DEADLOCK_RETRIES = int(os.environ.get("STOCK_DEADLOCK_RETRIES", "3"))
+# A reservation made with a key is recorded under it, so a caller that lost the response can
+# still release it by key; a key released first is refused when its reservation turns up later
+STOCK_RESERVATION_KEY_MAX_LENGTH = 64
+STOCK_RESERVATION_RETENTION = int(os.environ.get("STOCK_RESERVATION_RETENTION", "86400"))  # Seconds keys are kept
+
+# How unsharded items are decremented: "conditional" issues one guarded UPDATE and only falls
+# back to locking the row when it matches nothing; "locking" always reads the row FOR UPDATE first
+RESERVATION_MODES = ("conditional", "locking")
+STOCK_RESERVATION_MODE = os.environ.get("STOCK_RESERVATION_MODE", "conditional")
+
+# Use in place of `SELECT * FROM items` so sharded items report their total quantity
+ITEM_COLUMNS = ("items.id, items.name, CAST(items.quantity + COALESCE((SELECT SUM(b.quantity) FROM item_stock_buckets b "
+                "WHERE b.item_id = items.id), 0) AS SIGNED) AS quantity, items.price")
+
+
+class StockError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def split(total, buckets):
+    return [total // buckets + (1 if bucket < total % buckets else 0) for bucket in range(buckets)]
+
+
+# Lock an item row and then its buckets, the order every writer that locks a whole item uses.
+# Two paths lock a single bucket first and may then need the items row: a reservation whose
+# bucket fast path misses, and a release whose bucket is gone. Both can deadlock against a
+# whole-item writer, so every writer of stock runs through run_transaction, which retries.
+# Returns (items.quantity, [(bucket, quantity), ...]) or None if the item does not exist.
+def _lock(cursor, item_id):
+    cursor.execute("SELECT quantity FROM items WHERE id = %s FOR UPDATE", (item_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    cursor.execute("SELECT bucket, quantity FROM item_stock_buckets WHERE item_id = %s ORDER BY bucket FOR UPDATE",
+                   (item_id,))
+    return row[0], cursor.fetchall()
+
+
+# Write total back over the locked item, as `buckets` even buckets (or the items row alone for 1)
+def _spread(cursor, item_id, total, buckets, current_buckets):
+    if buckets == len(current_buckets) and buckets > 1:
+        cursor.executemany("UPDATE item_stock_buckets SET quantity = %s WHERE item_id = %s AND bucket = %s",
+                           [(quantity, item_id, bucket) for bucket, quantity in enumerate(split(total, buckets))])
+        cursor.execute("UPDATE items SET quantity = 0 WHERE id = %s", (item_id,))
+        return
+    if current_buckets:
+        cursor.execute("DELETE FROM item_stock_buckets WHERE item_id = %s", (item_id,))
+    if buckets > 1:
+        cursor.executemany("INSERT INTO item_stock_buckets (item_id, bucket, quantity) VALUES (%s, %s, %s)",
+                           [(item_id, bucket, quantity) for bucket, quantity in enumerate(split(total, buckets))])
+        total = 0
+    cursor.execute("UPDATE items SET quantity = %s WHERE id = %s", (total, item_id))
+
+
+# Re-split an item's stock into the given number of buckets; returns False if the item does not exist
+def set_buckets(cursor, item_id, buckets):
+    stock = _lock(cursor, item_id)
+    if stock is None:
+        return False
+    base, current_buckets = stock
+    _spread(cursor, item_id, base + sum(quantity for _, quantity in current_buckets), buckets, current_buckets)
+    return True
+
+
+# Finish setting an item's total quantity after an UPDATE wrote it to items.quantity (and so
+# locked the items row): a sharded item's total is spread over its buckets instead
+def spread_quantity(cursor, item_id, quantity):
+    cursor.execute("SELECT bucket, quantity FROM item_stock_buckets WHERE item_id = %s ORDER BY bucket FOR UPDATE",
+                   (item_id,))
+    current_buckets = cursor.fetchall()
+    if current_buckets:
+        _spread(cursor, item_id, quantity, len(current_buckets), current_buckets)
+
+
+def _reserve_locked(cursor, item_id, quantity):
+    stock = _lock(cursor, item_id)
+    if stock is None:
+        raise StockError(404, f'Item {item_id} not found')
+    base, current_buckets = stock
+    total = base + sum(available for _, available in current_buckets)
+    if total < quantity:
+        raise StockError(400, f'Insufficient quantity for item {item_id}')
+    if current_buckets:
+        # No single bucket could cover the order, so draw across all of them and,
+        # while they are locked anyway, rebalance what is left evenly
+        _spread(cursor, item_id, total - quantity, len(current_buckets), current_buckets)
+    else:
+        cursor.execute("UPDATE items SET quantity = %s WHERE id = %s", (base - quantity, item_id))
+    return {'item_id': item_id, 'bucket': None, 'quantity': quantity}
+
+
+def reserve_item(cursor, item_id, quantity, mode=STOCK_RESERVATION_MODE):
+    # Non-locking read of the item's buckets; none means all its stock is on the items row
+    cursor.execute("SELECT bucket, quantity FROM item_stock_buckets WHERE item_id = %s", (item_id,))
+    buckets = cursor.fetchall()
+    if buckets:
+        # Fast path: take the whole quantity from one random bucket that has enough, locking only that row
+        candidates = [bucket for bucket, available in buckets if available >= quantity]
+        if candidates:
+            bucket = random.choice(candidates)
+            cursor.execute("UPDATE item_stock_buckets SET quantity = quantity - %s "
+                           "WHERE item_id = %s AND bucket = %s AND quantity >= %s",
+                           (quantity, item_id, bucket, quantity))
+            if cursor.rowcount == 1:
+                return {'item_id': item_id, 'bucket': bucket, 'quantity': quantity}
+    elif mode == "conditional":
+        # One guarded decrement. When it matches no row the item is missing, short, or was just
+        # sharded; the locked path below tells those apart.
+        cursor.execute("UPDATE items SET quantity = quantity - %s WHERE id = %s AND quantity >= %s",
+                       (quantity, item_id, quantity))
+        if cursor.rowcount == 1:
+            return {'item_id': item_id, 'bucket': None, 'quantity': quantity}
+    return _reserve_locked(cursor, item_id, quantity)
+
+
+# Reserve every item of one order, in item id order so concurrent orders lock rows in the same order.
+# Raises StockError on the first item that cannot be reserved; the caller rolls back.
+def _reserve_items(cursor, items, mode):
+    return [reserve_item(cursor, item['item_id'], item['quantity'], mode)
+            for item in sorted(items, key=lambda item: item['item_id'])]
+
+
+def reserve(cursor, items, mode=STOCK_RESERVATION_MODE, key=None):
+    if key is not None:
+        stored = _claim_key(cursor, key, released=False)
+        if stored is not None:
+            reservation, released = stored
+            if released:
+                raise StockError(409, 'Reservation was already released')
+            # A retry of a reservation already taken
+            return json.loads(reservation)
+    reservation = _reserve_items(cursor, items, mode)
+    catalogue.bump(cursor)
+    changes.record(cursor, [line['item_id'] for line in reservation])
+    if key is not None:
+        _store(cursor, key, reservation)
+    return reservation
+
+
+# Record the lines taken under a key claimed by _claim_key, so release_key can give them back
+def _store(cursor, key, reservation):
+    cursor.execute("UPDATE stock_reservations SET reservation = %s WHERE reservation_key = %s",
+                   (json.dumps(reservation), key))
+    if random.random() < 0.01:
+        cursor.execute("DELETE FROM stock_reservations WHERE created_at < NOW() - INTERVAL %s SECOND LIMIT 1000",
+                       (STOCK_RESERVATION_RETENTION,))
+
+
+# Reserve several orders in one transaction; an order gets all its items or none of them.
+# Every item of the batch is locked once, in id order across the whole batch so concurrent
+# batches and orders take row locks in the same order, and written back once, however many
+# orders it is in. Orders are then served from the locked totals in request order.
+# With a key, every line taken for the batch is recorded under it for release_key; a
+# batch is never retried, so a key that was already used is refused.
+def reserve_batch(cursor, orders, key=None):
+    if key is not None and _claim_key(cursor, key, released=False) is not None:
+        raise StockError(409, 'Reservation key was already used')
+    available = {}  # item id -> [total quantity, locked buckets]
+    for item_id in sorted({item['item_id'] for order in orders for item in order['items']}):
+        stock = _lock(cursor, item_id)
+        if stock is not None:
+            base, current_buckets = stock
+            available[item_id] = [base + sum(quantity for _, quantity in current_buckets), current_buckets]
+    taken = {}
+    results = []
+    for order in orders:
+        lines = sorted(order['items'], key=lambda item: item['item_id'])
+        needed = {}
+        error = None
+        for item in lines:
+            item_id = item['item_id']
+            if item_id not in available:
+                error = StockError(404, f'Item {item_id} not found')
+                break
+            needed[item_id] = needed.get(item_id, 0) + item['quantity']
+            if available[item_id][0] - taken.get(item_id, 0) < needed[item_id]:
+                error = StockError(400, f'Insufficient quantity for item {item_id}')
+                break
+        if error is not None:
+            results.append({'status': error.status, 'message': error.message})
+            continue
+        for item_id, quantity in needed.items():
+            taken[item_id] = taken.get(item_id, 0) + quantity
+        results.append({'status': 201, 'reservation': [{'item_id': item['item_id'], 'bucket': None,
+                                                        'quantity': item['quantity']} for item in lines]})
+    for item_id in sorted(taken):
+        total, current_buckets = available[item_id]
+        if current_buckets:
+            _spread(cursor, item_id, total - taken[item_id], len(current_buckets), current_buckets)
+        else:
+            cursor.execute("UPDATE items SET quantity = %s WHERE id = %s", (total - taken[item_id], item_id))
+    if taken:
+        catalogue.bump(cursor)
+        changes.record(cursor, list(taken))
+    if key is not None:
+        _store(cursor, key, [line for result in results if result['status'] == 201 for line in result['reservation']])
+    return results
+
+
+# Give reserved stock back, to the bucket it came from when that bucket still exists.
+# A line without a bucket goes back to the items row.
+def release(cursor, reservation):
+    for line in sorted(reservation, key=lambda line: line['item_id']):
+        bucket = line.get('bucket')
+        if bucket is not None:
+            cursor.execute("UPDATE item_stock_buckets SET quantity = quantity + %s WHERE item_id = %s AND bucket = %s",
+                           (line['quantity'], line['item_id'], bucket))
+            if cursor.rowcount == 1:
+                continue
+        cursor.execute("UPDATE items SET quantity = quantity + %s WHERE id = %s", (line['quantity'], line['item_id']))
+    catalogue.bump(cursor)
+    changes.record(cursor, [line['item_id'] for line in reservation])
+
+
+# Insert the key's row, or lock and return (reservation, released) of the row already there.
+# A plain INSERT only locks the new row, so concurrent reservations under different keys do
+# not block each other the way a locking read of a missing key would.
+def _claim_key(cursor, key, released):
+    try:
+        cursor.execute("INSERT INTO stock_reservations (reservation_key, released) VALUES (%s, %s)", (key, released))
+        return None
+    except mysql.connector.IntegrityError as error:
+        if error.errno != errorcode.ER_DUP_ENTRY:
+            raise
+    cursor.execute("SELECT reservation, released FROM stock_reservations WHERE reservation_key = %s FOR UPDATE",
+                   (key,))
+    return cursor.fetchone()
+
+
+# Give back the reservation made under `key`, if there was one and it is still held.
+# Returns whether stock was given back.
+def release_key(cursor, key):
+    stored = _claim_key(cursor, key, released=True)
+    if stored is None:
+        return False
+    reservation, released = stored
+    if released:
+        return False
+    release(cursor, json.loads(reservation))
+    cursor.execute("UPDATE stock_reservations SET released = TRUE WHERE reservation_key = %s", (key,))
+    return True
+
+
+# Run work(cursor) in a transaction, retrying when InnoDB picks it as a deadlock victim.
+# Nothing is applied by a deadlocked attempt, so running it again is safe.
+def run_transaction(conn, work):
+    for attempt in range(1, STOCK_DEADLOCK_RETRIES + 1):
+        cursor = conn.cursor()
+        try:
+            conn.start_transaction()
+            result = work(cursor)
+            conn.commit()
+            return result
+        except mysql.connector.Error as error:
+            conn.rollback()
+            if error.errno == errorcode.ER_LOCK_DEADLOCK and attempt < STOCK_DEADLOCK_RETRIES:
+                continue
+            raise
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
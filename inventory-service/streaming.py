@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+
+import mysql.connector
+from flask import Response, current_app, request, stream_with_context
+
+logger = logging.getLogger(__name__)
+
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", "500"))  # Rows fetched and written per chunk
+NDJSON_MIMETYPE = "application/x-ndjson"
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", "500"))  # Rows inserted and committed together by bulk endpoints
+
+
+def wants_ndjson():
+    return request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+# Clients opt in with ?stream=1 or by asking for NDJSON
+def wants_stream():
+    return request.args.get("stream", "").lower() in ("1", "true", "yes") or wants_ndjson()
+
+
+def _close(cursor, conn):
+    try:
+        cursor.close()
+    except mysql.connector.Error:
+        # Abandoned streams leave unread rows behind; the pool discards such connections
+        pass
+    conn.close()
+
+
+def _iter_chunks(cursor, conn, chunk_size):
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        _close(cursor, conn)
+
+
+# Run the query on an unbuffered cursor and yield its rows a chunk at a time.
+# The query runs eagerly so errors surface before the response starts; the
+# cursor and connection are closed once the chunks are exhausted.
+def query_row_chunks(conn, query, params=(), chunk_size=STREAM_CHUNK_SIZE):
+    cursor = conn.cursor(buffered=False)
+    try:
+        cursor.execute(query, params)
+    except mysql.connector.Error:
+        _close(cursor, conn)
+        raise
+    return _iter_chunks(cursor, conn, chunk_size)
+
+
+# Stream chunks of records as {"<key>": [...]} or, when negotiated, as NDJSON
+def stream_records(key, chunks, to_record=lambda row: row):
+    dumps = current_app.json.dumps
+
+    if wants_ndjson():
+        def generate():
+            try:
+                for rows in chunks:
+                    yield "".join(dumps(to_record(row)) + "\n" for row in rows)
+            except mysql.connector.Error as error:
+                logger.error("Error streaming rows: %s", error)
+
+        return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+    def generate():
+        yield '{"%s": [' % key
+        separator = ""
+        try:
+            for rows in chunks:
+                if rows:
+                    yield separator + ",".join(dumps(to_record(row)) for row in rows)
+                    separator = ","
+        except mysql.connector.Error as error:
+            # Headers are already sent, so a truncated body is the only way to signal failure
+            logger.error("Error streaming rows: %s", error)
+            return
+        yield "]}"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def _ndjson_records(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None  # Left for the caller to report as an invalid row
+
+
+# Records of a bulk request: a JSON array, or one JSON object per line when sent as NDJSON.
+# NDJSON bodies are read as they are consumed instead of being parsed up front.
+# Raises ValueError when the body is neither.
+def request_records():
+    if request.mimetype == NDJSON_MIMETYPE:
+        return _ndjson_records(request.stream)
+    records = request.get_json(silent=True)
+    if not isinstance(records, list):
+        raise ValueError("a JSON array or NDJSON body is required")
+    return iter(records)
+
+
+# (index, record) pairs from records, BULK_CHUNK_SIZE at a time
+def record_chunks(records, chunk_size=BULK_CHUNK_SIZE):
+    chunk = []
+    for index, record in enumerate(records):
+        chunk.append((index, record))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
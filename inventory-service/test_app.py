@@ -0,0 +1,59 @@
+import unittest
+from unittest.mock import patch
+
+import mysql.connector
+
+import app as inventory_app
+import streaming
+from fake_db import FakeConnection, FakeCursor
+
+
+@patch('app.changes.record')
+@patch('app.catalogue.bump')
+@patch('app.stock.set_buckets')
+class TestAddItemsBulk(unittest.TestCase):
+    def setUp(self):
+        self.client = inventory_app.app.test_client()
+        self.conn = FakeConnection(FakeCursor(self.respond, lastrowid=7))
+        get_db_connection = patch('app.get_db_connection', return_value=self.conn)
+        get_db_connection.start()
+        self.addCleanup(get_db_connection.stop)
+
+    def respond(self, query, params):
+        return [(1,)] if query.startswith("SELECT @@auto_increment_increment") else []
+
+    def test_each_row_gets_its_own_result(self, set_buckets, bump, record):
+        response = self.client.post('/items/bulk', json=[
+            {'name': 'a', 'quantity': 5, 'price': '2.499'},
+            {'name': 'b', 'quantity': -1, 'price': 1},
+            {'name': 'c', 'quantity': 100, 'price': 3, 'buckets': 4},
+            {'name': 'd', 'quantity': 1, 'price': 1, 'buckets': 0},
+        ])
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()['results']
+        self.assertEqual([result['status'] for result in results], [201, 400, 201, 400])
+        self.assertEqual((results[0]['item']['id'], results[0]['item']['price']), (7, '2.50'))
+        self.assertEqual(results[2]['item']['id'], 8)
+        set_buckets.assert_called_once_with(self.conn.fake_cursor, 8, 4)
+        record.assert_called_once_with(self.conn.fake_cursor, [7, 8])
+        bump.assert_called_once_with(self.conn.fake_cursor)
+        self.assertEqual(self.conn.events, ["commit", "close"])
+
+    def test_a_failed_chunk_reports_the_committed_ones(self, set_buckets, bump, record):
+        def executemany(query, seq_params):
+            if len(self.conn.events) == 1:
+                raise mysql.connector.OperationalError("lost connection")
+            self.conn.fake_cursor.rowcount = len(seq_params)
+
+        self.conn.fake_cursor.executemany = executemany
+        with patch('app.record_chunks', lambda records: streaming.record_chunks(records, 1)), \
+                self.assertLogs('app', level='ERROR'):
+            response = self.client.post('/items/bulk', json=[{'name': name, 'quantity': 1, 'price': 1} for name in 'ab'])
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.get_json()['created'], 1)
+        self.assertEqual(self.conn.events, ["commit", "rollback", "close"])
+        self.assertEqual(bump.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
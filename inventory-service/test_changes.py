@@ -0,0 +1,73 @@
+import unittest
+from unittest.mock import patch
+
+import changes
+from fake_db import FakeConnection, FakeCursor
+
+
+def log(first_seq, last_seq, rows):
+    """A cursor over a change log spanning first_seq..last_seq whose entries after `since` are rows."""
+    def respond(query, params):
+        if query.startswith("SELECT MIN(seq), MAX(seq)"):
+            return [(first_seq, last_seq)]
+        return rows
+    return FakeCursor(respond)
+
+
+class TestRead(unittest.TestCase):
+    def test_returns_each_changed_item_once_in_order_of_its_last_change(self):
+        cursor = log(1, 4, [(2, 7, False), (3, 8, False), (4, 7, False)])
+        self.assertEqual(changes.read(cursor, 1), ([8, 7], 4, False, False))
+
+    def test_stops_before_a_recent_gap(self):
+        cursor = log(1, 5, [(2, 7, False), (4, 8, True), (5, 9, True)])
+        self.assertEqual(changes.read(cursor, 1), ([7], 2, False, True))
+
+    def test_skips_a_gap_older_than_the_settle_window(self):
+        cursor = log(1, 4, [(2, 7, False), (4, 8, False)])
+        self.assertEqual(changes.read(cursor, 1), ([7, 8], 4, False, False))
+
+    def test_resets_a_subscriber_behind_the_compacted_log(self):
+        cursor = log(10, 11, [(10, 7, False), (11, 8, False)])
+        self.assertEqual(changes.read(cursor, 3), ([7, 8], 11, True, False))
+        self.assertEqual(cursor.executed("SELECT seq, item_id")[0][1], 9)
+
+    def test_empty_log(self):
+        self.assertEqual(changes.read(log(None, None, []), 0), ([], 0, False, False))
+
+
+class TestRecord(unittest.TestCase):
+    def test_logs_each_item_once_in_id_order(self):
+        cursor = FakeCursor()
+        with patch('changes.random.random', return_value=1):
+            changes.record(cursor, [9, 2, 9])
+        self.assertEqual(cursor.executed("INSERT INTO item_changes"), [(2,), (9,)])
+
+    def test_nothing_to_log(self):
+        cursor = FakeCursor()
+        changes.record(cursor, [])
+        self.assertEqual(cursor.statements, [])
+
+
+@patch('changes.ITEM_CHANGES_POLL_INTERVAL', 0)
+class TestPoll(unittest.TestCase):
+    def test_waits_for_the_next_change_in_a_fresh_snapshot(self):
+        reads = [[], [], [(5, 7, False)]]
+
+        def respond(query, params):
+            if query.startswith("SELECT MIN(seq), MAX(seq)"):
+                return [(1, 4 if len(reads) > 1 else 5)]
+            return reads.pop(0)
+
+        conn = FakeConnection(FakeCursor(respond))
+        self.assertEqual(changes.poll(conn, conn.fake_cursor, 4, wait=5), ([7], 5, False, False))
+        self.assertEqual(conn.events, ["rollback"] * 3)
+
+    def test_answers_at_once_without_wait(self):
+        conn = FakeConnection(log(1, 4, []))
+        self.assertEqual(changes.poll(conn, conn.fake_cursor, 4), ([], 4, False, False))
+        self.assertEqual(conn.events, ["rollback"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import json
+import unittest
+from unittest.mock import patch
+
+import mysql.connector
+from mysql.connector import errorcode
+
+import stock
+from fake_db import FakeCursor
+
+
+@patch('stock.changes.record')
+@patch('stock.catalogue.bump')
+class TestReserveBatch(unittest.TestCase):
+    def test_locks_each_item_once_in_id_order_and_writes_it_once(self, bump, record):
+        quantities = {1: 5, 2: 20}
+
+        def respond(query, params):
+            if query.startswith("SELECT quantity FROM items"):
+                return [(quantities[params[0]],)] if params[0] in quantities else []
+            return []
+
+        cursor = FakeCursor(respond)
+        results = stock.reserve_batch(cursor, [
+            {'items': [{'item_id': 2, 'quantity': 5}, {'item_id': 1, 'quantity': 3}]},
+            {'items': [{'item_id': 1, 'quantity': 3}]},
+            {'items': [{'item_id': 2, 'quantity': 15}, {'item_id': 1, 'quantity': 2}]},
+            {'items': [{'item_id': 9, 'quantity': 1}]},
+        ])
+
+        self.assertEqual([result['status'] for result in results], [201, 400, 201, 404])
+        self.assertEqual(cursor.executed("SELECT quantity FROM items"), [(1,), (2,), (9,)])
+        self.assertEqual(cursor.executed("UPDATE items"), [(0, 1), (0, 2)])
+        record.assert_called_once_with(cursor, [1, 2])
+
+
+@patch('stock.changes.record')
+@patch('stock.catalogue.bump')
+class TestRelease(unittest.TestCase):
+    def test_line_without_bucket_goes_back_to_the_items_row(self, bump, record):
+        cursor = FakeCursor()
+        stock.release(cursor, [{'item_id': 3, 'quantity': 2}])
+        self.assertEqual(cursor.statements, [("UPDATE items SET quantity = quantity + %s WHERE id = %s", (2, 3))])
+
+
+@patch('stock.changes.record')
+@patch('stock.catalogue.bump')
+class TestReservationKeys(unittest.TestCase):
+    def test_a_retried_key_gets_the_stored_reservation(self, bump, record):
+        stored = [{'item_id': 1, 'bucket': None, 'quantity': 2}]
+
+        def respond(query, params):
+            if query.startswith("INSERT INTO stock_reservations"):
+                raise mysql.connector.IntegrityError(errno=errorcode.ER_DUP_ENTRY)
+            if query.startswith("SELECT reservation, released"):
+                return [(json.dumps(stored), False)]
+            return []
+
+        cursor = FakeCursor(respond)
+        self.assertEqual(stock.reserve(cursor, [{'item_id': 1, 'quantity': 2}], key='k'), stored)
+        self.assertEqual(cursor.executed("UPDATE items"), [])
+
+    def test_a_key_released_first_refuses_its_reservation(self, bump, record):
+        def respond(query, params):
+            if query.startswith("INSERT INTO stock_reservations"):
+                raise mysql.connector.IntegrityError(errno=errorcode.ER_DUP_ENTRY)
+            return [(None, True)] if query.startswith("SELECT reservation, released") else []
+
+        with self.assertRaises(stock.StockError) as raised:
+            stock.reserve(FakeCursor(respond), [{'item_id': 1, 'quantity': 2}], key='k')
+        self.assertEqual(raised.exception.status, 409)
+
+    def test_releasing_an_unknown_key_leaves_a_tombstone(self, bump, record):
+        cursor = FakeCursor()
+        self.assertFalse(stock.release_key(cursor, 'k'))
+        self.assertEqual(cursor.executed("INSERT INTO stock_reservations"), [('k', True)])
+        self.assertEqual(cursor.executed("UPDATE items"), [])
+
+
+class TestSplit(unittest.TestCase):
+    def test_spreads_the_remainder_over_the_first_buckets(self):
+        self.assertEqual(stock.split(10, 4), [3, 3, 2, 2])
+        self.assertEqual(stock.split(2, 4), [1, 1, 0, 0])
+        self.assertEqual(sum(stock.split(1001, 7)), 1001)
+
+
+if __name__ == '__main__':
+    unittest.main()
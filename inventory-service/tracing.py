@@ -0,0 +1,181 @@
+import os
+import threading
+from collections import OrderedDict
+
+from opentelemetry import trace
+from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, SpanProcessor, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.trace.sampling import ALWAYS_OFF, Decision, Sampler, SamplingResult, TraceIdRatioBased
+from opentelemetry.trace import SpanContext, TraceFlags, get_current_span
+from opentelemetry.trace.status import StatusCode
+from prometheus_client import Counter
+
+import instrumentation
+
+# How spans are handled:
+#   "export"  records every span, for the latency histograms, and exports the sampled traces
+#   "metrics" records every span for the latency histograms and exports nothing
+#   "off"     records nothing, so the stage and upstream histograms stay empty; trace
+#             context is still passed on, marked unsampled
+TRACE_MODES = ("export", "metrics", "off")
+TRACE_MODE = os.environ.get("TRACE_MODE", "export")
+TRACE_SAMPLE_RATIO = float(os.environ.get("TRACE_SAMPLE_RATIO", "1"))  # Share of new traces exported
+# Unsampled traces are held in memory until their root span ends, and exported after all
+# if they had an error or took TRACE_SLOW_THRESHOLD seconds or longer (0 disables that)
+TRACE_KEEP_ERRORS = os.environ.get("TRACE_KEEP_ERRORS", "true").lower() == "true"
+TRACE_SLOW_THRESHOLD = float(os.environ.get("TRACE_SLOW_THRESHOLD", "1"))
+TRACE_TAIL_MAX_TRACES = int(os.environ.get("TRACE_TAIL_MAX_TRACES", "1000"))  # Unfinished traces held per process
+TRACE_TAIL_MAX_SPANS = int(os.environ.get("TRACE_TAIL_MAX_SPANS", "256"))  # Spans held per trace
+TRACE_EXPORT_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT",
+                                       "http://simplest-jaeger-collector.observability.svc.cluster.local:4318/v1/traces")
+TRACE_EXPORT_QUEUE_SIZE = int(os.environ.get("TRACE_EXPORT_QUEUE_SIZE", "2048"))  # Spans beyond this are dropped
+TRACE_EXPORT_BATCH_SIZE = int(os.environ.get("TRACE_EXPORT_BATCH_SIZE", "512"))
+TRACE_EXPORT_DELAY_MS = int(os.environ.get("TRACE_EXPORT_DELAY_MS", "5000"))  # Longest wait before a partial batch is sent
+TRACE_EXPORT_TIMEOUT_MS = int(os.environ.get("TRACE_EXPORT_TIMEOUT_MS", "30000"))
+
+
+class RecordingSampler(Sampler):
+    """Parent-based ratio sampler that still records the spans it does not sample.
+
+    New traces are sampled by trace id, so every service running the same ratio
+    keeps the same traces; traces from upstream follow the caller's decision.
+    Unsampled spans are recorded rather than dropped, so the latency histograms
+    see every request and the tail sampler can keep errors and slow requests.
+    """
+
+    def __init__(self, ratio):
+        self._root = TraceIdRatioBased(ratio)
+
+    def should_sample(self, parent_context, trace_id, name, kind=None, attributes=None, links=None, trace_state=None):
+        parent = get_current_span(parent_context).get_span_context()
+        if parent.is_valid:
+            sampled = parent.trace_flags.sampled
+        else:
+            sampled = self._root.should_sample(parent_context, trace_id, name).decision == Decision.RECORD_AND_SAMPLE
+        return SamplingResult(Decision.RECORD_AND_SAMPLE if sampled else Decision.RECORD_ONLY, attributes,
+                              parent.trace_state if parent.is_valid else None)
+
+    def get_description(self):
+        return f"RecordingSampler{{{self._root.get_description()}}}"
+
+
+# A copy of an unsampled span, marked sampled so the exporting processor takes it
+def _as_sampled(span):
+    context = span.context
+    return ReadableSpan(
+        name=span.name,
+        context=SpanContext(context.trace_id, context.span_id, context.is_remote,
+                            TraceFlags(TraceFlags.SAMPLED), context.trace_state),
+        parent=span.parent,
+        resource=span.resource,
+        attributes=span.attributes,
+        events=span.events,
+        links=span.links,
+        kind=span.kind,
+        status=span.status,
+        start_time=span.start_time,
+        end_time=span.end_time,
+        instrumentation_scope=span.instrumentation_scope,
+    )
+
+
+class TailSamplingProcessor(SpanProcessor):
+    """Hands sampled spans straight to `processor` and holds unsampled ones until
+    their trace's local root span ends, then hands the whole trace over only if a
+    span failed or the root was slow.
+
+    Decisions are per process: a kept trace holds this service's spans, plus
+    whatever the other services sampled or kept of it. The oldest traces are
+    dropped once TRACE_TAIL_MAX_TRACES are waiting.
+    """
+
+    def __init__(self, processor, keep_errors=TRACE_KEEP_ERRORS, slow_threshold=TRACE_SLOW_THRESHOLD,
+                 max_traces=TRACE_TAIL_MAX_TRACES, max_spans=TRACE_TAIL_MAX_SPANS):
+        self.processor = processor
+        self.keep_errors = keep_errors
+        self.slow_threshold = slow_threshold
+        self.max_traces = max_traces
+        self.max_spans = max_spans
+        self._traces = OrderedDict()  # trace id -> [failed, spans]
+        self._lock = threading.Lock()
+
+    def on_end(self, span):
+        if span.context.trace_flags.sampled:
+            self.processor.on_end(span)
+            return
+        failed = self.keep_errors and span.status.status_code == StatusCode.ERROR
+        trace_id = span.context.trace_id
+        with self._lock:
+            if span.parent is not None and not span.parent.is_remote:
+                pending = self._traces.get(trace_id)
+                if pending is None:
+                    if len(self._traces) >= self.max_traces:
+                        self._traces.popitem(last=False)
+                        _decided('evicted')
+                    pending = self._traces[trace_id] = [False, []]
+                pending[0] = pending[0] or failed
+                if len(pending[1]) < self.max_spans:
+                    pending[1].append(span)
+                return
+            failed_before, spans = self._traces.pop(trace_id, (False, []))
+        slow = self.slow_threshold > 0 and (span.end_time - span.start_time) / 1e9 >= self.slow_threshold
+        if not (failed or failed_before or slow):
+            _decided('dropped')
+            return
+        _decided('kept')
+        for kept in spans + [span]:
+            self.processor.on_end(_as_sampled(kept))
+
+    def shutdown(self):
+        self.processor.shutdown()
+
+    def force_flush(self, timeout_millis=30000):
+        return self.processor.force_flush(timeout_millis)
+
+
+def build_provider(service_name, mode=TRACE_MODE, ratio=TRACE_SAMPLE_RATIO):
+    sampler = ALWAYS_OFF if mode == "off" else RecordingSampler(ratio if mode == "export" else 0)
+    provider = TracerProvider(resource=Resource.create(attributes={"service.name": service_name}), sampler=sampler)
+    # Per-stage and per-upstream latency histograms, recorded from finished spans
+    provider.add_span_processor(instrumentation.LatencyMetricsProcessor())
+    return provider
+
+
+# The processor that exports sampled traces, behind a tail sampler when only some are sampled
+def export_processor(exporter, ratio=TRACE_SAMPLE_RATIO):
+    processor = BatchSpanProcessor(exporter, max_queue_size=TRACE_EXPORT_QUEUE_SIZE,
+                                   schedule_delay_millis=TRACE_EXPORT_DELAY_MS,
+                                   max_export_batch_size=TRACE_EXPORT_BATCH_SIZE,
+                                   export_timeout_millis=TRACE_EXPORT_TIMEOUT_MS)
+    if ratio < 1 and (TRACE_KEEP_ERRORS or TRACE_SLOW_THRESHOLD > 0):
+        processor = TailSamplingProcessor(processor)
+    return processor
+
+
+# Set the global tracer provider; run at import, before the instrumentors
+def configure(service_name):
+    trace.set_tracer_provider(build_provider(service_name))
+
+
+# Start exporting; run per process, since the exporter's background thread does not survive a fork
+def start_export():
+    if TRACE_MODE != "export":
+        return
+    trace.get_tracer_provider().add_span_processor(export_processor(OTLPSpanExporter(endpoint=TRACE_EXPORT_ENDPOINT)))
+
+
+# Tail sampling metrics, registered on the service's metrics registry by bind_metrics()
+_decisions_counter = None
+
+
+def _decided(decision):
+    if _decisions_counter is not None:
+        _decisions_counter.labels(decision=decision).inc()
+
+
+def bind_metrics(registry):
+    global _decisions_counter
+    _decisions_counter = Counter('trace_tail_decisions', 'Unsampled traces kept (failed or slow), dropped, '
+                                 'or evicted unfinished by the tail sampler', ['decision'], registry=registry)
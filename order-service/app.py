@@ -1,93 +1,218 @@
+import logging
 import os
+import time
+import uuid
 import mysql.connector
+from mysql.connector import errorcode
 from flask import Flask, request, jsonify
 import requests
 from prometheus_flask_exporter import PrometheusMetrics
 
+import db
+import instrumentation
+import idempotency
+import logs
+import order_queue
+import summaries
+import tracing
+import upstream
+import user_assertion
+from db import get_db_connection, get_read_connection
+import user_cache
+from user_cache import UserCache
+from streaming import STREAM_CHUNK_SIZE, stream_records, wants_stream
+
 # Import OpenTelemetry modules
 from opentelemetry import trace
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.flask import FlaskInstrumentor
 from opentelemetry.instrumentation.requests import RequestsInstrumentor
 
 app = Flask(__name__)
 metrics = PrometheusMetrics(app)
+db.bind_metrics(metrics.registry)
+instrumentation.bind_metrics(metrics.registry)
+tracing.bind_metrics(metrics.registry)
+logs.bind_metrics(metrics.registry)
+upstream.bind_metrics(metrics.registry)
+user_cache.bind_metrics(metrics.registry)
+order_queue.bind_metrics(metrics.registry)
 
-# Configure tracing
-resource = Resource.create(attributes={"service.name": "order-service"})  
-trace.set_tracer_provider(TracerProvider(resource=resource))
-
-# Configure Jaeger exporter
-jaeger_exporter = OTLPSpanExporter(
-    endpoint="http://simplest-jaeger-collector.observability.svc.cluster.local:4318/v1/traces",  
-)
+# Configure tracing: sampling, export and the per-stage and per-upstream latency histograms (see tracing.py)
+tracing.configure("order-service")
 
-trace.get_tracer_provider().add_span_processor(
-    BatchSpanProcessor(jaeger_exporter)
-)
+# JSON log lines with trace and span ids (see logs.py)
+logs.configure("order-service")
 
 # Auto-instrument Flask and requests
 FlaskInstrumentor().instrument_app(app)
+logs.instrument_flask(app)
+# Consistency tokens for reads from replicas (see db.py)
+db.instrument_flask(app)
 RequestsInstrumentor().instrument()
 
 tracer = trace.get_tracer(__name__)
-
-# Database configuration from environment variables
-DB_HOST = os.environ.get("DB_HOST")
-DB_PORT = os.environ.get("DB_PORT", "3306")
-DB_NAME = os.environ.get("DB_NAME")
-DB_USER = os.environ.get("DB_USER")
-DB_PASSWORD = os.environ.get("DB_PASSWORD")
-
-USER_SERVICE_URL = "http://user-app.flask-app.svc.cluster.local:80"
-INVENTORY_SERVICE_URL = "http://inventory-app.flask-app.svc.cluster.local:80"
-
-def get_db_connection():
+logger = logging.getLogger(__name__)
+
+USER_SERVICE_URL = os.environ.get("USER_SERVICE_URL", "http://user-app.flask-app.svc.cluster.local:80")
+INVENTORY_SERVICE_URL = os.environ.get("INVENTORY_SERVICE_URL", "http://inventory-app.flask-app.svc.cluster.local:80")
+
+# Upstream clients with timeouts, a bulkhead and a circuit breaker each
+user_service = upstream.Upstream("user-service", USER_SERVICE_URL, "USER_SERVICE")
+inventory_service = upstream.Upstream("inventory-service", INVENTORY_SERVICE_URL, "INVENTORY_SERVICE")
+
+def fetch_user_status(user_id):
+    return user_service.get(f"/users/{user_id}").status_code
+
+def fetch_user_invalidations(since):
+    params = {'since': since} if since is not None else {}
+    response = user_service.get("/users/invalidations", params=params)
+    response.raise_for_status()
+    data = response.json()
+    return data['user_ids'], data['last_seq'], data['reset']
+
+# Read-through cache of user existence checks, kept fresh by user-service's invalidation feed
+verified_users = UserCache(fetch_user_status, fetch_user_invalidations)
+
+# How create_order checks users the gateway has not vouched for: ask user-service, or rely on
+# the orders.user_id foreign key, which rejects unknown users inside the order transaction
+USER_CHECK_MODES = ("user-service", "foreign-key")
+ORDER_USER_CHECK = os.environ.get("ORDER_USER_CHECK", "user-service")
+if ORDER_USER_CHECK not in USER_CHECK_MODES:
+    raise ValueError(f"ORDER_USER_CHECK must be one of {', '.join(USER_CHECK_MODES)}, not {ORDER_USER_CHECK!r}")
+
+# Stock is reserved through inventory-service, which spreads hot items over several stock rows.
+# The key lets the reservation be released even when its response never arrives.
+def reserve_stock(items, reservation_key):
+    return inventory_service.post("/reservations", json={'items': items, 'reservation_key': reservation_key})
+
+def reserve_stock_batch(orders, reservation_key):
+    return inventory_service.post("/reservations/batch", json={'orders': orders, 'reservation_key': reservation_key})
+
+# Hand reserved stock back when the orders it was taken for could not be stored, given the
+# reservation's lines or the key it was made with. Failures are logged, never raised, since
+# callers are already on an error path or have committed their orders.
+def release_stock(reservation=None, reservation_key=None):
+    body = {'reservation_key': reservation_key} if reservation_key is not None else {'reservation': reservation}
     try:
-        return mysql.connector.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-    except mysql.connector.Error as error:
-        print("Error connecting to database:", error)
-        return None
-
-def create_tables():
+        response = inventory_service.post("/reservations/release", json=body)
+        if response.status_code != 200:
+            logger.error("Error releasing stock: %s %s", response.status_code, response.text)
+    except requests.exceptions.RequestException as error:
+        logger.error("Error releasing stock: %s", error)
+
+# Per-process setup. gunicorn runs this in each worker after fork (see gunicorn.conf.py),
+# since the span exporter's background thread and DB connections do not survive a fork.
+def init_worker():
+    # Export sampled traces (TRACE_MODE, OTEL_EXPORTER_OTLP_TRACES_ENDPOINT)
+    tracing.start_export()
+    # Write logs from a background thread
+    logs.start()
+    # Drain the asynchronous order intake queue
+    order_queue.start_workers(process_queued_order)
+
+# Claim the Idempotency-Key for this attempt before it touches inventory. Returns (claim token,
+# None) when the attempt is to run, or (None, response) for a duplicate: the response of the
+# attempt that finished under the key, or a 409 if the one in flight outlasts IDEMPOTENCY_WAIT.
+# Duplicates poll on fresh connections, so none is held while they wait.
+def claim_order_key(idempotency_key, data):
+    with tracer.start_as_current_span("claim_idempotency_key"):
+        deadline = time.monotonic() + idempotency.IDEMPOTENCY_WAIT
+        while True:
+            conn = get_db_connection()
+            if conn is None:
+                return None, (jsonify({'message': 'Database connection failed'}), 500)
+            try:
+                token, stored = idempotency.claim(conn, idempotency_key, data)
+                idempotency.prune(conn)
+            except mysql.connector.Error as error:
+                logger.error("Error claiming idempotency key: %s", error)
+                return None, (jsonify({'message': 'Failed to create order'}), 500)
+            finally:
+                conn.close()
+            if token is not None:
+                return token, None
+            # No row means its attempt gave the key up just now, so try to claim it again
+            if stored is not None and (not idempotency.is_pending(stored) or time.monotonic() >= deadline
+                                       or stored[0] != idempotency.fingerprint(data)):
+                return None, idempotency.replay(stored, data)
+            time.sleep(idempotency.IDEMPOTENCY_POLL_INTERVAL)
+
+# Give up a claimed key after an attempt that stored no order. Failing here only delays
+# retries until the claim's lease runs out, so errors are logged, not raised.
+def release_order_key(idempotency_key, claim_token):
+    conn = get_db_connection()
+    if conn is None:
+        logger.error("Error releasing idempotency key: database connection failed")
+        return
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                user_id INT NOT NULL,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS order_items (
-                order_id INT NOT NULL,
-                item_id INT NOT NULL,
-                quantity INT NOT NULL,
-                FOREIGN KEY (order_id) REFERENCES orders(id),
-                FOREIGN KEY (item_id) REFERENCES items(id),
-                PRIMARY KEY (order_id, item_id)
-            )
-        ''')
-        conn.commit()
-        cursor.close()
+        idempotency.release(conn, idempotency_key, claim_token)
     except mysql.connector.Error as error:
-        print("Error creating tables:", error)
+        logger.error("Error releasing idempotency key: %s", error)
     finally:
-        if conn and conn.is_connected():
+        conn.close()
+
+# Set in the environ of requests that queue workers run through create_order
+QUEUED_REQUEST_ENVIRON = 'order_queue.request_id'
+
+def order_request_accepted(request_id):
+    status_url = f"/orders/requests/{request_id}"
+    response = jsonify({'message': 'Order accepted', 'request': {'id': request_id, 'status': order_queue.QUEUED},
+                        'status_url': status_url})
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
+
+# Store an order request for the queue workers; the client follows it at the status URL
+def enqueue_order(data, idempotency_key, user_verified):
+    with tracer.start_as_current_span("enqueue_order"):
+        error = validate_batch_order(data)
+        if error:
+            return jsonify({'message': error}), 400
+        conn = get_db_connection()
+        if conn is None:
+            return jsonify({'message': 'Database connection failed'}), 500
+        cursor = conn.cursor()
+        try:
+            try:
+                request_id = order_queue.enqueue(cursor, data, idempotency_key or order_queue.new_idempotency_key(),
+                                                 user_verified)
+            except mysql.connector.IntegrityError as error:
+                if not idempotency.is_duplicate_key(error):
+                    raise
+                # A retry of a request already queued under this Idempotency-Key
+                conn.rollback()
+                queued = order_queue.find_by_key(cursor, idempotency_key)
+                if queued is None:
+                    # Pruned between the colliding insert and this lookup; a retry queues it afresh
+                    response = jsonify({'message': 'The request under this Idempotency-Key was just removed, retry it'})
+                    response.headers['Retry-After'] = '1'
+                    return response, 409
+                request_id, queued_data = queued
+                if queued_data != data:
+                    return jsonify({'message': 'Idempotency-Key was already used with a different request'}), 422
+            conn.commit()
+            return order_request_accepted(request_id)
+        except mysql.connector.Error as error:
+            logger.error("Error queueing order: %s", error)
+            conn.rollback()
+            return jsonify({'message': 'Failed to queue order'}), 500
+        finally:
+            cursor.close()
             conn.close()
 
-create_tables()
+# Run a queued order request through create_order, as though it had just arrived
+def process_queued_order(entry):
+    with tracer.start_as_current_span("process_queued_order"):
+        headers = {'Idempotency-Key': entry.idempotency_key}
+        if entry.user_verified:
+            # The gateway's assertion has expired by now, so vouch for the user again
+            assertion = user_assertion.issue(entry.data['user_id'])
+            if assertion is not None:
+                headers[user_assertion.USER_ASSERTION_HEADER] = assertion
+        with app.test_request_context('/orders', method='POST', json=entry.data, headers=headers,
+                                      environ_overrides={QUEUED_REQUEST_ENVIRON: entry.id}):
+            response = app.make_response(create_order())
+        return response.status_code, response.get_data(as_text=True)
 
 @app.route('/orders', methods=['POST'])
 def create_order():
@@ -97,107 +222,424 @@ def create_order():
             return jsonify({'message': 'Bad Request: user_id and items are required'}), 400
 
         user_id = data['user_id']
-        items_to_order = data['items']
-
-        conn = get_db_connection()
-        if conn is None:
-            return jsonify({'message': 'Database connection failed'}), 500
-
-        cursor = conn.cursor()
 
-        # Verify User
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is not None and not idempotency.is_valid_key(idempotency_key):
+            return jsonify({'message': 'Bad Request: invalid Idempotency-Key'}), 400
+        trusted = user_assertion.verify(request.headers.get(user_assertion.USER_ASSERTION_HEADER), user_id)
+
+        # Queue the order and answer 202 straight away, unless this is a queue worker running it
+        if QUEUED_REQUEST_ENVIRON not in request.environ and order_queue.wants_async(request.headers.get('Prefer')):
+            return enqueue_order(data, idempotency_key, trusted)
+
+        # The Idempotency-Key is claimed before anything else, so a concurrent duplicate waits for
+        # this attempt and replays its response instead of reserving stock of its own. Retries
+        # that carry the key get the first attempt's response.
+        claim_token = None
+        if idempotency_key is not None:
+            claim_token, duplicate = claim_order_key(idempotency_key, data)
+            if duplicate is not None:
+                return duplicate
+        response = app.make_response(place_order(data, trusted, idempotency_key, claim_token))
+        if claim_token is not None and response.status_code != 201:
+            release_order_key(idempotency_key, claim_token)
+        return response
+
+# Verify the user, reserve the stock and store the order, once create_order has claimed its key
+def place_order(data, trusted, idempotency_key, claim_token):
+    user_id = data['user_id']
+    items_to_order = data['items']
+
+    # Verify User, unless the gateway has just done so and signed for it
+    if not trusted and ORDER_USER_CHECK == "user-service":
         try:
             with tracer.start_as_current_span("verify_user"):
-                user_response = requests.get(f"{USER_SERVICE_URL}/users/{user_id}")
-                if user_response.status_code != 200:
+                if verified_users.status(user_id) != 200:
                     return jsonify({'message': 'User not found'}), 404
-        except requests.exceptions.ConnectionError:
+        except upstream.UNAVAILABLE:
             return jsonify({'message': 'User service unavailable'}), 503
 
-        # Check and Update Inventory (with Database Transactions)
-        try:
-            conn.start_transaction()  # Start a transaction
-
-            for item in items_to_order:
-                item_id = item['item_id']
-                quantity = item['quantity']
-
-                # Check Inventory
-                with tracer.start_as_current_span("check_inventory"):
-                    cursor.execute("SELECT quantity FROM items WHERE id = %s FOR UPDATE", (item_id,))
-                    result = cursor.fetchone()
-
-                    if result is None:
-                        conn.rollback()  # Rollback if item not found
-                        return jsonify({'message': f'Item {item_id} not found'}), 404
-
-                    available_quantity = result[0]
-                    if available_quantity < quantity:
-                        conn.rollback()  # Rollback if insufficient quantity
-                        return jsonify({'message': f'Insufficient quantity for item {item_id}'}), 400
+    # Reserve Inventory before the order transaction starts, so no connection or row lock is
+    # held while inventory-service works. Every way out short of the commit below gives the
+    # reservation back by its key, including a lost response after inventory-service took it.
+    reservation_key = uuid.uuid4().hex
+    try:
+        with tracer.start_as_current_span("reserve_inventory"):
+            reservation_response = reserve_stock(items_to_order, reservation_key)
+    except upstream.UpstreamUnavailable:
+        return jsonify({'message': 'Inventory service unavailable'}), 503  # Turned away before it was sent
+    except upstream.UNAVAILABLE:
+        release_stock(reservation_key=reservation_key)
+        return jsonify({'message': 'Inventory service unavailable'}), 503
+    if reservation_response.status_code in (400, 404):
+        return jsonify(reservation_response.json()), reservation_response.status_code  # An item is missing or short
+    if reservation_response.status_code != 201:
+        logger.error("Error reserving stock: %s %s", reservation_response.status_code, reservation_response.text)
+        release_stock(reservation_key=reservation_key)
+        return jsonify({'message': 'Failed to create order'}), 500
+
+    conn = get_db_connection()
+    if conn is None:
+        release_stock(reservation_key=reservation_key)
+        return jsonify({'message': 'Database connection failed'}), 500
+
+    cursor = conn.cursor()
+    committed = False
+
+    # Store the order (with Database Transactions)
+    try:
+        conn.start_transaction()  # Start a transaction
 
-                # Update Inventory
-                with tracer.start_as_current_span("update_inventory"):
-                    new_quantity = available_quantity - quantity
-                    cursor.execute("UPDATE items SET quantity = %s WHERE id = %s", (new_quantity, item_id))
+        # Locking the key's row first makes a takeover of a claim that outlived its lease
+        # wait for this attempt, which stops here if its claim was taken over already
+        if idempotency_key is not None and not idempotency.hold(cursor, idempotency_key, claim_token):
+            conn.rollback()
+            return jsonify({'message': 'A request with this Idempotency-Key is still in progress'}), 409
 
-            # Create Order
-            with tracer.start_as_current_span("insert_order"):
+        # Create Order. The foreign key turns away unknown users the check above did not.
+        with tracer.start_as_current_span("insert_order"):
+            try:
                 cursor.execute("INSERT INTO orders (user_id) VALUES (%s)", (user_id,))
-                order_id = cursor.lastrowid
-
-            # Add Order Items
-            with tracer.start_as_current_span("insert_order_items"):
-                for item in items_to_order:
-                    cursor.execute("INSERT INTO order_items (order_id, item_id, quantity) VALUES (%s, %s, %s)",
-                                   (order_id, item['item_id'], item['quantity']))
+            except mysql.connector.IntegrityError as error:
+                if error.errno != errorcode.ER_NO_REFERENCED_ROW_2:
+                    raise
+                conn.rollback()
+                return jsonify({'message': 'User not found'}), 404
+            order_id = cursor.lastrowid
+
+        # Prices are captured with the order, so later price changes do not rewrite its total
+        with tracer.start_as_current_span("capture_prices"):
+            unit_prices = summaries.prices(cursor, [item['item_id'] for item in items_to_order])
+            if len(unit_prices) < len({item['item_id'] for item in items_to_order}):
+                conn.rollback()  # An item was deleted after its stock was reserved
+                return jsonify({'message': 'Item not found'}), 404
+            item_count, total = summaries.summarise(items_to_order, unit_prices)
+
+        # Add Order Items
+        with tracer.start_as_current_span("insert_order_items"):
+            cursor.executemany("INSERT INTO order_items (order_id, item_id, quantity, unit_price) VALUES (%s, %s, %s, %s)",
+                               [(order_id, item['item_id'], item['quantity'], unit_prices[item['item_id']])
+                                for item in items_to_order])
+            summaries.record(cursor, [(order_id, user_id, item_count, total)])
+
+        # Construct the order object for the response
+        order_data = {
+            'id': order_id,
+            'user_id': user_id,
+            'items': items_to_order,
+            'item_count': item_count,
+            'total': total
+        }
+        response_data = {'message': 'Order created successfully', 'order': order_data}
+
+        if idempotency_key is not None:
+            # Stored in the same transaction, so duplicates see the response exactly when the order is stored
+            idempotency.record(cursor, idempotency_key, 201, response_data)
+
+        conn.commit()  # Commit the transaction
+        committed = True
+        logger.debug("Order created: %s", response_data)
+        return jsonify(response_data), 201
 
-            conn.commit()  # Commit the transaction
-            print("Transaction Committed")
-            # Construct the order object for the response
+    except mysql.connector.Error as error:
+        logger.error("Error during transaction: %s", error)
+        conn.rollback()  # Rollback on any database error
+        return jsonify({'message': 'Failed to create order'}), 500
+    finally:
+        cursor.close()
+        conn.close()
+        if not committed:
+            release_stock(reservation_key=reservation_key)
+
+ORDERS_BATCH_MAX = int(os.environ.get("ORDERS_BATCH_MAX", "1000"))
+
+def is_positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+# Check the shape of one order in a batch, returning an error message or None
+def validate_batch_order(order):
+    if not isinstance(order, dict) or not isinstance(order.get('items'), list) or not order['items']:
+        return 'Bad Request: user_id and items are required'
+    if not is_positive_int(order.get('user_id')):
+        return 'Bad Request: user_id must be a positive integer'
+    seen = set()
+    for item in order['items']:
+        if not isinstance(item, dict) or not is_positive_int(item.get('item_id')) or not is_positive_int(item.get('quantity')):
+            return 'Bad Request: each item needs a positive item_id and quantity'
+        if item['item_id'] in seen:
+            return f"Bad Request: item {item['item_id']} is listed more than once"
+        seen.add(item['item_id'])
+    return None
+
+@app.route('/orders/batch', methods=['POST'])
+def create_orders_batch():
+    with tracer.start_as_current_span("create_orders_batch"):
+        data = request.json
+        if not data or not isinstance(data.get('orders'), list) or not data['orders']:
+            return jsonify({'message': 'Bad Request: a non-empty orders list is required'}), 400
+        orders = data['orders']
+        if len(orders) > ORDERS_BATCH_MAX:
+            return jsonify({'message': f'Bad Request: at most {ORDERS_BATCH_MAX} orders per batch'}), 400
+
+        results = [None] * len(orders)
+        pending = []
+        for index, order in enumerate(orders):
+            error = validate_batch_order(order)
+            if error:
+                results[index] = {'index': index, 'status': 400, 'message': error}
+            else:
+                pending.append(index)
+
+        # Verify every user in one query
+        with tracer.start_as_current_span("verify_users"):
+            user_ids = sorted({orders[index]['user_id'] for index in pending})
+            existing_users = set()
+            if user_ids:
+                conn = get_db_connection()
+                if conn is None:
+                    return jsonify({'message': 'Database connection failed'}), 500
+                cursor = conn.cursor()
+                try:
+                    placeholders = ', '.join(['%s'] * len(user_ids))
+                    cursor.execute(f"SELECT id FROM users WHERE id IN ({placeholders})", tuple(user_ids))
+                    existing_users = {row[0] for row in cursor.fetchall()}
+                except mysql.connector.Error as error:
+                    logger.error("Error verifying users: %s", error)
+                    return jsonify({'message': 'Failed to create orders'}), 500
+                finally:
+                    cursor.close()
+                    conn.close()
+
+        reservable = []
+        for index in pending:
+            if orders[index]['user_id'] not in existing_users:
+                results[index] = {'index': index, 'status': 404, 'message': 'User not found'}
+            else:
+                reservable.append(index)
+
+        # inventory-service reserves stock for the whole batch in one transaction, in request
+        # order; an order either gets all its items or fails. As for single orders this happens
+        # before the order transaction, and every way out short of its commit releases the
+        # batch's stock by key, including a lost response after inventory-service took it.
+        accepted = []
+        reservations = {}
+        reservation_key = uuid.uuid4().hex if reservable else None
+        try:
+            with tracer.start_as_current_span("reserve_inventory"):
+                if reservable:
+                    reservation_response = reserve_stock_batch([{'items': orders[index]['items']} for index in reservable],
+                                                               reservation_key)
+        except upstream.UpstreamUnavailable:
+            return jsonify({'message': 'Inventory service unavailable'}), 503  # Turned away before it was sent
+        except upstream.UNAVAILABLE:
+            release_stock(reservation_key=reservation_key)
+            return jsonify({'message': 'Inventory service unavailable'}), 503
+        if reservable:
+            if reservation_response.status_code != 200:
+                logger.error("Error reserving stock: %s %s", reservation_response.status_code, reservation_response.text)
+                release_stock(reservation_key=reservation_key)
+                return jsonify({'message': 'Failed to create orders'}), 500
+            for index, reservation in zip(reservable, reservation_response.json()['results']):
+                if reservation['status'] == 201:
+                    accepted.append(index)
+                    reservations[index] = reservation['reservation']
+                else:
+                    results[index] = {'index': index, 'status': reservation['status'], 'message': reservation['message']}
+
+        conn = get_db_connection() if accepted else None
+        if accepted and conn is None:
+            release_stock(reservation_key=reservation_key)
+            return jsonify({'message': 'Database connection failed'}), 500
 
-            order_data = {
-                'id': order_id,
-                'user_id': user_id,
-                'items': items_to_order
-            }
+        unpriced = []
+        committed = False
+        if accepted:
+            cursor = conn.cursor()
+            try:
+                conn.start_transaction()
+
+                # Prices are captured with the orders, in one query for the whole batch
+                with tracer.start_as_current_span("capture_prices"):
+                    unit_prices = summaries.prices(cursor, [item['item_id'] for index in accepted for item in orders[index]['items']])
+                    priced = []
+                    for index in accepted:
+                        if all(item['item_id'] in unit_prices for item in orders[index]['items']):
+                            priced.append(index)
+                        else:
+                            # An item was deleted after its stock was reserved
+                            results[index] = {'index': index, 'status': 404, 'message': 'Item not found'}
+                            unpriced.extend(reservations[index])
+                    accepted = priced
+
+                with tracer.start_as_current_span("insert_orders"):
+                    order_items = []
+                    order_summaries = []
+                    for index in accepted:
+                        order = orders[index]
+                        cursor.execute("INSERT INTO orders (user_id) VALUES (%s)", (order['user_id'],))
+                        order_id = cursor.lastrowid
+                        order_items.extend((order_id, item['item_id'], item['quantity'], unit_prices[item['item_id']])
+                                           for item in order['items'])
+                        item_count, total = summaries.summarise(order['items'], unit_prices)
+                        order_summaries.append((order_id, order['user_id'], item_count, total))
+                        results[index] = {
+                            'index': index,
+                            'status': 201,
+                            'order': {'id': order_id, 'user_id': order['user_id'], 'items': order['items'],
+                                      'item_count': item_count, 'total': total}
+                        }
+
+                with tracer.start_as_current_span("insert_order_items"):
+                    if order_items:
+                        cursor.executemany("INSERT INTO order_items (order_id, item_id, quantity, unit_price) VALUES (%s, %s, %s, %s)",
+                                           order_items)
+                        summaries.record(cursor, order_summaries)
+
+                conn.commit()
+                committed = True
 
-            print("Response Data:", {'message': 'Order created successfully', 'order': order_data})  # Debug print
-            return jsonify({'message': 'Order created successfully', 'order': order_data}), 201
+            except mysql.connector.Error as error:
+                logger.error("Error during batch transaction: %s", error)
+                conn.rollback()
+                return jsonify({'message': 'Failed to create orders'}), 500
+            finally:
+                cursor.close()
+                conn.close()
+                if not committed:
+                    release_stock(reservation_key=reservation_key)
+
+        # Outside the transaction's error handling: the orders are committed, so the client
+        # must get their results whatever happens to this release
+        if unpriced:
+            release_stock(unpriced)
+        return jsonify({
+            'message': 'Batch processed',
+            'created': len(accepted),
+            'failed': len(orders) - len(accepted),
+            'results': results
+        }), 200
+
+@app.route('/orders/requests/<int:request_id>', methods=['GET'])
+def get_order_request(request_id):
+    with tracer.start_as_current_span("get_order_request"):
+        conn = get_db_connection()
+        if conn is not None:
+            cursor = conn.cursor()
+            try:
+                order_request = order_queue.find(cursor, request_id)
+            except mysql.connector.Error as error:
+                logger.error("Error fetching order request: %s", error)
+                return jsonify({'message': 'Failed to fetch order request'}), 500
+            finally:
+                cursor.close()
+                conn.close()
+            if order_request is None:
+                return jsonify({'message': 'Order request not found'}), 404
+            response = jsonify({'request': order_request})
+            if order_request['order_id'] is not None:
+                response.headers['Location'] = f"/orders/{order_request['order_id']}"
+            elif order_request['status'] != order_queue.FAILED:
+                response.headers['Retry-After'] = '1'
+            return response
+        else:
+            return jsonify({'message': 'Database connection failed'}), 500
 
-        except mysql.connector.Error as error:
-            print("Error during transaction:", error)
-            conn.rollback()  # Rollback on any database error
-            return jsonify({'message': 'Failed to create order'}), 500
-        except requests.exceptions.ConnectionError:
-            return jsonify({'message': 'Inventory or user service unavailable'}), 503
-        finally:
-            cursor.close()
-            conn.close()
+ORDERS_MAX_LIMIT = int(os.environ.get("ORDERS_MAX_LIMIT", "1000"))
+
+def optional_int_arg(name):
+    value = request.args.get(name)
+    return int(value) if value is not None else None
+
+# Fetch orders and their items in two queries, however many orders match
+def fetch_orders(cursor, order_id=None, user_id=None, after_id=None, limit=None):
+    conditions = []
+    params = []
+    if order_id is not None:
+        conditions.append("id = %s")
+        params.append(order_id)
+    if user_id is not None:
+        conditions.append("user_id = %s")
+        params.append(user_id)
+    if after_id is not None:
+        conditions.append("id > %s")
+        params.append(after_id)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    query = f"SELECT * FROM orders{where} ORDER BY id"
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+    cursor.execute(query, tuple(params))
+    orders = cursor.fetchall()
+    if not orders:
+        return orders
+
+    # Orders come back sorted by id, so their items are a single range scan on the order_items primary key
+    items_query = """
+        SELECT oi.order_id, oi.item_id, oi.quantity, i.name, oi.unit_price, oi.line_total
+        FROM order_items oi
+        JOIN items i ON oi.item_id = i.id
+    """
+    items_params = [orders[0]['id'], orders[-1]['id']]
+    if user_id is not None:
+        items_query += " JOIN orders o ON oi.order_id = o.id WHERE oi.order_id BETWEEN %s AND %s AND o.user_id = %s"
+        items_params.append(user_id)
+    else:
+        items_query += " WHERE oi.order_id BETWEEN %s AND %s"
+    cursor.execute(items_query, tuple(items_params))
+
+    orders_by_id = {}
+    for order in orders:
+        order['items'] = []
+        orders_by_id[order['id']] = order
+    for item in cursor.fetchall():
+        order = orders_by_id.get(item['order_id'])
+        if order is not None:
+            order['items'].append({'item_id': item['item_id'], 'quantity': item['quantity'], 'name': item['name'],
+                                   'price': item['unit_price'], 'line_total': item['line_total']})
+    return orders
+
+# Yield pages of orders with their items, walking the table by keyset so memory stays bounded
+def iter_order_pages(conn, user_id=None, after_id=None, page_size=STREAM_CHUNK_SIZE):
+    cursor = conn.cursor(dictionary=True)
+    try:
+        while True:
+            orders = fetch_orders(cursor, user_id=user_id, after_id=after_id, limit=page_size)
+            if orders:
+                yield orders
+            if len(orders) < page_size:
+                break
+            after_id = orders[-1]['id']
+    finally:
+        cursor.close()
+        conn.close()
 
 @app.route('/orders', methods=['GET'])
 def get_orders():
     with tracer.start_as_current_span("get_orders"):
-        conn = get_db_connection()
+        try:
+            user_id = optional_int_arg('user_id')
+            after_id = optional_int_arg('after_id')
+            limit = optional_int_arg('limit')
+        except ValueError:
+            return jsonify({'message': 'Bad Request: user_id, after_id and limit must be integers'}), 400
+        if limit is not None and limit < 1:
+            return jsonify({'message': 'Bad Request: limit must be positive'}), 400
+        if limit is not None:
+            limit = min(limit, ORDERS_MAX_LIMIT)
+
+        conn = get_read_connection()
+        if conn is not None and limit is None and wants_stream():
+            return stream_records('orders', iter_order_pages(conn, user_id=user_id, after_id=after_id))
         if conn is not None:
             cursor = conn.cursor(dictionary=True)
             try:
-                cursor.execute("SELECT * FROM orders")
-                orders = cursor.fetchall()
-
-                for order in orders:
-                    cursor.execute("""
-                        SELECT oi.item_id, oi.quantity, i.name, i.price
-                        FROM order_items oi
-                        JOIN items i ON oi.item_id = i.id
-                        WHERE oi.order_id = %s
-                    """, (order['id'],))
-                    order_items = cursor.fetchall()
-                    order['items'] = [{'item_id': item['item_id'], 'quantity': item['quantity'], 'name': item['name'], 'price': item['price']} for item in order_items]
-
-                return jsonify({'orders': orders}), 200
+                orders = fetch_orders(cursor, user_id=user_id, after_id=after_id, limit=limit)
+                response = {'orders': orders}
+                if limit is not None:
+                    response['next_after_id'] = orders[-1]['id'] if len(orders) == limit else None
+                return jsonify(response), 200
             except mysql.connector.Error as error:
-                print("Error fetching orders:", error)
+                logger.error("Error fetching orders: %s", error)
                 return jsonify({'message': 'Failed to fetch orders'}), 500
             finally:
                 cursor.close()
@@ -208,26 +650,16 @@ def get_orders():
 @app.route('/orders/<int:order_id>', methods=['GET'])
 def get_order(order_id):
     with tracer.start_as_current_span("get_order"):
-        conn = get_db_connection()
+        conn = get_read_connection()
         if conn is not None:
             cursor = conn.cursor(dictionary=True)
             try:
-                cursor.execute("SELECT * FROM orders WHERE id = %s", (order_id,))
-                order = cursor.fetchone()
-
-                if order:
-                    cursor.execute("""
-                        SELECT oi.item_id, oi.quantity, i.name, i.price
-                        FROM order_items oi
-                        JOIN items i ON oi.item_id = i.id
-                        WHERE oi.order_id = %s
-                    """, (order_id,))
-                    order_items = cursor.fetchall()
-                    order['items'] = [{'item_id': item['item_id'], 'quantity': item['quantity'], 'name': item['name'], 'price': item['price']} for item in order_items]
-                    return jsonify({'order': order}), 200
+                orders = fetch_orders(cursor, order_id=order_id)
+                if orders:
+                    return jsonify({'order': orders[0]}), 200
                 return jsonify({'message': 'Order not found'}), 404
             except mysql.connector.Error as error:
-                print("Error fetching order:", error)
+                logger.error("Error fetching order: %s", error)
                 return jsonify({'message': 'Failed to fetch order'}), 500
             finally:
                 cursor.close()
@@ -235,10 +667,80 @@ def get_order(order_id):
         else:
             return jsonify({'message': 'Database connection failed'}), 500
 
+USER_ORDERS_PAGE_SIZE = int(os.environ.get("USER_ORDERS_PAGE_SIZE", "100"))
+
+# A user's orders from the precomputed summaries, a page at a time
+@app.route('/users/<int:user_id>/orders', methods=['GET'])
+def get_user_orders(user_id):
+    with tracer.start_as_current_span("get_user_orders"):
+        try:
+            after_id = optional_int_arg('after_id')
+            limit = optional_int_arg('limit')
+        except ValueError:
+            return jsonify({'message': 'Bad Request: after_id and limit must be integers'}), 400
+        if limit is not None and limit < 1:
+            return jsonify({'message': 'Bad Request: limit must be positive'}), 400
+        limit = min(limit or USER_ORDERS_PAGE_SIZE, ORDERS_MAX_LIMIT)
+
+        conn = get_read_connection()
+        if conn is not None:
+            cursor = conn.cursor()
+            try:
+                orders = summaries.for_user(cursor, user_id, after_id=after_id, limit=limit)
+                next_after_id = orders[-1]['order_id'] if len(orders) == limit else None
+                return jsonify({'orders': orders, 'next_after_id': next_after_id}), 200
+            except mysql.connector.Error as error:
+                logger.error("Error fetching user orders: %s", error)
+                return jsonify({'message': 'Failed to fetch orders'}), 500
+            finally:
+                cursor.close()
+                conn.close()
+        else:
+            return jsonify({'message': 'Database connection failed'}), 500
+
+# Order count, items and amount spent across all of a user's orders
+@app.route('/users/<int:user_id>/orders/summary', methods=['GET'])
+def get_user_orders_summary(user_id):
+    with tracer.start_as_current_span("get_user_orders_summary"):
+        conn = get_read_connection()
+        if conn is not None:
+            cursor = conn.cursor()
+            try:
+                return jsonify({'summary': summaries.user_totals(cursor, user_id)}), 200
+            except mysql.connector.Error as error:
+                logger.error("Error fetching user order summary: %s", error)
+                return jsonify({'message': 'Failed to fetch order summary'}), 500
+            finally:
+                cursor.close()
+                conn.close()
+        else:
+            return jsonify({'message': 'Database connection failed'}), 500
+
+@app.route('/orders/<int:order_id>/summary', methods=['GET'])
+def get_order_summary(order_id):
+    with tracer.start_as_current_span("get_order_summary"):
+        conn = get_read_connection()
+        if conn is not None:
+            cursor = conn.cursor()
+            try:
+                summary = summaries.find(cursor, order_id)
+                if summary is not None:
+                    return jsonify({'summary': summary}), 200
+                return jsonify({'message': 'Order not found'}), 404
+            except mysql.connector.Error as error:
+                logger.error("Error fetching order summary: %s", error)
+                return jsonify({'message': 'Failed to fetch order summary'}), 500
+            finally:
+                cursor.close()
+                conn.close()
+        else:
+            return jsonify({'message': 'Database connection failed'}), 500
+
 # Health check endpoint
 @app.route('/healthz', methods=['GET'])
 def health_check():
     return jsonify({'status': 'ok'}), 200
 
 if __name__ == '__main__':
+    init_worker()
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
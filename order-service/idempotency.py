@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import random
+import uuid
+
+import mysql.connector
+from flask import current_app
+from mysql.connector import errorcode
+
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+IDEMPOTENCY_KEY_TTL = int(os.environ.get("IDEMPOTENCY_KEY_TTL", "86400"))  # Seconds a stored response is kept
+IDEMPOTENCY_PRUNE_RATE = 0.01  # Fraction of lookups that also delete expired keys
+# Seconds an attempt holds its key. A claim older than this belongs to an attempt that died
+# without finishing, and the next duplicate takes it over; it must outlast a whole order.
+IDEMPOTENCY_CLAIM_LEASE = int(os.environ.get("IDEMPOTENCY_CLAIM_LEASE", "30"))
+IDEMPOTENCY_WAIT = float(os.environ.get("IDEMPOTENCY_WAIT", "10"))  # Longest a duplicate waits on the attempt in flight
+IDEMPOTENCY_POLL_INTERVAL = float(os.environ.get("IDEMPOTENCY_POLL_INTERVAL", "0.1"))
+
+
+def is_valid_key(key):
+    return 0 < len(key) <= IDEMPOTENCY_KEY_MAX_LENGTH
+
+
+def is_duplicate_key(error):
+    return error.errno == errorcode.ER_DUP_ENTRY
+
+
+# Retries must carry the same body as the first attempt to be treated as the same request
+def fingerprint(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+def find(cursor, key):
+    cursor.execute("SELECT request_hash, response_code, response_body FROM order_idempotency WHERE idempotency_key = %s",
+                   (key,))
+    rows = cursor.fetchall()  # Drain the result so the connection can run the next statement
+    return rows[0] if rows else None
+
+
+def prune(conn):
+    if random.random() >= IDEMPOTENCY_PRUNE_RATE:
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DELETE FROM order_idempotency WHERE created_at < NOW() - INTERVAL %s SECOND LIMIT 1000",
+                       (IDEMPOTENCY_KEY_TTL,))
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+# Claim the key for one attempt in a short transaction of its own, committed before the
+# attempt reserves any stock. A row without a response code is an attempt in flight, so a
+# duplicate finds it and waits rather than running the order a second time. Returns
+# (claim token, None) when this attempt owns the key, or (None, stored) otherwise, stored
+# being the row as find() returns it, or None if its attempt gave the key up meanwhile.
+def claim(conn, key, data):
+    token = uuid.uuid4().hex
+    request_hash = fingerprint(data)
+    cursor = conn.cursor()
+    try:
+        try:
+            cursor.execute("INSERT INTO order_idempotency (idempotency_key, request_hash, claim_token, claimed_until) "
+                           "VALUES (%s, %s, %s, NOW(3) + INTERVAL %s SECOND)",
+                           (key, request_hash, token, IDEMPOTENCY_CLAIM_LEASE))
+            conn.commit()
+            return token, None
+        except mysql.connector.IntegrityError as error:
+            if not is_duplicate_key(error):
+                raise
+            conn.rollback()
+        # Take over the key of an attempt that died without finishing or giving it up
+        cursor.execute("UPDATE order_idempotency SET claim_token = %s, claimed_until = NOW(3) + INTERVAL %s SECOND "
+                       "WHERE idempotency_key = %s AND request_hash = %s AND response_code IS NULL "
+                       "AND claimed_until < NOW(3)", (token, IDEMPOTENCY_CLAIM_LEASE, key, request_hash))
+        if cursor.rowcount == 1:
+            conn.commit()
+            return token, None
+        stored = find(cursor, key)
+        conn.commit()
+        return None, stored
+    except mysql.connector.Error:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+# Lock the key's row as the first statement of the order transaction, so a takeover waits for
+# this attempt's outcome. Returns False if the claim was taken over; the caller rolls back.
+def hold(cursor, key, token):
+    cursor.execute("SELECT claim_token FROM order_idempotency WHERE idempotency_key = %s FOR UPDATE", (key,))
+    rows = cursor.fetchall()
+    return bool(rows) and rows[0][0] == token
+
+
+# Give the key up after an attempt that stored no order, so a retry runs afresh
+def release(conn, key, token):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DELETE FROM order_idempotency WHERE idempotency_key = %s AND claim_token = %s "
+                       "AND response_code IS NULL", (key, token))
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+# Whether the attempt that claimed the key has yet to store its response
+def is_pending(stored):
+    return stored[1] is None
+
+
+def record(cursor, key, status, payload):
+    cursor.execute("UPDATE order_idempotency SET response_code = %s, response_body = %s WHERE idempotency_key = %s",
+                   (status, current_app.json.dumps(payload), key))
+
+
+# Answer a duplicate: the stored response, a 422 if its body differs from the one that claimed
+# the key, or a 409 while the attempt that claimed it is still in flight
+def replay(stored, data):
+    request_hash, status, body = stored
+    if request_hash != fingerprint(data):
+        body = current_app.json.dumps({'message': 'Idempotency-Key was already used with a different request'})
+        return current_app.response_class(body, status=422, mimetype='application/json')
+    if status is None:
+        body = current_app.json.dumps({'message': 'A request with this Idempotency-Key is still in progress'})
+        return current_app.response_class(body, status=409, mimetype='application/json', headers={'Retry-After': '1'})
+    return current_app.response_class(body, status=status, mimetype='application/json',
+                                      headers={'Idempotent-Replayed': 'true'})
@@ -0,0 +1,93 @@
+# Apply order-service's schema migrations. Runs once per deployment, before the pods start,
+# and after user-service's and inventory-service's, whose tables these refer to:
+#   DB_HOST=... DB_NAME=... DB_USER=... DB_PASSWORD=... python migrate.py [--status] [--to VERSION]
+from migrations import Migration, add_column, add_index, column_exists, main
+
+SERVICE = "order-service"
+
+
+# Lines from before prices were captured are priced at what the items cost today
+def add_order_item_prices(cursor):
+    if column_exists(cursor, "order_items", "unit_price"):
+        return
+    cursor.execute("ALTER TABLE order_items ADD COLUMN unit_price DECIMAL(10, 2) NULL, "
+                   "ADD COLUMN line_total DECIMAL(12, 2) AS (unit_price * quantity) STORED")
+    cursor.execute("UPDATE order_items oi JOIN items i ON oi.item_id = i.id SET oi.unit_price = i.price "
+                   "WHERE oi.unit_price IS NULL")
+
+
+MIGRATIONS = [
+    Migration(1, "Create orders, order items and idempotency keys", '''
+        CREATE TABLE IF NOT EXISTS orders (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''', '''
+        CREATE TABLE IF NOT EXISTS order_items (
+            order_id INT NOT NULL,
+            item_id INT NOT NULL,
+            quantity INT NOT NULL,
+            FOREIGN KEY (order_id) REFERENCES orders(id),
+            FOREIGN KEY (item_id) REFERENCES items(id),
+            PRIMARY KEY (order_id, item_id)
+        )
+    ''', '''
+        CREATE TABLE IF NOT EXISTS order_idempotency (
+            idempotency_key VARCHAR(255) NOT NULL PRIMARY KEY,
+            request_hash CHAR(64) NOT NULL,
+            response_code INT NULL,
+            response_body MEDIUMTEXT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            INDEX (created_at)
+        )
+    '''),
+    Migration(2, "Capture order prices and precompute order summaries", add_order_item_prices, '''
+        CREATE TABLE IF NOT EXISTS order_summaries (
+            order_id INT NOT NULL PRIMARY KEY,
+            user_id INT NOT NULL,
+            item_count INT NOT NULL,
+            total DECIMAL(12, 2) NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (order_id) REFERENCES orders(id),
+            INDEX (user_id, order_id),
+            INDEX (created_at)
+        )
+    ''', '''
+        INSERT IGNORE INTO order_summaries (order_id, user_id, item_count, total)
+        SELECT o.id, o.user_id, COALESCE(SUM(oi.quantity), 0), COALESCE(SUM(oi.line_total), 0)
+        FROM orders o
+        LEFT JOIN order_summaries s ON s.order_id = o.id
+        LEFT JOIN order_items oi ON oi.order_id = o.id
+        WHERE s.order_id IS NULL
+        GROUP BY o.id, o.user_id
+    '''),
+    Migration(3, "Index orders by user and order items by item",
+              add_index("orders", "user_id", "id"),
+              add_index("order_items", "item_id")),
+    Migration(4, "Queue order requests for asynchronous intake", '''
+        CREATE TABLE IF NOT EXISTS order_requests (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            status VARCHAR(16) NOT NULL,
+            request_body MEDIUMTEXT NOT NULL,
+            idempotency_key VARCHAR(255) NOT NULL UNIQUE,
+            user_verified BOOLEAN NOT NULL DEFAULT FALSE,
+            attempts INT NOT NULL DEFAULT 0,
+            available_at TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+            enqueued_at TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+            finished_at TIMESTAMP(3) NULL,
+            response_code INT NULL,
+            response_body MEDIUMTEXT NULL,
+            order_id INT NULL,
+            INDEX (status, available_at),
+            INDEX (finished_at)
+        )
+    '''),
+    # An attempt claims its key in a committed row before reserving stock; duplicates wait on it
+    Migration(5, "Claim idempotency keys ahead of the order transaction",
+              add_column("order_idempotency", "claim_token", "CHAR(32) NULL"),
+              add_column("order_idempotency", "claimed_until", "TIMESTAMP(3) NULL")),
+]
+
+if __name__ == '__main__':
+    main(SERVICE, MIGRATIONS)
@@ -0,0 +1,295 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+import mysql.connector
+from prometheus_client import Counter, Gauge, Histogram
+
+from db import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+# Asynchronous order intake. An order posted with `Prefer: respond-async` (or any order, with
+# ORDER_INTAKE=async) is stored in order_requests and answered with 202 straight away. Worker
+# threads in every order-service process claim queued requests in batches and run them
+# through create_order. Each request carries an idempotency key, so one retried after a
+# worker died part-way through cannot create its order twice.
+INTAKE_MODES = ("sync", "async")
+ORDER_INTAKE = os.environ.get("ORDER_INTAKE", "sync")  # For requests that do not say which they prefer
+ORDER_QUEUE_WORKERS = int(os.environ.get("ORDER_QUEUE_WORKERS", "2"))  # Worker threads per process
+ORDER_QUEUE_BATCH = int(os.environ.get("ORDER_QUEUE_BATCH", "20"))  # Requests claimed per round trip
+ORDER_QUEUE_POLL_INTERVAL = float(os.environ.get("ORDER_QUEUE_POLL_INTERVAL", "1"))  # Seconds between polls when idle
+ORDER_QUEUE_LEASE = int(os.environ.get("ORDER_QUEUE_LEASE", "60"))  # Seconds before a claimed request may be retried
+ORDER_QUEUE_MAX_ATTEMPTS = int(os.environ.get("ORDER_QUEUE_MAX_ATTEMPTS", "5"))
+ORDER_QUEUE_RETRY_DELAY = float(os.environ.get("ORDER_QUEUE_RETRY_DELAY", "2"))  # Base delay before a retry, doubled per attempt
+ORDER_QUEUE_RETENTION = int(os.environ.get("ORDER_QUEUE_RETENTION", "86400"))  # Seconds finished requests stay visible
+ORDER_QUEUE_METRICS_INTERVAL = float(os.environ.get("ORDER_QUEUE_METRICS_INTERVAL", "5"))
+
+QUEUED, PROCESSING, CREATED, FAILED = "queued", "processing", "created", "failed"
+REQUEST_COLUMNS = "id, status, attempts, response_code, response_body, order_id, enqueued_at, finished_at"
+
+# Set on enqueue so this process's workers start at once instead of at their next poll
+_wake = threading.Event()
+
+
+def wants_async(prefer_header):
+    preferences = {token.strip().lower() for token in (prefer_header or "").split(",")}
+    if "respond-async" in preferences:
+        return True
+    return ORDER_INTAKE == "async" and "wait" not in {token.split("=")[0] for token in preferences}
+
+
+def new_idempotency_key():
+    return f"order-request-{uuid.uuid4().hex}"
+
+
+# Store an order request; returns its id. user_verified records that the gateway vouched for the user.
+def enqueue(cursor, data, idempotency_key, user_verified):
+    cursor.execute("INSERT INTO order_requests (status, request_body, idempotency_key, user_verified) "
+                   "VALUES (%s, %s, %s, %s)", (QUEUED, json.dumps(data), idempotency_key, user_verified))
+    _wake.set()
+    return cursor.lastrowid
+
+
+# (id, request_body) of the request stored under an idempotency key, or None
+def find_by_key(cursor, idempotency_key):
+    cursor.execute("SELECT id, request_body FROM order_requests WHERE idempotency_key = %s", (idempotency_key,))
+    rows = cursor.fetchall()
+    return (rows[0][0], json.loads(rows[0][1])) if rows else None
+
+
+def to_dict(row):
+    request_id, status, attempts, response_code, response_body, order_id, enqueued_at, finished_at = row
+    return {
+        'id': request_id,
+        'status': status,
+        'attempts': attempts,
+        'order_id': order_id,
+        'response_code': response_code,
+        'response': json.loads(response_body) if response_body else None,
+        'enqueued_at': enqueued_at.isoformat() if enqueued_at else None,
+        'finished_at': finished_at.isoformat() if finished_at else None,
+    }
+
+
+def find(cursor, request_id):
+    cursor.execute(f"SELECT {REQUEST_COLUMNS} FROM order_requests WHERE id = %s", (request_id,))
+    row = cursor.fetchone()
+    return to_dict(row) if row else None
+
+
+class Entry:
+    def __init__(self, request_id, data, idempotency_key, user_verified, attempts, waited):
+        self.id = request_id
+        self.data = data
+        self.idempotency_key = idempotency_key
+        self.user_verified = bool(user_verified)
+        self.attempts = attempts  # Including this one
+        self.waited = waited  # Seconds since it was enqueued
+
+
+# Claim up to `limit` requests that are queued, or whose worker's lease ran out. SKIP LOCKED
+# lets workers claim side by side without waiting on each other's rows.
+def claim(conn, limit=ORDER_QUEUE_BATCH):
+    cursor = conn.cursor()
+    try:
+        conn.start_transaction()
+        cursor.execute("SELECT id, request_body, idempotency_key, user_verified, attempts, "
+                       "TIMESTAMPDIFF(MICROSECOND, enqueued_at, NOW(3)) / 1000000 FROM order_requests "
+                       "WHERE status IN (%s, %s) AND available_at <= NOW(3) ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED",
+                       (QUEUED, PROCESSING, limit))
+        rows = cursor.fetchall()
+        if rows:
+            placeholders = ", ".join(["%s"] * len(rows))
+            cursor.execute(f"UPDATE order_requests SET status = %s, attempts = attempts + 1, "
+                           f"available_at = NOW(3) + INTERVAL %s SECOND WHERE id IN ({placeholders})",
+                           (PROCESSING, ORDER_QUEUE_LEASE) + tuple(row[0] for row in rows))
+        conn.commit()
+    except mysql.connector.Error:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return [Entry(request_id, json.loads(body), key, verified, attempts + 1, float(waited))
+            for request_id, body, key, verified, attempts, waited in rows]
+
+
+def retry_delay(attempts):
+    return ORDER_QUEUE_RETRY_DELAY * 2 ** (attempts - 1) * random.uniform(0.5, 1)
+
+
+# Outcome of one attempt: (status, response_code, response_body, order_id, retry delay)
+def outcome(entry, response_code, response_body):
+    if response_code == 201:
+        return CREATED, response_code, response_body, json.loads(response_body)['order']['id'], 0
+    if (response_code >= 500 or response_code == 409) and entry.attempts < ORDER_QUEUE_MAX_ATTEMPTS:
+        # Upstream or database trouble, or an earlier attempt still holding the idempotency key,
+        # which also makes a retry safe
+        return QUEUED, response_code, response_body, None, retry_delay(entry.attempts)
+    return FAILED, response_code, response_body, None, 0
+
+
+def finish(conn, results):
+    cursor = conn.cursor()
+    try:
+        cursor.executemany("UPDATE order_requests SET status = %s, response_code = %s, response_body = %s, order_id = %s, "
+                           "available_at = NOW(3) + INTERVAL %s SECOND, "
+                           "finished_at = IF(%s, NOW(3), NULL) WHERE id = %s",
+                           [(status, code, body, order_id, delay, status in (CREATED, FAILED), request_id)
+                            for request_id, (status, code, body, order_id, delay) in results])
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def prune(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DELETE FROM order_requests WHERE finished_at < NOW() - INTERVAL %s SECOND LIMIT 1000",
+                       (ORDER_QUEUE_RETENTION,))
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+class Worker(threading.Thread):
+    """Claims batches of queued order requests and runs each through process(entry),
+    which returns the (status code, JSON body) that create_order answered with."""
+
+    def __init__(self, process, name):
+        super().__init__(name=name, daemon=True)
+        self.process = process
+
+    def run(self):
+        while True:
+            try:
+                claimed = self.run_once()
+            except Exception:
+                # Claimed requests are retried by any worker once their lease runs out
+                logger.exception("Error processing order queue")
+                claimed = 0
+            _maybe_refresh_metrics()
+            if claimed < ORDER_QUEUE_BATCH:
+                _wake.wait(ORDER_QUEUE_POLL_INTERVAL)
+                _wake.clear()
+
+    # Process one batch; returns how many requests were claimed. The claim's connection goes
+    # back to the pool before processing, since each create_order checks out its own; holding
+    # it for the whole batch would let the workers starve the pool. Each result is recorded
+    # on a fresh connection as soon as it is known.
+    def run_once(self):
+        conn = get_db_connection()
+        if conn is None:
+            return 0
+        try:
+            entries = claim(conn)
+        finally:
+            conn.close()
+        for entry in entries:
+            _observe_wait(entry.attempts, entry.waited)
+            if entry.attempts > ORDER_QUEUE_MAX_ATTEMPTS:
+                # Every earlier attempt died without recording a result
+                body = json.dumps({'message': 'Order request abandoned after repeated failures'})
+                self.record(entry, (FAILED, 500, body, None, 0))
+                continue
+            try:
+                response_code, response_body = self.process(entry)
+            except Exception:
+                logger.exception("Error processing order request %s", entry.id)
+                response_code, response_body = 500, json.dumps({'message': 'Failed to create order'})
+            self.record(entry, outcome(entry, response_code, response_body))
+        if random.random() < 0.01:
+            conn = get_db_connection()
+            if conn is not None:
+                try:
+                    prune(conn)
+                finally:
+                    conn.close()
+        return len(entries)
+
+    # Store one request's result. If that fails the request is retried once its lease runs
+    # out, and its idempotency key answers the retry with the same order.
+    def record(self, entry, result):
+        conn = get_db_connection()
+        if conn is None:
+            logger.error("Error recording order request %s: database connection failed", entry.id)
+            return
+        try:
+            finish(conn, [(entry.id, result)])
+            _count_processed(result[0])
+        except mysql.connector.Error as error:
+            logger.error("Error recording order request %s: %s", entry.id, error)
+        finally:
+            conn.close()
+
+
+def start_workers(process, count=ORDER_QUEUE_WORKERS):
+    workers = [Worker(process, f"order-queue-{index}") for index in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+# Queue metrics, registered on the service's metrics registry by bind_metrics()
+_depth_gauge = None
+_lag_gauge = None
+_wait_histogram = None
+_processed_counter = None
+_metrics_lock = threading.Lock()
+_metrics_refreshed_at = 0.0
+
+
+def _observe_wait(attempts, seconds):
+    if _wait_histogram is not None and attempts == 1:
+        _wait_histogram.observe(seconds)
+
+
+def _count_processed(status):
+    if _processed_counter is not None:
+        _processed_counter.labels(result=status).inc()
+
+
+# Depth and lag are properties of the shared table, so one worker per process reads them now and then
+def _maybe_refresh_metrics():
+    global _metrics_refreshed_at
+    if _depth_gauge is None or time.monotonic() - _metrics_refreshed_at < ORDER_QUEUE_METRICS_INTERVAL:
+        return
+    if not _metrics_lock.acquire(blocking=False):
+        return
+    try:
+        _metrics_refreshed_at = time.monotonic()
+        conn = get_db_connection()
+        if conn is None:
+            return
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT status, COUNT(*), TIMESTAMPDIFF(MICROSECOND, MIN(enqueued_at), NOW(3)) / 1000000 "
+                           "FROM order_requests WHERE status IN (%s, %s) GROUP BY status", (QUEUED, PROCESSING))
+            rows = {status: (count, float(lag or 0)) for status, count, lag in cursor.fetchall()}
+        finally:
+            cursor.close()
+            conn.close()
+        for status in (QUEUED, PROCESSING):
+            _depth_gauge.labels(status=status).set(rows.get(status, (0, 0))[0])
+        _lag_gauge.set(max((lag for _, lag in rows.values()), default=0))
+    except mysql.connector.Error as error:
+        logger.error("Error reading order queue metrics: %s", error)
+    finally:
+        _metrics_lock.release()
+
+
+def bind_metrics(registry):
+    global _depth_gauge, _lag_gauge, _wait_histogram, _processed_counter
+    # Every process reads the same table, so the freshest reading is reported
+    _depth_gauge = Gauge('order_queue_depth', 'Order requests waiting (queued) or being worked on (processing)',
+                         ['status'], multiprocess_mode='livemax', registry=registry)
+    _lag_gauge = Gauge('order_queue_lag_seconds', 'Age of the oldest unfinished order request',
+                       multiprocess_mode='livemax', registry=registry)
+    _wait_histogram = Histogram('order_queue_wait_seconds', 'Time from enqueueing an order request to its first claim',
+                                buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300), registry=registry)
+    _processed_counter = Counter('order_queue_processed', 'Order request attempts by result (created, failed, queued for retry)',
+                                 ['result'], registry=registry)
@@ -0,0 +1,53 @@
+# One precomputed row per order, written in the order's own transaction, so order
+# listings and totals never have to join order_items with items.
+SUMMARY_COLUMNS = "order_id, user_id, item_count, total, created_at"
+
+
+# Current unit prices of the given items, read in the order's transaction
+def prices(cursor, item_ids):
+    item_ids = sorted(set(item_ids))
+    cursor.execute(f"SELECT id, price FROM items WHERE id IN ({', '.join(['%s'] * len(item_ids))})", tuple(item_ids))
+    return dict(cursor.fetchall())
+
+
+def summarise(items, unit_prices):
+    item_count = sum(item['quantity'] for item in items)
+    total = sum(unit_prices[item['item_id']] * item['quantity'] for item in items)
+    return item_count, total
+
+
+def record(cursor, rows):
+    cursor.executemany("INSERT INTO order_summaries (order_id, user_id, item_count, total) VALUES (%s, %s, %s, %s)",
+                       rows)
+
+
+def to_dict(row):
+    order_id, user_id, item_count, total, created_at = row
+    return {'order_id': order_id, 'user_id': user_id, 'item_count': item_count, 'total': total,
+            'created_at': created_at.isoformat() if created_at else None}
+
+
+def find(cursor, order_id):
+    cursor.execute(f"SELECT {SUMMARY_COLUMNS} FROM order_summaries WHERE order_id = %s", (order_id,))
+    row = cursor.fetchone()
+    return to_dict(row) if row else None
+
+
+# One page of a user's orders, oldest first, walked by order id on the (user_id, order_id) index
+def for_user(cursor, user_id, after_id=None, limit=100):
+    query = f"SELECT {SUMMARY_COLUMNS} FROM order_summaries WHERE user_id = %s"
+    params = [user_id]
+    if after_id is not None:
+        query += " AND order_id > %s"
+        params.append(after_id)
+    query += " ORDER BY order_id LIMIT %s"
+    params.append(limit)
+    cursor.execute(query, tuple(params))
+    return [to_dict(row) for row in cursor.fetchall()]
+
+
+def user_totals(cursor, user_id):
+    cursor.execute("SELECT COUNT(*), COALESCE(SUM(item_count), 0), COALESCE(SUM(total), 0) "
+                   "FROM order_summaries WHERE user_id = %s", (user_id,))
+    order_count, item_count, total = cursor.fetchone()
+    return {'user_id': user_id, 'order_count': order_count, 'item_count': int(item_count), 'total': total}
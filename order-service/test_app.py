@@ -0,0 +1,98 @@
+import unittest
+from decimal import Decimal
+from unittest.mock import Mock, patch
+
+import mysql.connector
+import requests
+
+import app as order_app
+from fake_db import FakeConnection, FakeCursor
+
+
+def reservation_response(*statuses):
+    results = [{'status': 201, 'reservation': [{'item_id': 1, 'bucket': 0, 'quantity': 1}]} if status == 201
+               else {'status': status, 'message': 'Insufficient stock'} for status in statuses]
+    return Mock(status_code=200, json=Mock(return_value={'results': results}))
+
+
+class TestCreateOrdersBatch(unittest.TestCase):
+    def setUp(self):
+        self.client = order_app.app.test_client()
+        self.users = [1]
+        self.prices = {1: Decimal('2.50'), 2: Decimal('4.00')}
+        self.users_conn = FakeConnection(FakeCursor(lambda query, params: [(user_id,) for user_id in self.users]))
+        self.orders_conn = FakeConnection(FakeCursor(self.respond, lastrowid=0))
+        get_db_connection = patch('app.get_db_connection', side_effect=[self.users_conn, self.orders_conn])
+        self.get_db_connection = get_db_connection.start()
+        self.addCleanup(get_db_connection.stop)
+        release_stock = patch('app.release_stock')
+        self.release_stock = release_stock.start()
+        self.addCleanup(release_stock.stop)
+
+    def respond(self, query, params):
+        if query.startswith("SELECT id, price FROM items"):
+            return [(item_id, self.prices[item_id]) for item_id in params if item_id in self.prices]
+        if query.startswith("INSERT INTO orders"):
+            self.orders_conn.fake_cursor.lastrowid += 1
+        return []
+
+    def post_batch(self, *orders):
+        return self.client.post('/orders/batch', json={'orders': list(orders)})
+
+    def reserved_key(self, reserve_stock_batch):
+        return reserve_stock_batch.call_args[0][1]
+
+    @patch('app.reserve_stock_batch')
+    def test_each_order_gets_its_own_result(self, reserve_stock_batch):
+        reserve_stock_batch.return_value = reservation_response(201, 409)
+        response = self.post_batch({'user_id': 1, 'items': [{'item_id': 1, 'quantity': 2}]},
+                                   {'user_id': 2, 'items': [{'item_id': 1, 'quantity': 1}]},
+                                   {'user_id': 1, 'items': []},
+                                   {'user_id': 1, 'items': [{'item_id': 2, 'quantity': 9}]})
+
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+        self.assertEqual([result['status'] for result in body['results']], [201, 404, 400, 409])
+        self.assertEqual((body['created'], body['failed']), (1, 3))
+        self.assertEqual(body['results'][0]['order']['total'], '5.00')
+        self.assertEqual(reserve_stock_batch.call_args[0][0],
+                         [{'items': [{'item_id': 1, 'quantity': 2}]}, {'items': [{'item_id': 2, 'quantity': 9}]}])
+        self.assertEqual(self.orders_conn.events, ["start_transaction", "commit", "close"])
+        self.release_stock.assert_not_called()
+
+    @patch('app.reserve_stock_batch', side_effect=requests.exceptions.Timeout("read timed out"))
+    def test_lost_reservation_response_releases_by_key(self, reserve_stock_batch):
+        response = self.post_batch({'user_id': 1, 'items': [{'item_id': 1, 'quantity': 1}]})
+        self.assertEqual(response.status_code, 503)
+        self.release_stock.assert_called_once_with(reservation_key=self.reserved_key(reserve_stock_batch))
+        self.assertEqual(self.orders_conn.events, [])
+
+    @patch('app.reserve_stock_batch')
+    def test_failed_transaction_rolls_back_and_releases_by_key(self, reserve_stock_batch):
+        reserve_stock_batch.return_value = reservation_response(201)
+
+        def respond(query, params):
+            if query.startswith("INSERT INTO orders"):
+                raise mysql.connector.OperationalError("lost connection")
+            return self.respond(query, params)
+
+        self.orders_conn.fake_cursor.respond = respond
+        with self.assertLogs('app', level='ERROR'):
+            response = self.post_batch({'user_id': 1, 'items': [{'item_id': 1, 'quantity': 1}]})
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.orders_conn.events, ["start_transaction", "rollback", "close"])
+        self.release_stock.assert_called_once_with(reservation_key=self.reserved_key(reserve_stock_batch))
+
+    @patch('app.reserve_stock_batch')
+    def test_stock_of_a_deleted_item_is_released_after_the_commit(self, reserve_stock_batch):
+        reserve_stock_batch.return_value = reservation_response(201, 201)
+        del self.prices[2]
+        response = self.post_batch({'user_id': 1, 'items': [{'item_id': 1, 'quantity': 1}]},
+                                   {'user_id': 1, 'items': [{'item_id': 2, 'quantity': 1}]})
+        self.assertEqual([result['status'] for result in response.get_json()['results']], [201, 404])
+        self.assertEqual(self.orders_conn.events, ["start_transaction", "commit", "close"])
+        self.release_stock.assert_called_once_with([{'item_id': 1, 'bucket': 0, 'quantity': 1}])
+
+
+if __name__ == '__main__':
+    unittest.main()
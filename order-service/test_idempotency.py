@@ -0,0 +1,96 @@
+import unittest
+
+import mysql.connector
+from flask import Flask
+from mysql.connector import errorcode
+
+import idempotency
+from fake_db import FakeConnection, FakeCursor
+
+
+class TestFingerprint(unittest.TestCase):
+    def test_ignores_key_order_and_whitespace(self):
+        self.assertEqual(idempotency.fingerprint({'user_id': 1, 'items': [{'item_id': 2, 'quantity': 1}]}),
+                         idempotency.fingerprint({'items': [{'quantity': 1, 'item_id': 2}], 'user_id': 1}))
+
+    def test_differs_for_another_body(self):
+        self.assertNotEqual(idempotency.fingerprint({'user_id': 1}), idempotency.fingerprint({'user_id': 2}))
+
+
+class TestClaim(unittest.TestCase):
+    data = {'user_id': 1}
+
+    def duplicate(self, takeover_rows, stored):
+        def respond(query, params):
+            if query.startswith("INSERT INTO order_idempotency"):
+                raise mysql.connector.IntegrityError(errno=errorcode.ER_DUP_ENTRY)
+            if query.startswith("UPDATE order_idempotency"):
+                cursor.rowcount = takeover_rows
+            if query.startswith("SELECT request_hash"):
+                return [stored]
+            return []
+
+        cursor = FakeCursor(respond)
+        return FakeConnection(cursor)
+
+    def test_a_new_key_is_claimed_and_committed_at_once(self):
+        conn = FakeConnection()
+        token, stored = idempotency.claim(conn, 'k', self.data)
+        self.assertIsNotNone(token)
+        self.assertIsNone(stored)
+        self.assertEqual(conn.fake_cursor.executed("INSERT INTO order_idempotency")[0][:3],
+                         ('k', idempotency.fingerprint(self.data), token))
+        self.assertEqual(conn.events, ["commit"])
+
+    def test_an_attempt_in_flight_is_returned_not_taken_over(self):
+        pending = (idempotency.fingerprint(self.data), None, None)
+        conn = self.duplicate(0, pending)
+        self.assertEqual(idempotency.claim(conn, 'k', self.data), (None, pending))
+        self.assertTrue(idempotency.is_pending(pending))
+
+    def test_an_expired_claim_is_taken_over(self):
+        conn = self.duplicate(1, None)
+        token, stored = idempotency.claim(conn, 'k', self.data)
+        self.assertEqual(conn.fake_cursor.executed("UPDATE order_idempotency")[0][0], token)
+        self.assertIsNone(stored)
+        self.assertEqual(conn.events, ["rollback", "commit"])
+
+
+class TestHold(unittest.TestCase):
+    def test_only_the_current_claim_holds_the_key(self):
+        cursor = FakeCursor(lambda query, params: [('mine',)])
+        self.assertTrue(idempotency.hold(cursor, 'k', 'mine'))
+        self.assertFalse(idempotency.hold(cursor, 'k', 'theirs'))
+        self.assertTrue(cursor.statements[0][0].endswith("FOR UPDATE"))
+
+    def test_a_released_key_is_not_held(self):
+        self.assertFalse(idempotency.hold(FakeCursor(), 'k', 'mine'))
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.context = Flask(__name__).app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def test_same_body_replays_the_stored_response(self):
+        data = {'user_id': 1}
+        response = idempotency.replay((idempotency.fingerprint(data), 201, '{"order": {"id": 3}}'), data)
+        self.assertEqual((response.status_code, response.headers['Idempotent-Replayed']), (201, 'true'))
+        self.assertEqual(response.get_json(), {'order': {'id': 3}})
+
+    def test_different_body_is_refused(self):
+        stored = (idempotency.fingerprint({'user_id': 1}), 201, '{"order": {"id": 3}}')
+        self.assertEqual(idempotency.replay(stored, {'user_id': 2}).status_code, 422)
+
+    def test_attempt_in_flight_answers_409(self):
+        data = {'user_id': 1}
+        response = idempotency.replay((idempotency.fingerprint(data), None, None), data)
+        self.assertEqual((response.status_code, response.headers['Retry-After']), (409, '1'))
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+# User lookup cache configuration
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "30"))  # Hard upper bound on how long a found user is trusted
+USER_CACHE_NEGATIVE_TTL = float(os.environ.get("USER_CACHE_NEGATIVE_TTL", "5"))  # How long a 404 is remembered
+USER_CACHE_INVALIDATION_INTERVAL = float(os.environ.get("USER_CACHE_INVALIDATION_INTERVAL", "2"))  # Invalidation feed poll interval
+
+# Only definite answers are cached; errors and timeouts always go upstream
+CACHEABLE_STATUSES = (200, 404)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.status = None
+        self.error = None
+
+
+class UserCache:
+    """TTL + LRU cache of user lookups with single-flight misses.
+
+    fetch(user_id) returns the user-service status code for that user.
+    fetch_invalidations(since) returns (user_ids, last_seq, reset) from the
+    user-service invalidation feed and is polled at most once per interval.
+    """
+
+    def __init__(self, fetch, fetch_invalidations=None, size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL,
+                 negative_ttl=USER_CACHE_NEGATIVE_TTL, invalidation_interval=USER_CACHE_INVALIDATION_INTERVAL):
+        self.fetch = fetch
+        self.fetch_invalidations = fetch_invalidations
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.invalidation_interval = invalidation_interval
+        self._entries = OrderedDict()  # user_id -> (status, expires_at)
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._last_seq = None
+        self._last_sync = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(str(user_id), None)
+
+    def _sync_due(self):
+        return self.fetch_invalidations is not None and time.monotonic() - self._last_sync >= self.invalidation_interval
+
+    def _apply_invalidations(self, user_ids, last_seq, reset):
+        if reset or self._last_seq is None:
+            self.invalidate()
+        for user_id in user_ids:
+            self.invalidate(user_id)
+        _count(_invalidations_counter, len(user_ids))
+        self._last_seq = last_seq
+
+    # Return the cached status for key, or None on a miss
+    def _cached(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    _count(_hits_counter)
+                    return entry[0]
+                del self._entries[key]
+        _count(_misses_counter)
+        return None
+
+    def _store(self, key, status):
+        if status not in CACHEABLE_STATUSES:
+            return
+        ttl = self.ttl if status == 200 else self.negative_ttl
+        with self._lock:
+            self._entries[key] = (status, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def sync_invalidations(self):
+        if not self._sync_due():
+            return
+        # One thread polls the feed; the rest keep serving from the cache
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            self._apply_invalidations(*self.fetch_invalidations(self._last_seq))
+        except Exception as error:
+            # Entries still expire by TTL, so a failed poll only delays invalidation up to that bound
+            logger.error("Error polling user invalidations: %s", error)
+        finally:
+            self._last_sync = time.monotonic()
+            self._sync_lock.release()
+
+    def status(self, user_id):
+        self.sync_invalidations()
+        key = str(user_id)
+        status = self._cached(key)
+        if status is not None:
+            return status
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            # Another request is already asking user-service about this user
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.status
+
+        try:
+            flight.status = self.fetch(user_id)
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            self._store(key, flight.status)
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+        return flight.status
+
+
+class AsyncUserCache(UserCache):
+    """UserCache for asyncio code: fetch and fetch_invalidations are coroutines."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._syncing = False
+
+    async def sync_invalidations(self):
+        if not self._sync_due() or self._syncing:
+            return
+        self._syncing = True
+        try:
+            self._apply_invalidations(*await self.fetch_invalidations(self._last_seq))
+        except Exception as error:
+            logger.error("Error polling user invalidations: %s", error)
+        finally:
+            self._last_sync = time.monotonic()
+            self._syncing = False
+
+    async def status(self, user_id):
+        await self.sync_invalidations()
+        key = str(user_id)
+        status = self._cached(key)
+        if status is not None:
+            return status
+
+        flight = self._flights.get(key)
+        if flight is not None:
+            # shield() keeps one cancelled waiter from cancelling the shared lookup
+            return await asyncio.shield(flight)
+
+        flight = self._flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            status = await self.fetch(user_id)
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except Exception as error:
+            flight.set_exception(error)
+            flight.exception()  # Mark as retrieved when no one else is waiting
+            raise
+        finally:
+            self._flights.pop(key, None)
+        self._store(key, status)
+        flight.set_result(status)
+        return status
+
+
+# Cache metrics, registered on the service's metrics registry by bind_metrics()
+_hits_counter = None
+_misses_counter = None
+_invalidations_counter = None
+
+
+def _count(counter, amount=1):
+    if counter is not None and amount:
+        counter.inc(amount)
+
+
+def bind_metrics(registry):
+    global _hits_counter, _misses_counter, _invalidations_counter
+    _hits_counter = Counter('user_cache_hits', 'User lookups answered from the local cache', registry=registry)
+    _misses_counter = Counter('user_cache_misses', 'User lookups that had to call user-service', registry=registry)
+    _invalidations_counter = Counter('user_cache_invalidations', 'Cached users evicted by the invalidation feed',
+                                     registry=registry)
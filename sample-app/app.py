@@ -1,53 +1,90 @@
+import logging
 import os
 import time
 import mysql.connector
 from flask import Flask, request, jsonify
-import requests
 from prometheus_flask_exporter import PrometheusMetrics
 
+import auth
+import instrumentation
+import logs
+import tracing
+import upstream
+import user_assertion
+import user_cache
+from upstream_cache import RevalidatingCache
+from user_cache import UserCache
+
 # Import OpenTelemetry modules
 from opentelemetry import trace
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.flask import FlaskInstrumentor
 from opentelemetry.instrumentation.requests import RequestsInstrumentor
 
 app = Flask(__name__)
 metrics = PrometheusMetrics(app)
+instrumentation.bind_metrics(metrics.registry)
+tracing.bind_metrics(metrics.registry)
+logs.bind_metrics(metrics.registry)
+auth.bind_metrics(metrics.registry)
+upstream.bind_metrics(metrics.registry)
+user_cache.bind_metrics(metrics.registry)
 
-# Configure tracing
-resource = Resource.create(attributes={"service.name": "api-gateway-service"}) 
-trace.set_tracer_provider(TracerProvider(resource=resource))
-
-# Configure Jaeger exporter
-jaeger_exporter = OTLPSpanExporter(
-    endpoint="http://simplest-jaeger-collector.observability.svc.cluster.local:4318/v1/traces",  
-)
+# Configure tracing: sampling, export and the per-stage and per-upstream latency histograms (see tracing.py)
+tracing.configure("api-gateway-service")
 
-trace.get_tracer_provider().add_span_processor(
-    BatchSpanProcessor(jaeger_exporter)
-)
+# JSON log lines with trace and span ids (see logs.py)
+logs.configure("api-gateway-service")
 
 # Auto-instrument Flask and requests
 FlaskInstrumentor().instrument_app(app)
+logs.instrument_flask(app)
 RequestsInstrumentor().instrument()
 
 tracer = trace.get_tracer(__name__)
+logger = logging.getLogger(__name__)
+
+# Per-process setup. gunicorn runs this in each worker after fork (see gunicorn.conf.py),
+# since the span exporter's background thread does not survive a fork.
+def init_worker():
+    # Export sampled traces (TRACE_MODE, OTEL_EXPORTER_OTLP_TRACES_ENDPOINT)
+    tracing.start_export()
+    # Write logs from a background thread
+    logs.start()
+
+ORDER_SERVICE_URL = os.environ.get("ORDER_SERVICE_URL", "http://order-app.flask-app.svc.cluster.local:80")
+USER_SERVICE_URL = os.environ.get("USER_SERVICE_URL", "http://user-app.flask-app.svc.cluster.local:80")
+INVENTORY_SERVICE_URL = os.environ.get("INVENTORY_SERVICE_URL", "http://inventory-app.flask-app.svc.cluster.local:80")
+
+# Upstream clients with timeouts, a bulkhead and a circuit breaker each.
+# Creating an order waits on user-service and inventory-service in turn, so it gets a longer read timeout.
+user_service = upstream.Upstream("user-service", USER_SERVICE_URL, "USER_SERVICE")
+order_service = upstream.Upstream("order-service", ORDER_SERVICE_URL, "ORDER_SERVICE", read_timeout=10)
+inventory_service = upstream.Upstream("inventory-service", INVENTORY_SERVICE_URL, "INVENTORY_SERVICE")
 
-ORDER_SERVICE_URL = "http://order-app.flask-app.svc.cluster.local:80"
-USER_SERVICE_URL = "http://user-app.flask-app.svc.cluster.local:80"
-INVENTORY_SERVICE_URL = "http://inventory-app.flask-app.svc.cluster.local:80"
+def fetch_user_status(user_id):
+    return user_service.get(f"/users/{user_id}").status_code
 
-# Very basic authentication for demo purposes
-registered_users = {
-    "user1": "pass1",
-    "user2": "pass2"
-}
+def fetch_user_invalidations(since):
+    params = {'since': since} if since is not None else {}
+    response = user_service.get("/users/invalidations", params=params)
+    response.raise_for_status()
+    data = response.json()
+    return data['user_ids'], data['last_seq'], data['reset']
 
-def authenticate_user(username, password):
-    return username in registered_users and registered_users[username] == password
+# Consistency token the services return after a write (see db.py in each service). Clients
+# get it back from the gateway and send it with their next requests, and it is passed on
+# with their reads, so those see the write even when a database replica serves them.
+CONSISTENCY_HEADER = "X-Consistency-Token"
+
+def consistency_headers(headers):
+    token = headers.get(CONSISTENCY_HEADER)
+    return {CONSISTENCY_HEADER: token} if token else {}
+
+# Read-through cache of user existence checks, kept fresh by user-service's invalidation feed
+verified_users = UserCache(fetch_user_status, fetch_user_invalidations)
+
+# Last inventory catalogue, revalidated against inventory-service's ETag on every request
+catalogue_cache = RevalidatingCache()
 
 @app.route('/login', methods=['POST'])
 def login():
@@ -56,8 +93,13 @@ def login():
         username = data.get('username')
         password = data.get('password')
 
-        if authenticate_user(username, password):
-            return jsonify({'message': 'Login successful'}), 200
+        if auth.authenticate_user(username, password):
+            body = {'message': 'Login successful'}
+            # Clients send the token as "Authorization: Bearer <token>" instead of their password
+            token = auth.issue_token(username)
+            if token is not None:
+                body.update(access_token=token, token_type='Bearer', expires_in=auth.AUTH_TOKEN_TTL)
+            return jsonify(body), 200
         else:
             return jsonify({'message': 'Invalid credentials'}), 401
 
@@ -68,9 +110,8 @@ def login():
 )
 def place_order():
     with tracer.start_as_current_span("place_order"):
-        # Basic authentication
-        auth = request.authorization
-        if not auth or not authenticate_user(auth.username, auth.password):
+        # Bearer token from /login, or Basic credentials
+        if auth.authenticate_header(request.headers.get('Authorization')) is None:
             return jsonify({'message': 'Authentication required'}), 401
 
         data = request.json
@@ -83,44 +124,116 @@ def place_order():
         # Verify user 
         try:
             with tracer.start_as_current_span("verify_user"):
-                user_response = requests.get(f"{USER_SERVICE_URL}/users/{user_id}")
-                if user_response.status_code != 200:
+                if verified_users.status(user_id) != 200:
                     return jsonify({'message': 'Invalid user'}), 400
-        except requests.exceptions.ConnectionError:
+        except upstream.UNAVAILABLE:
             return jsonify({'message': 'User service unavailable'}), 503
 
+        # Forward the client's Idempotency-Key so order-service can deduplicate retries
+        headers = {}
+        if 'Idempotency-Key' in request.headers:
+            headers['Idempotency-Key'] = request.headers['Idempotency-Key']
+        # Forward Prefer: respond-async, which has order-service queue the order and answer 202
+        if 'Prefer' in request.headers:
+            headers['Prefer'] = request.headers['Prefer']
+        # Vouch for the user just verified, so order-service does not check it again
+        assertion = user_assertion.issue(user_id)
+        if assertion is not None:
+            headers[user_assertion.USER_ASSERTION_HEADER] = assertion
+
         # Create order
         try:
             with tracer.start_as_current_span("create_order"):
-                order_response = requests.post(f"{ORDER_SERVICE_URL}/orders", json={'user_id': user_id, 'items': items})
-                print(f"Order Service Response: {order_response.status_code}, {order_response.text}") # Debugging
+                order_response = order_service.post("/orders", json={'user_id': user_id, 'items': items},
+                                               headers=headers)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Order service response: %s %s", order_response.status_code, order_response.text)
                 if order_response.status_code == 201:
                     order_data = order_response.json()
                     if 'order' in order_data:
-                        return jsonify({'message': 'Order placed successfully', 'order': order_data['order']}), 201
+                        return (jsonify({'message': 'Order placed successfully', 'order': order_data['order']}), 201,
+                                consistency_headers(order_response.headers))
                     else:
                         return jsonify({'message': 'Failed to place order', 'details': 'Order service returned unexpected response format'}), 500
+                elif order_response.status_code == 202:
+                    return order_request_accepted(order_response.json()['request'])
                 else:
                     return jsonify({'message': 'Failed to place order', 'details': order_response.json()}), order_response.status_code
-        except requests.exceptions.ConnectionError:
+        except upstream.UNAVAILABLE:
+            return jsonify({'message': 'Order service unavailable'}), 503
+
+def order_request_accepted(order_request):
+    status_url = f"/place_order/requests/{order_request['id']}"
+    response = jsonify({'message': 'Order accepted', 'request': order_request, 'status_url': status_url})
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
+
+@app.route('/place_order/requests/<int:request_id>', methods=['GET'])
+def get_order_request(request_id):
+    with tracer.start_as_current_span("get_order_request"):
+        # Bearer token from /login, or Basic credentials
+        if auth.authenticate_header(request.headers.get('Authorization')) is None:
+            return jsonify({'message': 'Authentication required'}), 401
+
+        try:
+            with tracer.start_as_current_span("fetch_order_request"):
+                status_response = order_service.get(f"/orders/requests/{request_id}")
+                response = jsonify(status_response.json())
+                response.status_code = status_response.status_code
+                if 'Retry-After' in status_response.headers:
+                    response.headers['Retry-After'] = status_response.headers['Retry-After']
+                return response
+        except upstream.UNAVAILABLE:
+            return jsonify({'message': 'Order service unavailable'}), 503
+
+@app.route('/place_order/batch', methods=['POST'])
+@metrics.counter(
+    'place_order_batch_requests_total', 'Total number of place_order batch requests',
+    labels={'status': lambda r: r.status_code}
+)
+def place_order_batch():
+    with tracer.start_as_current_span("place_order_batch"):
+        # Bearer token from /login, or Basic credentials
+        if auth.authenticate_header(request.headers.get('Authorization')) is None:
+            return jsonify({'message': 'Authentication required'}), 401
+
+        data = request.json
+        orders = data.get('orders') if data else None
+        if not orders or not isinstance(orders, list):
+            return jsonify({'message': 'Bad Request: a non-empty orders list is required'}), 400
+
+        # Users are verified by order-service in a single query, not once per order here
+        try:
+            with tracer.start_as_current_span("create_orders_batch"):
+                batch_response = order_service.post("/orders/batch", json={'orders': orders})
+                return jsonify(batch_response.json()), batch_response.status_code, consistency_headers(batch_response.headers)
+        except upstream.UNAVAILABLE:
             return jsonify({'message': 'Order service unavailable'}), 503
 
 @app.route('/items', methods=['GET'])
 def get_items():
     with tracer.start_as_current_span("get_items"):
-        # Basic authentication
-        auth = request.authorization
-        if not auth or not authenticate_user(auth.username, auth.password):
+        # Bearer token from /login, or Basic credentials
+        if auth.authenticate_header(request.headers.get('Authorization')) is None:
             return jsonify({'message': 'Authentication required'}), 401
 
         try:
             with tracer.start_as_current_span("get_inventory"):
-                inventory_response = requests.get(f"{INVENTORY_SERVICE_URL}/items")
-                if inventory_response.status_code == 200:
-                    return jsonify(inventory_response.json()), 200
+                inventory_response = inventory_service.get("/items", headers={**catalogue_cache.request_headers(),
+                                                                              **consistency_headers(request.headers)})
+                cached = catalogue_cache.update(inventory_response.status_code, inventory_response.headers.get('ETag'),
+                                                inventory_response.content)
+                if cached is not None:
+                    etag, body = cached
+                    response = app.response_class(body, mimetype='application/json')
+                    if etag:
+                        response.headers['ETag'] = etag
+                        response.headers['Cache-Control'] = 'no-cache'
+                    return response.make_conditional(request)
                 else:
                     return jsonify({'message': 'Failed to retrieve items', 'details': inventory_response.json()}), inventory_response.status_code
-        except requests.exceptions.ConnectionError:
+        except upstream.UNAVAILABLE:
             return jsonify({'message': 'Inventory service unavailable'}), 503
 
 @app.route('/')
@@ -142,4 +255,5 @@ def slow_endpoint():
     return jsonify({'message': 'Slow response'}), 200
 
 if __name__ == '__main__':
+    init_worker()
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
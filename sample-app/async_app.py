@@ -0,0 +1,364 @@
+# asyncio version of the API gateway in app.py, with the same routes and responses.
+# Every upstream call goes through one keep-alive connection pool per worker, so a
+# worker can hold many in-flight requests instead of one thread per request.
+#
+# Run with:
+#   GUNICORN_APP=async_app:app GUNICORN_WORKER_CLASS=aiohttp.GunicornWebWorker gunicorn
+# or locally with `python async_app.py`.
+import asyncio
+import os
+
+import aiohttp
+from aiohttp import web
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, PlatformCollector,
+                               ProcessCollector, generate_latest, multiprocess)
+
+import auth
+import instrumentation
+import logs
+import tracing
+import upstream
+import user_assertion
+import user_cache
+from upstream_cache import RevalidatingCache
+from user_cache import AsyncUserCache
+
+# Import OpenTelemetry modules
+from opentelemetry import trace
+from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
+from opentelemetry.instrumentation.aiohttp_server import AioHttpServerInstrumentor
+
+# Configure tracing: sampling, export and the per-stage and per-upstream latency histograms (see tracing.py)
+tracing.configure("api-gateway-service")
+
+# JSON log lines with trace and span ids (see logs.py)
+logs.configure("api-gateway-service")
+
+# Auto-instrument aiohttp server and client
+AioHttpServerInstrumentor().instrument()
+AioHttpClientInstrumentor().instrument()
+
+tracer = trace.get_tracer(__name__)
+
+
+# Per-process setup. gunicorn runs this in each worker after fork (see gunicorn.conf.py),
+# since the span exporter's background thread does not survive a fork.
+def init_worker():
+    # Export sampled traces (TRACE_MODE, OTEL_EXPORTER_OTLP_TRACES_ENDPOINT)
+    tracing.start_export()
+    # Write logs from a background thread
+    logs.start()
+
+
+ORDER_SERVICE_URL = os.environ.get("ORDER_SERVICE_URL", "http://order-app.flask-app.svc.cluster.local:80")
+USER_SERVICE_URL = os.environ.get("USER_SERVICE_URL", "http://user-app.flask-app.svc.cluster.local:80")
+INVENTORY_SERVICE_URL = os.environ.get("INVENTORY_SERVICE_URL", "http://inventory-app.flask-app.svc.cluster.local:80")
+
+# Upstream connection pool configuration
+UPSTREAM_CONNECTION_LIMIT = int(os.environ.get("UPSTREAM_CONNECTION_LIMIT", "200"))  # Across all upstreams
+UPSTREAM_CONNECTION_LIMIT_PER_HOST = int(os.environ.get("UPSTREAM_CONNECTION_LIMIT_PER_HOST", "50"))
+UPSTREAM_KEEPALIVE_TIMEOUT = float(os.environ.get("UPSTREAM_KEEPALIVE_TIMEOUT", "30"))
+
+# Timeouts and a circuit breaker per upstream, as in app.py
+USER_SERVICE = upstream.AsyncUpstream("user-service", USER_SERVICE_URL, "USER_SERVICE")
+ORDER_SERVICE = upstream.AsyncUpstream("order-service", ORDER_SERVICE_URL, "ORDER_SERVICE", read_timeout=10)
+INVENTORY_SERVICE = upstream.AsyncUpstream("inventory-service", INVENTORY_SERVICE_URL, "INVENTORY_SERVICE")
+UPSTREAM_UNAVAILABLE = (aiohttp.ClientConnectionError, asyncio.TimeoutError, upstream.UpstreamUnavailable)
+
+# Metrics served on /metrics
+registry = CollectorRegistry()
+ProcessCollector(registry=registry)
+PlatformCollector(registry=registry)
+instrumentation.bind_metrics(registry)
+tracing.bind_metrics(registry)
+logs.bind_metrics(registry)
+auth.bind_metrics(registry)
+upstream.bind_metrics(registry)
+user_cache.bind_metrics(registry)
+place_order_counter = Counter('place_order_requests', 'Total number of place_order requests', ['status'],
+                              registry=registry)
+place_order_batch_counter = Counter('place_order_batch_requests', 'Total number of place_order batch requests',
+                                    ['status'], registry=registry)
+
+HTTP_SESSION = web.AppKey("http_session", aiohttp.ClientSession)
+VERIFIED_USERS = web.AppKey("verified_users", AsyncUserCache)
+CATALOGUE_CACHE = web.AppKey("catalogue_cache", RevalidatingCache)
+
+# Consistency token the services return after a write (see db.py in each service). Clients
+# get it back from the gateway and send it with their next requests, and it is passed on
+# with their reads, so those see the write even when a database replica serves them.
+CONSISTENCY_HEADER = "X-Consistency-Token"
+
+
+def consistency_headers(headers):
+    token = headers.get(CONSISTENCY_HEADER)
+    return {CONSISTENCY_HEADER: token} if token else {}
+
+
+def json_response(body, status=200, headers=None):
+    return web.json_response(body, status=status, headers=headers)
+
+
+# Hashing a password would stall the event loop, so Basic credentials that are not
+# already cached are checked on the default executor
+async def authenticate_user(username, password):
+    return await asyncio.get_running_loop().run_in_executor(None, auth.authenticate_user, username, password)
+
+
+async def is_authenticated(request):
+    header = request.headers.get('Authorization')
+    basic = auth.basic_credentials(header)
+    if basic is None:
+        return auth.authenticate_header(header) is not None
+    return auth.recently_verified(*basic) or await authenticate_user(*basic)
+
+
+# Serve a cached upstream JSON body, or a 304 if the client already holds this ETag
+def conditional_response(request, etag, body):
+    if not etag:
+        return web.Response(body=body, content_type='application/json')
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if any(f'"{tag.value}"' == etag or tag.value == '*' for tag in request.if_none_match or ()):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type='application/json', headers=headers)
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def upstream_json(response):
+    try:
+        return await response.json(content_type=None)
+    except ValueError:
+        return {'message': await response.text()}
+
+
+async def login(request):
+    with tracer.start_as_current_span("login"):
+        data = await read_json(request) or {}
+        username = data.get('username')
+        if await authenticate_user(username, data.get('password')):
+            body = {'message': 'Login successful'}
+            token = auth.issue_token(username)
+            if token is not None:
+                body.update(access_token=token, token_type='Bearer', expires_in=auth.AUTH_TOKEN_TTL)
+            return json_response(body)
+        return json_response({'message': 'Invalid credentials'}, 401)
+
+
+async def place_order(request):
+    response = await _place_order(request)
+    place_order_counter.labels(status=response.status).inc()
+    return response
+
+
+async def _place_order(request):
+    with tracer.start_as_current_span("place_order"):
+        if not await is_authenticated(request):
+            return json_response({'message': 'Authentication required'}, 401)
+
+        data = await read_json(request) or {}
+        user_id = data.get('user_id')
+        items = data.get('items')
+
+        if not user_id or not items:
+            return json_response({'message': 'Bad Request: user_id and items are required'}, 400)
+
+        session = request.app[HTTP_SESSION]
+
+        # Verify user
+        try:
+            with tracer.start_as_current_span("verify_user"):
+                if await request.app[VERIFIED_USERS].status(user_id) != 200:
+                    return json_response({'message': 'Invalid user'}, 400)
+        except UPSTREAM_UNAVAILABLE:
+            return json_response({'message': 'User service unavailable'}, 503)
+
+        # Forward the client's Idempotency-Key so order-service can deduplicate retries
+        headers = {}
+        if 'Idempotency-Key' in request.headers:
+            headers['Idempotency-Key'] = request.headers['Idempotency-Key']
+        # Forward Prefer: respond-async, which has order-service queue the order and answer 202
+        if 'Prefer' in request.headers:
+            headers['Prefer'] = request.headers['Prefer']
+        # Vouch for the user just verified, so order-service does not check it again
+        assertion = user_assertion.issue(user_id)
+        if assertion is not None:
+            headers[user_assertion.USER_ASSERTION_HEADER] = assertion
+
+        # Create order
+        try:
+            with tracer.start_as_current_span("create_order"):
+                async with ORDER_SERVICE.request(session, 'POST', "/orders", json={'user_id': user_id, 'items': items},
+                                                 headers=headers) as order_response:
+                    order_data = await upstream_json(order_response)
+                    if order_response.status == 201:
+                        if 'order' in order_data:
+                            return json_response({'message': 'Order placed successfully', 'order': order_data['order']}, 201,
+                                                 consistency_headers(order_response.headers))
+                        return json_response({'message': 'Failed to place order', 'details': 'Order service returned unexpected response format'}, 500)
+                    if order_response.status == 202:
+                        return order_request_accepted(order_data['request'])
+                    return json_response({'message': 'Failed to place order', 'details': order_data}, order_response.status)
+        except UPSTREAM_UNAVAILABLE:
+            return json_response({'message': 'Order service unavailable'}, 503)
+
+
+def order_request_accepted(order_request):
+    status_url = f"/place_order/requests/{order_request['id']}"
+    response = json_response({'message': 'Order accepted', 'request': order_request, 'status_url': status_url}, 202)
+    response.headers['Location'] = status_url
+    return response
+
+
+async def get_order_request(request):
+    with tracer.start_as_current_span("get_order_request"):
+        if not await is_authenticated(request):
+            return json_response({'message': 'Authentication required'}, 401)
+
+        try:
+            request_id = int(request.match_info['request_id'])
+            with tracer.start_as_current_span("fetch_order_request"):
+                async with ORDER_SERVICE.request(request.app[HTTP_SESSION], 'GET',
+                                                 f"/orders/requests/{request_id}") as status_response:
+                    response = json_response(await upstream_json(status_response), status_response.status)
+                    if 'Retry-After' in status_response.headers:
+                        response.headers['Retry-After'] = status_response.headers['Retry-After']
+                    return response
+        except UPSTREAM_UNAVAILABLE:
+            return json_response({'message': 'Order service unavailable'}, 503)
+
+
+async def place_order_batch(request):
+    response = await _place_order_batch(request)
+    place_order_batch_counter.labels(status=response.status).inc()
+    return response
+
+
+async def _place_order_batch(request):
+    with tracer.start_as_current_span("place_order_batch"):
+        if not await is_authenticated(request):
+            return json_response({'message': 'Authentication required'}, 401)
+
+        data = await read_json(request)
+        orders = data.get('orders') if data else None
+        if not orders or not isinstance(orders, list):
+            return json_response({'message': 'Bad Request: a non-empty orders list is required'}, 400)
+
+        try:
+            with tracer.start_as_current_span("create_orders_batch"):
+                async with ORDER_SERVICE.request(request.app[HTTP_SESSION], 'POST', "/orders/batch",
+                                                 json={'orders': orders}) as batch_response:
+                    return json_response(await upstream_json(batch_response), batch_response.status,
+                                         consistency_headers(batch_response.headers))
+        except UPSTREAM_UNAVAILABLE:
+            return json_response({'message': 'Order service unavailable'}, 503)
+
+
+async def get_items(request):
+    with tracer.start_as_current_span("get_items"):
+        if not await is_authenticated(request):
+            return json_response({'message': 'Authentication required'}, 401)
+
+        try:
+            with tracer.start_as_current_span("get_inventory"):
+                cache = request.app[CATALOGUE_CACHE]
+                headers = {**cache.request_headers(), **consistency_headers(request.headers)}
+                async with INVENTORY_SERVICE.request(request.app[HTTP_SESSION], 'GET', "/items",
+                                                     headers=headers) as inventory_response:
+                    if inventory_response.status in (200, 304):
+                        body = await inventory_response.read()
+                        cached = cache.update(inventory_response.status, inventory_response.headers.get('ETag'), body)
+                        if cached is not None:
+                            return conditional_response(request, *cached)
+                    inventory_data = await upstream_json(inventory_response)
+                    return json_response({'message': 'Failed to retrieve items', 'details': inventory_data}, inventory_response.status)
+        except UPSTREAM_UNAVAILABLE:
+            return json_response({'message': 'Inventory service unavailable'}, 503)
+
+
+async def index(request):
+    return web.Response(text="Welcome to the Online Store API Gateway!", content_type="text/html")
+
+
+# Health check endpoint
+async def health_check(request):
+    return json_response({'status': 'ok'})
+
+
+async def error_endpoint(request):
+    return json_response({'message': 'Simulated error'}, 500)
+
+
+async def slow_endpoint(request):
+    await asyncio.sleep(2)  # Introduce a 2-second delay without blocking the worker
+    return json_response({'message': 'Slow response'})
+
+
+async def metrics_endpoint(request):
+    scrape_registry = registry
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        # Under gunicorn, report the metrics of every worker (see gunicorn.conf.py)
+        scrape_registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(scrape_registry)
+    return web.Response(body=generate_latest(scrape_registry), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+async def open_http_session(app):
+    connector = aiohttp.TCPConnector(
+        limit=UPSTREAM_CONNECTION_LIMIT,
+        limit_per_host=UPSTREAM_CONNECTION_LIMIT_PER_HOST,
+        keepalive_timeout=UPSTREAM_KEEPALIVE_TIMEOUT,
+    )
+    app[HTTP_SESSION] = aiohttp.ClientSession(connector=connector,
+                                              trace_configs=[instrumentation.upstream_trace_config()])
+
+
+async def close_http_session(app):
+    await app[HTTP_SESSION].close()
+
+
+def create_app():
+    app = web.Application(middlewares=[logs.aiohttp_middleware()])
+
+    async def fetch_user_status(user_id):
+        async with USER_SERVICE.request(app[HTTP_SESSION], 'GET', f"/users/{user_id}") as response:
+            return response.status
+
+    async def fetch_user_invalidations(since):
+        params = {'since': since} if since is not None else {}
+        async with USER_SERVICE.request(app[HTTP_SESSION], 'GET', "/users/invalidations", params=params) as response:
+            response.raise_for_status()
+            data = await response.json()
+            return data['user_ids'], data['last_seq'], data['reset']
+
+    # Read-through cache of user existence checks, kept fresh by user-service's invalidation feed
+    app[VERIFIED_USERS] = AsyncUserCache(fetch_user_status, fetch_user_invalidations)
+    # Last inventory catalogue, revalidated against inventory-service's ETag on every request
+    app[CATALOGUE_CACHE] = RevalidatingCache()
+    app.on_startup.append(open_http_session)
+    app.on_cleanup.append(close_http_session)
+    app.add_routes([
+        web.post('/login', login),
+        web.post('/place_order', place_order),
+        web.post('/place_order/batch', place_order_batch),
+        web.get(r'/place_order/requests/{request_id:\d+}', get_order_request),
+        web.get('/items', get_items),
+        web.get('/', index),
+        web.get('/healthz', health_check),
+        web.get('/error', error_endpoint),
+        web.get('/slow', slow_endpoint),
+        web.get('/metrics', metrics_endpoint),
+    ])
+    return app
+
+
+app = create_app()
+
+if __name__ == '__main__':
+    init_worker()
+    web.run_app(app, host='0.0.0.0', port=5000)
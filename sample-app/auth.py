@@ -0,0 +1,257 @@
+import argparse
+import base64
+import getpass
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+# Gateway authentication. Clients log in once at /login for a signed bearer token, which
+# is verified here with one HMAC and no lookup, or keep sending HTTP Basic credentials,
+# which are checked against slow password hashes and then cached for a short while.
+AUTH_CREDENTIALS_FILE = os.environ.get("AUTH_CREDENTIALS_FILE", "")  # JSON object of username -> password hash
+AUTH_PBKDF2_ITERATIONS = int(os.environ.get("AUTH_PBKDF2_ITERATIONS", "600000"))  # For newly set passwords
+AUTH_TOKEN_SECRET = os.environ.get("AUTH_TOKEN_SECRET", "")  # Unset disables bearer tokens
+AUTH_TOKEN_TTL = int(os.environ.get("AUTH_TOKEN_TTL", "3600"))  # Seconds; tokens cannot be revoked before this
+AUTH_BASIC_CACHE_SIZE = int(os.environ.get("AUTH_BASIC_CACHE_SIZE", "1024"))
+AUTH_BASIC_CACHE_TTL = float(os.environ.get("AUTH_BASIC_CACHE_TTL", "60"))  # How long a changed password still works
+
+HASH_ALGORITHM = "pbkdf2_sha256"
+
+# Demo accounts user1/pass1 and user2/pass2, used when no credentials file is configured
+DEMO_CREDENTIALS = {
+    "user1": "pbkdf2_sha256$600000$e09107423914b8869f67696702df29ef$/i2D0ZYkkG29hd9PSSngOUl7fUWCuG3NwzDty0+f4FQ=",
+    "user2": "pbkdf2_sha256$600000$284c29c410ca19f4f80cf441ee9431fd$dVt3pqMtXp1VlflLhL3GnYErUcP3eUHFI3qwU4oHixQ=",
+}
+
+
+# "pbkdf2_sha256$<iterations>$<salt>$<base64 digest>"
+def hash_password(password, iterations=AUTH_PBKDF2_ITERATIONS):
+    salt = secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), iterations)
+    return f"{HASH_ALGORITHM}${iterations}${salt}${base64.b64encode(digest).decode()}"
+
+
+def check_password(password, encoded):
+    try:
+        algorithm, iterations, salt, expected = encoded.split('$')
+        iterations = int(iterations)
+    except ValueError:
+        return False
+    if algorithm != HASH_ALGORITHM:
+        return False
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), iterations)
+    return hmac.compare_digest(base64.b64encode(digest).decode(), expected)
+
+
+class CredentialStore:
+    """Password hashes by username, kept in a JSON file.
+
+    The file is read once at startup; in Kubernetes it is mounted from the
+    gateway-credentials Secret and built with `python auth.py set-password`.
+    Without a file the demo accounts are used, as before hashing was added.
+    """
+
+    def __init__(self, path=AUTH_CREDENTIALS_FILE, create=False):
+        self.path = path
+        self._hashes = self._load(create)
+
+    def _load(self, create):
+        if not self.path:
+            return dict(DEMO_CREDENTIALS)
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            if create:
+                return {}
+            logger.warning("Credentials file not found, using the demo accounts: %s", self.path)
+            return dict(DEMO_CREDENTIALS)
+
+    def verify(self, username, password):
+        encoded = self._hashes.get(username)
+        if encoded is None:
+            # Unknown users cost a hash too, so response times do not reveal which usernames exist
+            check_password(password, DEMO_CREDENTIALS["user1"])
+            return False
+        return check_password(password, encoded)
+
+    def set_password(self, username, password):
+        self._hashes[username] = hash_password(password)
+        # Written to a temporary file and renamed, so readers never see a partial file
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(self._hashes, f, indent=2, sort_keys=True)
+        os.replace(temporary, self.path)
+
+
+class VerifiedCredentialCache:
+    """Bounded LRU of Basic credentials that recently passed the hash check.
+
+    Entries are keyed by an HMAC of username and password under a per-process
+    random key, so passwords are never kept. Only successes are cached: wrong
+    passwords always pay for the hash.
+    """
+
+    def __init__(self, size=AUTH_BASIC_CACHE_SIZE, ttl=AUTH_BASIC_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._key = secrets.token_bytes(32)
+        self._entries = OrderedDict()  # key -> expires_at
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key_for(self, username, password):
+        return hmac.new(self._key, f"{username}\0{password}".encode(), hashlib.sha256).digest()
+
+    def contains(self, username, password):
+        key = self._key_for(username, password)
+        with self._lock:
+            expires_at = self._entries.get(key)
+            if expires_at is None:
+                return False
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return False
+            self._entries.move_to_end(key)
+            return True
+
+    def add(self, username, password):
+        key = self._key_for(username, password)
+        with self._lock:
+            self._entries[key] = time.monotonic() + self.ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+credentials = CredentialStore()
+verified_credentials = VerifiedCredentialCache()
+
+
+# Whether the credentials passed the hash check recently; cheap enough for an event loop
+def recently_verified(username, password):
+    if verified_credentials.contains(username, password):
+        _checked('basic', 'cached')
+        return True
+    return False
+
+
+def authenticate_user(username, password):
+    if not isinstance(username, str) or not isinstance(password, str):
+        return False
+    if recently_verified(username, password):
+        return True
+    if credentials.verify(username, password):
+        verified_credentials.add(username, password)
+        _checked('basic', 'verified')
+        return True
+    _checked('basic', 'rejected')
+    return False
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _sign(payload):
+    return hmac.new(AUTH_TOKEN_SECRET.encode(), payload.encode(), hashlib.sha256).hexdigest()
+
+
+# "<base64url username>.<expires_at>.<signature>", or None when tokens are disabled
+def issue_token(username):
+    if not AUTH_TOKEN_SECRET:
+        return None
+    payload = f"{_b64encode(username.encode())}.{int(time.time()) + AUTH_TOKEN_TTL}"
+    return f"{payload}.{_sign(payload)}"
+
+
+# The username a token was issued to, or None if it is invalid or expired
+def verify_token(token):
+    if not AUTH_TOKEN_SECRET or not token:
+        return None
+    payload, _, signature = token.rpartition('.')
+    encoded_username, _, expires_at = payload.partition('.')
+    try:
+        expires_at = int(expires_at)
+        if expires_at < time.time() or not hmac.compare_digest(signature.encode(), _sign(payload).encode()):
+            raise ValueError("invalid token")
+        username = base64.urlsafe_b64decode(encoded_username + '=' * (-len(encoded_username) % 4)).decode()
+    except ValueError:  # Also covers bad base64 and UTF-8
+        _checked('bearer', 'rejected')
+        return None
+    _checked('bearer', 'verified')
+    return username
+
+
+# (username, password) from a Basic Authorization header, or None
+def basic_credentials(header):
+    scheme, _, value = (header or '').partition(' ')
+    if scheme.lower() != 'basic':
+        return None
+    try:
+        username, separator, password = base64.b64decode(value.strip(), validate=True).decode().partition(':')
+    except ValueError:
+        return None
+    return (username, password) if separator else None
+
+
+# The user behind an Authorization header, a bearer token or Basic credentials, or None
+def authenticate_header(header):
+    scheme, _, value = (header or '').partition(' ')
+    if scheme.lower() == 'bearer':
+        return verify_token(value.strip())
+    basic = basic_credentials(header)
+    if basic is not None and authenticate_user(*basic):
+        return basic[0]
+    return None
+
+
+# Authentication metrics, registered on the service's metrics registry by bind_metrics()
+_checks_counter = None
+
+
+def _checked(method, result):
+    if _checks_counter is not None:
+        _checks_counter.labels(method=method, result=result).inc()
+
+
+def bind_metrics(registry):
+    global _checks_counter
+    _checks_counter = Counter('gateway_auth_checks', 'Credential checks by method (basic, bearer) and result '
+                              '(cached, verified, rejected)', ['method', 'result'], registry=registry)
+
+
+# Maintain a credentials file: python auth.py set-password USERNAME [--file PATH]
+def main():
+    parser = argparse.ArgumentParser(description="Manage the gateway's credentials file")
+    parser.add_argument("command", choices=["set-password"])
+    parser.add_argument("username")
+    parser.add_argument("--file", default=AUTH_CREDENTIALS_FILE or "credentials.json")
+    args = parser.parse_args()
+
+    store = CredentialStore(args.file, create=True)
+    password = getpass.getpass(f"Password for {args.username}: ")
+    if password != getpass.getpass("Repeat password: "):
+        raise SystemExit("Passwords do not match")
+    store.set_password(args.username, password)
+    print(f"Password set for {args.username} in {args.file}")
+
+
+if __name__ == '__main__':
+    main()
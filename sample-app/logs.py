@@ -0,0 +1,178 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from opentelemetry import trace
+from prometheus_client import Counter
+
+# Logging for every service: one JSON object per line on stdout, carrying the trace and
+# span ids of the request that logged it. Once a worker starts, records are handed to a
+# background thread through a bounded queue, so request threads never wait on stdout;
+# when the queue is full records are dropped and counted rather than blocking.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()  # DEBUG also logs request and response payloads
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# Share of requests whose records below WARNING are kept, per handler, e.g.
+# "create_order=0.1,get_items=0.01". Warnings and errors are always kept.
+LOG_SAMPLE_RATES = {
+    route.strip(): float(rate)
+    for route, _, rate in (entry.partition("=") for entry in os.environ.get("LOG_SAMPLE_RATES", "").split(",") if entry)
+}
+
+# (handler name, whether its low-level records are kept) of the request being served
+_request = contextvars.ContextVar("log_request", default=(None, True))
+_service_name = None
+_handler = None
+_listener = None
+
+# Attributes every LogRecord has; anything else was passed as `extra` and is logged as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "trace_id", "span_id", "route"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'service': _service_name,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in ('route', 'trace_id', 'span_id'):
+            if getattr(record, field, None):
+                entry[field] = getattr(record, field)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+class ContextFilter(logging.Filter):
+    """Drops records of unsampled requests below WARNING and stamps the rest with
+    the route and the current span's ids. Runs on the thread that logged."""
+
+    def filter(self, record):
+        route, sampled = _request.get()
+        if not sampled and record.levelno < logging.WARNING:
+            return False
+        record.route = route
+        context = trace.get_current_span().get_span_context()
+        if context.is_valid:
+            record.trace_id = format(context.trace_id, '032x')
+            record.span_id = format(context.span_id, '016x')
+        return True
+
+
+class _QueueHandler(QueueHandler):
+    # Resolve the message and traceback now, while the arguments still hold what was logged,
+    # and leave the JSON encoding to the listener thread
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _dropped()
+
+
+def _install(handler):
+    global _handler
+    handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    if _handler is not None:
+        root.removeHandler(_handler)
+    root.addHandler(handler)
+    _handler = handler
+
+
+def _stream_handler():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+# Log JSON lines straight to stdout; run at import. Until start() that is synchronous,
+# so nothing queued in the gunicorn master is copied into every worker by fork.
+def configure(service_name):
+    global _service_name
+    _service_name = service_name
+    logging.getLogger().setLevel(LOG_LEVEL)
+    _install(_stream_handler())
+
+
+# Move writing to a background thread; run per process, after fork
+def start():
+    global _listener
+    if _listener is not None:
+        return
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    _listener = QueueListener(records, _stream_handler())
+    _listener.start()
+    _install(_QueueHandler(records))
+    atexit.register(_listener.stop)  # Flushes what is still queued
+
+
+def _decide(route):
+    rate = LOG_SAMPLE_RATES.get(route)
+    return route, rate is None or random.random() < rate
+
+
+# Tag a Flask app's requests with their endpoint and sampling decision
+def instrument_flask(app):
+    from flask import g, request
+
+    @app.before_request
+    def _start_request():
+        g.log_request_token = _request.set(_decide(request.endpoint))
+
+    @app.teardown_request
+    def _end_request(error=None):
+        token = g.pop('log_request_token', None)
+        if token is not None:
+            _request.reset(token)
+
+
+# The same for the aiohttp gateway, as middleware
+def aiohttp_middleware():
+    from aiohttp import web
+
+    @web.middleware
+    async def middleware(request, handler):
+        token = _request.set(_decide(getattr(request.match_info.handler, '__name__', None)))
+        try:
+            return await handler(request)
+        finally:
+            _request.reset(token)
+
+    return middleware
+
+
+# Logging metrics, registered on the service's metrics registry by bind_metrics()
+_dropped_counter = None
+
+
+def _dropped():
+    if _dropped_counter is not None:
+        _dropped_counter.inc()
+
+
+def bind_metrics(registry):
+    global _dropped_counter
+    _dropped_counter = Counter('log_records_dropped', 'Log records dropped because the log queue was full',
+                               registry=registry)
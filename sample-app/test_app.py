@@ -1,6 +1,19 @@
+import threading
+import time
 import unittest
-from unittest.mock import patch
+from unittest.mock import Mock, patch
+from aiohttp.test_utils import AioHTTPTestCase
+import async_app
+import auth
+import json
+import logging
+import logs
+import tracing
+import app as gateway
 from app import app  
+import upstream
+import user_assertion
+from user_cache import UserCache
 
 class TestApp(unittest.TestCase):
     def setUp(self):
@@ -12,5 +25,258 @@ class TestApp(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data.decode(), "Welcome to the Online Store API Gateway!")
 
+    @patch('upstream.requests.get')
+    def test_items_revalidates_cached_catalogue(self, mock_get):
+        gateway.catalogue_cache = gateway.RevalidatingCache()
+        body = b'{"items": [{"id": 1}]}'
+        mock_get.side_effect = [Mock(status_code=200, headers={'ETag': '"v1"'}, content=body),
+                                Mock(status_code=304, headers={'ETag': '"v1"'}, content=b'')]
+        auth = {'Authorization': 'Basic dXNlcjE6cGFzczE='}
+        first = self.app.get('/items', headers=auth)
+        second = self.app.get('/items', headers=auth)
+        self.assertEqual((first.status_code, first.data), (200, body))
+        self.assertEqual((second.status_code, second.data), (200, body))
+        self.assertEqual(mock_get.call_args.kwargs['headers'], {'If-None-Match': '"v1"'})
+
+        mock_get.side_effect = [Mock(status_code=304, headers={'ETag': '"v1"'}, content=b'')]
+        response = self.app.get('/items', headers={**auth, 'If-None-Match': '"v1"'})
+        self.assertEqual(response.status_code, 304)
+
+    @patch('upstream.requests.get')
+    @patch('upstream.requests.post')
+    def test_async_order_is_accepted_and_followed_by_status_url(self, mock_post, mock_get):
+        auth = {'Authorization': 'Basic dXNlcjE6cGFzczE='}
+        queued = {'id': 9, 'status': 'queued'}
+        mock_post.return_value = Mock(status_code=202, json=Mock(return_value={'request': queued}))
+        with patch.object(gateway.verified_users, 'status', return_value=200):
+            response = self.app.post('/place_order', json={'user_id': 1, 'items': [{'item_id': 1, 'quantity': 1}]},
+                                     headers={**auth, 'Prefer': 'respond-async'})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.headers['Location'], '/place_order/requests/9')
+        self.assertEqual(response.get_json()['request'], queued)
+        self.assertEqual(mock_post.call_args.kwargs['headers']['Prefer'], 'respond-async')
+
+        mock_get.return_value = Mock(status_code=200, headers={'Retry-After': '1'},
+                                     json=Mock(return_value={'request': queued}))
+        response = self.app.get('/place_order/requests/9', headers=auth)
+        self.assertEqual((response.status_code, response.headers['Retry-After']), (200, '1'))
+        self.assertTrue(mock_get.call_args.args[0].endswith('/orders/requests/9'))
+        self.assertEqual(self.app.get('/place_order/requests/9').status_code, 401)
+
+    @patch('upstream.requests.get')
+    @patch('upstream.requests.post')
+    def test_consistency_token_is_returned_and_forwarded_with_reads(self, mock_post, mock_get):
+        gateway.catalogue_cache = gateway.RevalidatingCache()
+        auth = {'Authorization': 'Basic dXNlcjE6cGFzczE='}
+        token = 'gtid:3e11fa47-71ca-11e1-9e33-c80aa9429562:1-77'
+        mock_post.return_value = Mock(status_code=201, headers={gateway.CONSISTENCY_HEADER: token},
+                                      json=Mock(return_value={'order': {'id': 1}}))
+        with patch.object(gateway.verified_users, 'status', return_value=200):
+            response = self.app.post('/place_order', json={'user_id': 1, 'items': [{'item_id': 1, 'quantity': 1}]},
+                                     headers=auth)
+        self.assertEqual((response.status_code, response.headers[gateway.CONSISTENCY_HEADER]), (201, token))
+
+        mock_get.return_value = Mock(status_code=200, headers={'ETag': '"v2"'}, content=b'{"items": []}')
+        self.app.get('/items', headers={**auth, gateway.CONSISTENCY_HEADER: token})
+        self.assertEqual(mock_get.call_args.kwargs['headers'], {gateway.CONSISTENCY_HEADER: token})
+        self.app.get('/items', headers=auth)
+        self.assertEqual(mock_get.call_args.kwargs['headers'], {'If-None-Match': '"v2"'})
+
+class TestUserCache(unittest.TestCase):
+    def test_caches_found_and_missing_users(self):
+        calls = []
+        cache = UserCache(lambda user_id: calls.append(user_id) or (200 if user_id == 1 else 404))
+        self.assertEqual(cache.status(1), 200)
+        self.assertEqual(cache.status(1), 200)
+        self.assertEqual(cache.status(2), 404)
+        self.assertEqual(cache.status(2), 404)
+        self.assertEqual(calls, [1, 2])
+
+    def test_does_not_cache_errors_and_evicts_least_recently_used(self):
+        statuses = iter([500, 200, 200, 200])
+        cache = UserCache(lambda user_id: next(statuses), size=1)
+        self.assertEqual(cache.status(1), 500)
+        self.assertEqual(cache.status(1), 200)
+        cache.status(2)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.status(1), 200)
+
+    def test_concurrent_misses_share_one_fetch(self):
+        calls = []
+        def fetch(user_id):
+            calls.append(user_id)
+            time.sleep(0.05)
+            return 200
+        cache = UserCache(fetch)
+        threads = [threading.Thread(target=cache.status, args=(7,)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [7])
+
+    def test_invalidation_feed_evicts_changed_users(self):
+        feed = iter([([], 10, False), ([1], 11, False)])
+        calls = []
+        cache = UserCache(lambda user_id: calls.append(user_id) or 200, lambda since: next(feed),
+                          invalidation_interval=0)
+        cache.status(1)
+        cache.status(1)
+        self.assertEqual(calls, [1, 1])
+
+class TestUpstream(unittest.TestCase):
+    def test_breaker_opens_on_failures_and_closes_after_a_good_trial(self):
+        breaker = upstream.CircuitBreaker('test', window=4, min_calls=4, open_seconds=0.05)
+        for failed in (False, True, True, False):
+            self.assertTrue(breaker.allow())
+            breaker.record(failed, 0.01)
+        self.assertEqual(breaker.state, upstream.OPEN)
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())  # Only one trial call at a time
+        breaker.record(False, 0.01)
+        self.assertEqual(breaker.state, upstream.CLOSED)
+
+    @patch('upstream.time.sleep')
+    @patch('upstream.requests.get')
+    def test_get_is_retried_on_unavailable_upstream(self, mock_get, mock_sleep):
+        mock_get.side_effect = [Mock(status_code=503), Mock(status_code=200)]
+        client = upstream.Upstream('test', 'http://test', 'TEST')
+        self.assertEqual(client.get('/users/1').status_code, 200)
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(mock_get.call_args.kwargs['timeout'], client.timeout)
+
+    @patch('upstream.requests.post')
+    def test_post_is_not_retried_and_open_breaker_fails_fast(self, mock_post):
+        mock_post.return_value = Mock(status_code=503)
+        client = upstream.Upstream('test', 'http://test', 'TEST')
+        client.breaker = upstream.CircuitBreaker('test', min_calls=1)
+        self.assertEqual(client.post('/orders').status_code, 503)
+        self.assertEqual(mock_post.call_count, 1)
+        with self.assertRaises(upstream.UpstreamUnavailable):
+            client.post('/orders')
+        self.assertEqual(mock_post.call_count, 1)
+
+class TestUserAssertion(unittest.TestCase):
+    @patch('user_assertion.USER_ASSERTION_SECRET', 'test-secret')
+    def test_assertion_is_bound_to_user_and_signature(self):
+        assertion = user_assertion.issue(7)
+        self.assertTrue(user_assertion.verify(assertion, 7))
+        self.assertTrue(user_assertion.verify(assertion, '7'))
+        self.assertFalse(user_assertion.verify(assertion, 8))
+        user_id, expires_at, signature = assertion.split('.')
+        self.assertFalse(user_assertion.verify(f"{user_id}.{int(expires_at) + 60}.{signature}", 7))
+        self.assertFalse(user_assertion.verify('not-an-assertion', 7))
+
+    @patch('user_assertion.USER_ASSERTION_SECRET', 'test-secret')
+    def test_expired_assertion_is_rejected(self):
+        with patch('user_assertion.USER_ASSERTION_TTL', -1):
+            assertion = user_assertion.issue(7)
+        self.assertFalse(user_assertion.verify(assertion, 7))
+
+    @patch('user_assertion.USER_ASSERTION_SECRET', '')
+    def test_disabled_without_secret(self):
+        self.assertIsNone(user_assertion.issue(7))
+
+class TestAuth(unittest.TestCase):
+    @patch('auth.AUTH_TOKEN_SECRET', 'test-secret')
+    def test_login_issues_a_token_accepted_as_bearer(self):
+        client = app.test_client()
+        response = client.post('/login', json={'username': 'user2', 'password': 'pass2'})
+        token = response.get_json()['access_token']
+        self.assertEqual(auth.authenticate_header(f'Bearer {token}'), 'user2')
+        payload, signature = token.rsplit('.', 1)
+        self.assertIsNone(auth.verify_token(f"{payload}.{'0' * len(signature)}"))
+        with patch('auth.AUTH_TOKEN_TTL', -1):
+            self.assertIsNone(auth.verify_token(auth.issue_token('user2')))
+        self.assertEqual(client.post('/login', json={'username': 'user2', 'password': 'wrong'}).status_code, 401)
+
+    @patch('auth.credentials')
+    def test_only_verified_basic_credentials_are_cached(self, credentials):
+        auth.verified_credentials.clear()
+        credentials.verify.side_effect = lambda username, password: password == 'pass1'
+        header = 'Basic dXNlcjE6cGFzczE='
+        self.assertEqual(auth.authenticate_header(header), 'user1')
+        self.assertEqual(auth.authenticate_header(header), 'user1')
+        self.assertFalse(auth.authenticate_user('user1', 'wrong'))
+        self.assertFalse(auth.authenticate_user('user1', 'wrong'))
+        self.assertEqual(credentials.verify.call_count, 3)
+
+    def test_passwords_are_stored_hashed(self):
+        encoded = auth.hash_password('secret', iterations=1000)
+        self.assertNotIn('secret', encoded)
+        self.assertTrue(auth.check_password('secret', encoded))
+        self.assertFalse(auth.check_password('Secret', encoded))
+        self.assertTrue(auth.CredentialStore('').verify('user1', 'pass1'))
+
+class TestTracing(unittest.TestCase):
+    def test_unsampled_traces_are_exported_only_when_failed_or_slow(self):
+        from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+        from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+        from opentelemetry.trace import Status, StatusCode
+        exporter = InMemorySpanExporter()
+        provider = tracing.build_provider("test", mode="export", ratio=0)
+        provider.add_span_processor(tracing.TailSamplingProcessor(SimpleSpanProcessor(exporter), keep_errors=True,
+                                                                  slow_threshold=0.05))
+        tracer = provider.get_tracer(__name__)
+        with tracer.start_as_current_span("fast"):
+            with tracer.start_as_current_span("stage"):
+                pass
+        self.assertEqual(exporter.get_finished_spans(), ())
+        with tracer.start_as_current_span("failed"):
+            with tracer.start_as_current_span("stage") as span:
+                span.set_status(Status(StatusCode.ERROR))
+        self.assertEqual([span.name for span in exporter.get_finished_spans()], ["stage", "failed"])
+        self.assertTrue(all(span.context.trace_flags.sampled for span in exporter.get_finished_spans()))
+        exporter.clear()
+        with tracer.start_as_current_span("slow"):
+            time.sleep(0.06)
+        self.assertEqual([span.name for span in exporter.get_finished_spans()], ["slow"])
+
+class TestLogs(unittest.TestCase):
+    def test_records_carry_trace_ids_and_unsampled_routes_keep_only_warnings(self):
+        from opentelemetry import trace
+        tracer = trace.get_tracer(__name__)
+        context_filter = logs.ContextFilter()
+        record = logging.LogRecord('test', logging.INFO, __file__, 1, 'order %s', (7,), None)
+        with tracer.start_as_current_span('stage') as span:
+            self.assertTrue(context_filter.filter(record))
+        entry = json.loads(logs.JsonFormatter().format(record))
+        self.assertEqual(entry['message'], 'order 7')
+        self.assertEqual(entry['trace_id'], format(span.get_span_context().trace_id, '032x'))
+
+        with patch.dict(logs.LOG_SAMPLE_RATES, {'place_order': 0}):
+            token = logs._request.set(logs._decide('place_order'))
+            try:
+                self.assertFalse(context_filter.filter(logging.LogRecord('test', logging.INFO, __file__, 1, 'x', None, None)))
+                self.assertTrue(context_filter.filter(logging.LogRecord('test', logging.ERROR, __file__, 1, 'x', None, None)))
+            finally:
+                logs._request.reset(token)
+
+class TestAsyncApp(AioHTTPTestCase):
+    async def get_application(self):
+        return async_app.create_app()
+
+    async def test_hello(self):
+        response = await self.client.get('/')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.text(), "Welcome to the Online Store API Gateway!")
+
+    async def test_items_requires_authentication(self):
+        response = await self.client.get('/items')
+        self.assertEqual(response.status, 401)
+        self.assertEqual(await response.json(), {'message': 'Authentication required'})
+
+    async def test_place_order_rejects_unknown_user(self):
+        async def fetch_user_status(user_id):
+            return 404
+        self.app[async_app.VERIFIED_USERS].fetch = fetch_user_status
+        self.app[async_app.VERIFIED_USERS].fetch_invalidations = None
+        response = await self.client.post('/place_order', json={'user_id': 5, 'items': [{'item_id': 1, 'quantity': 1}]},
+                                          auth=async_app.aiohttp.BasicAuth('user1', 'pass1'))
+        self.assertEqual(response.status, 400)
+        self.assertEqual(await response.json(), {'message': 'Invalid user'})
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
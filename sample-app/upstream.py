@@ -0,0 +1,276 @@
+import asyncio
+import contextlib
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from prometheus_client import Counter, Gauge
+
+# Defaults for every upstream. Timeouts and the bulkhead size can also be set per
+# upstream with its env prefix, e.g. USER_SERVICE_READ_TIMEOUT=2.
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", "1"))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", "5"))
+# Concurrent calls to one upstream per worker; by default one gunicorn thread is always left for the others
+UPSTREAM_MAX_CONCURRENT = int(os.environ.get("UPSTREAM_MAX_CONCURRENT",
+                                             max(1, int(os.environ.get("GUNICORN_THREADS", "4")) - 1)))
+UPSTREAM_BULKHEAD_WAIT = float(os.environ.get("UPSTREAM_BULKHEAD_WAIT", "1"))  # Seconds to wait for a free slot
+
+# Circuit breaker configuration
+UPSTREAM_BREAKER_WINDOW = int(os.environ.get("UPSTREAM_BREAKER_WINDOW", "20"))  # Most recent calls considered
+UPSTREAM_BREAKER_MIN_CALLS = int(os.environ.get("UPSTREAM_BREAKER_MIN_CALLS", "10"))
+UPSTREAM_BREAKER_FAILURE_RATE = float(os.environ.get("UPSTREAM_BREAKER_FAILURE_RATE", "0.5"))
+UPSTREAM_BREAKER_SLOW_CALL_RATE = float(os.environ.get("UPSTREAM_BREAKER_SLOW_CALL_RATE", "0.8"))
+UPSTREAM_SLOW_CALL_SECONDS = float(os.environ.get("UPSTREAM_SLOW_CALL_SECONDS", "2"))
+UPSTREAM_BREAKER_OPEN_SECONDS = float(os.environ.get("UPSTREAM_BREAKER_OPEN_SECONDS", "10"))
+
+# Retries, for GETs only
+UPSTREAM_GET_RETRIES = int(os.environ.get("UPSTREAM_GET_RETRIES", "2"))
+UPSTREAM_RETRY_BACKOFF = float(os.environ.get("UPSTREAM_RETRY_BACKOFF", "0.05"))  # Base delay in seconds
+UPSTREAM_RETRY_BACKOFF_MAX = float(os.environ.get("UPSTREAM_RETRY_BACKOFF_MAX", "1"))
+RETRYABLE_STATUSES = (502, 503, 504)
+
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+# What callers catch to answer 503: refused or reset connections, timeouts and rejections below
+UNAVAILABLE = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+class UpstreamUnavailable(requests.exceptions.ConnectionError):
+    """Raised without calling the upstream, because its breaker is open or its bulkhead is full."""
+
+
+def backoff(attempt):
+    # Full jitter, so retries from many workers do not arrive together
+    return random.uniform(0, min(UPSTREAM_RETRY_BACKOFF_MAX, UPSTREAM_RETRY_BACKOFF * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Per-process circuit breaker for one upstream.
+
+    Opens when enough of the last calls failed (connection errors, timeouts, 5xx)
+    or were slow, rejects calls while open, and after open_seconds lets a single
+    trial call through: success closes it again, failure re-opens it.
+    """
+
+    def __init__(self, name, window=UPSTREAM_BREAKER_WINDOW, min_calls=UPSTREAM_BREAKER_MIN_CALLS,
+                 failure_rate=UPSTREAM_BREAKER_FAILURE_RATE, slow_call_rate=UPSTREAM_BREAKER_SLOW_CALL_RATE,
+                 slow_call_seconds=UPSTREAM_SLOW_CALL_SECONDS, open_seconds=UPSTREAM_BREAKER_OPEN_SECONDS):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=window)  # (failed, slow)
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+        _set_state(name, CLOSED)
+
+    def _set(self, state):
+        self.state = state
+        _set_state(self.name, state)
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self._set(OPEN)
+
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    return False
+                self._set(HALF_OPEN)
+            if self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record(self, failed, seconds):
+        slow = seconds >= self.slow_call_seconds
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trial_running = False
+                if failed or slow:
+                    self._open()
+                else:
+                    self._set(CLOSED)
+            elif self.state == CLOSED:
+                self._outcomes.append((failed, slow))
+                calls = len(self._outcomes)
+                if calls >= self.min_calls:
+                    failures = sum(1 for failed, _ in self._outcomes if failed)
+                    slow_calls = sum(1 for _, slow in self._outcomes if slow)
+                    if failures >= calls * self.failure_rate or slow_calls >= calls * self.slow_call_rate:
+                        self._open()
+
+    # The call ended without an answer either way, e.g. it was cancelled
+    def abandon(self):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trial_running = False
+
+
+class Upstream:
+    """Client for one upstream service: timeouts, a bulkhead and a circuit breaker.
+
+    Every call is bounded by (connect, read) timeouts and waits at most
+    UPSTREAM_BULKHEAD_WAIT for one of max_concurrent slots, so a slow upstream
+    can pin only part of a worker's threads. Calls rejected by the bulkhead or
+    an open breaker raise UpstreamUnavailable. GETs are retried with jittered
+    backoff; other methods are never retried, since they may have taken effect.
+    """
+
+    def __init__(self, name, base_url, env_prefix, connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+                 read_timeout=UPSTREAM_READ_TIMEOUT, max_concurrent=UPSTREAM_MAX_CONCURRENT):
+        self.name = name
+        self.base_url = base_url
+        self.timeout = (float(os.environ.get(f"{env_prefix}_CONNECT_TIMEOUT", connect_timeout)),
+                        float(os.environ.get(f"{env_prefix}_READ_TIMEOUT", read_timeout)))
+        self.max_concurrent = int(os.environ.get(f"{env_prefix}_MAX_CONCURRENT", max_concurrent))
+        self.breaker = CircuitBreaker(name)
+        self._bulkhead = threading.BoundedSemaphore(self.max_concurrent)
+
+    def get(self, path, **kwargs):
+        for attempt in range(UPSTREAM_GET_RETRIES + 1):
+            last_attempt = attempt == UPSTREAM_GET_RETRIES
+            try:
+                response = self._call(requests.get, path, kwargs)
+            except UpstreamUnavailable:
+                raise
+            except UNAVAILABLE:
+                if last_attempt:
+                    raise
+            else:
+                if last_attempt or response.status_code not in RETRYABLE_STATUSES:
+                    return response
+            _retried(self.name)
+            time.sleep(backoff(attempt))
+
+    def post(self, path, **kwargs):
+        return self._call(requests.post, path, kwargs)
+
+    def _call(self, send, path, kwargs):
+        if not self._bulkhead.acquire(timeout=UPSTREAM_BULKHEAD_WAIT):
+            _reject(self.name, 'bulkhead_full')
+            raise UpstreamUnavailable(f"{self.name}: too many concurrent calls")
+        try:
+            if not self.breaker.allow():
+                _reject(self.name, 'circuit_open')
+                raise UpstreamUnavailable(f"{self.name}: circuit open")
+            start = time.monotonic()
+            failed = True
+            try:
+                response = send(self.base_url + path, timeout=self.timeout, **kwargs)
+                failed = response.status_code >= 500
+                return response
+            finally:
+                self.breaker.record(failed, time.monotonic() - start)
+        finally:
+            self._bulkhead.release()
+
+
+class AsyncUpstream:
+    """Upstream for the asyncio gateway, with the same timeouts, breaker and GET retries.
+
+    The bulkhead is the aiohttp connector's per-host connection limit: waiting for
+    one of its connections counts against the connect timeout, which is extended
+    by UPSTREAM_BULKHEAD_WAIT for that.
+    """
+
+    def __init__(self, name, base_url, env_prefix, connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+                 read_timeout=UPSTREAM_READ_TIMEOUT):
+        import aiohttp
+
+        self.name = name
+        self.base_url = base_url
+        connect_timeout = float(os.environ.get(f"{env_prefix}_CONNECT_TIMEOUT", connect_timeout))
+        read_timeout = float(os.environ.get(f"{env_prefix}_READ_TIMEOUT", read_timeout))
+        self.timeout = aiohttp.ClientTimeout(connect=connect_timeout + UPSTREAM_BULKHEAD_WAIT,
+                                             sock_connect=connect_timeout, sock_read=read_timeout)
+        self.breaker = CircuitBreaker(name)
+
+    @contextlib.asynccontextmanager
+    async def request(self, session, method, path, **kwargs):
+        import aiohttp
+
+        errors = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+        retries = UPSTREAM_GET_RETRIES if method == 'GET' else 0
+        for attempt in range(retries + 1):
+            last_attempt = attempt == retries
+            if not self.breaker.allow():
+                _reject(self.name, 'circuit_open')
+                raise UpstreamUnavailable(f"{self.name}: circuit open")
+            start = time.monotonic()
+            try:
+                response = await session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+            except errors:
+                self.breaker.record(True, time.monotonic() - start)
+                if last_attempt:
+                    raise
+            except BaseException:
+                self.breaker.abandon()
+                raise
+            else:
+                if last_attempt or response.status not in RETRYABLE_STATUSES:
+                    break
+                response.release()
+                self.breaker.record(True, time.monotonic() - start)
+            _retried(self.name)
+            await asyncio.sleep(backoff(attempt))
+
+        failed = response.status >= 500
+        try:
+            yield response
+        except errors:
+            failed = True
+            raise
+        except BaseException:
+            if not failed:
+                failed = None  # The caller's own error, not the upstream's
+            raise
+        finally:
+            response.release()
+            if failed is None:
+                self.breaker.abandon()
+            else:
+                self.breaker.record(failed, time.monotonic() - start)
+
+
+# Resilience metrics, registered on the service's metrics registry by bind_metrics()
+_state_gauge = None
+_rejections_counter = None
+_retries_counter = None
+
+
+def _retried(upstream):
+    if _retries_counter is not None:
+        _retries_counter.labels(upstream=upstream).inc()
+
+
+def _set_state(upstream, state):
+    if _state_gauge is not None:
+        _state_gauge.labels(upstream=upstream).set(state)
+
+
+def _reject(upstream, reason):
+    if _rejections_counter is not None:
+        _rejections_counter.labels(upstream=upstream, reason=reason).inc()
+
+
+def bind_metrics(registry):
+    global _state_gauge, _rejections_counter, _retries_counter
+    # Breakers are per worker; across workers the worst state is reported
+    _state_gauge = Gauge('upstream_circuit_state', 'Circuit breaker state per upstream (0 closed, 1 half-open, 2 open)',
+                         ['upstream'], multiprocess_mode='livemax', registry=registry)
+    _rejections_counter = Counter('upstream_rejections', 'Upstream calls rejected without being sent',
+                                  ['upstream', 'reason'], registry=registry)
+    _retries_counter = Counter('upstream_retries', 'GET requests to an upstream that were retried',
+                               ['upstream'], registry=registry)
@@ -0,0 +1,33 @@
+import threading
+
+
+class RevalidatingCache:
+    """Last 200 body and ETag received from one upstream URL.
+
+    Requests send the cached ETag as If-None-Match; a 304 from upstream means the
+    cached body is still current, so only headers cross the network.
+    """
+
+    def __init__(self):
+        self._entry = None  # (etag, body)
+        self._lock = threading.Lock()
+
+    @property
+    def etag(self):
+        entry = self._entry
+        return entry[0] if entry else None
+
+    def request_headers(self):
+        entry = self._entry
+        return {'If-None-Match': entry[0]} if entry else {}
+
+    # Given an upstream response, return (etag, body) to serve, or None if it was not a usable success
+    def update(self, status, etag, body):
+        if status == 304:
+            return self._entry
+        if status != 200:
+            return None
+        if etag:
+            with self._lock:
+                self._entry = (etag, body)
+        return etag, body
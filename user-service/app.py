@@ -1,105 +1,91 @@
+import logging
 import os
 import mysql.connector
+from mysql.connector import errorcode
 from flask import Flask, request, jsonify
 from prometheus_flask_exporter import PrometheusMetrics
 
+import db
+import instrumentation
+import logs
+import tracing
+import updates
+from db import get_db_connection, get_read_connection, inserted_ids
+from streaming import query_row_chunks, record_chunks, request_records, stream_records, wants_stream
+
 # Import OpenTelemetry modules
 from opentelemetry import trace
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.flask import FlaskInstrumentor
 from opentelemetry.instrumentation.requests import RequestsInstrumentor
 
 app = Flask(__name__)
 metrics = PrometheusMetrics(app)
+db.bind_metrics(metrics.registry)
+instrumentation.bind_metrics(metrics.registry)
+tracing.bind_metrics(metrics.registry)
+logs.bind_metrics(metrics.registry)
 
-# Configure tracing
-resource = Resource.create(attributes={"service.name": "user-service"})  
-trace.set_tracer_provider(TracerProvider(resource=resource))
-
-# Configure Jaeger exporter
-jaeger_exporter = OTLPSpanExporter(
-    endpoint="http://simplest-jaeger-collector.observability.svc.cluster.local:4318/v1/traces",  
-)
+# Configure tracing: sampling, export and the per-stage and per-upstream latency histograms (see tracing.py)
+tracing.configure("user-service")
 
-trace.get_tracer_provider().add_span_processor(
-    BatchSpanProcessor(jaeger_exporter)
-)
+# JSON log lines with trace and span ids (see logs.py)
+logs.configure("user-service")
 
 # Auto-instrument Flask and requests
 FlaskInstrumentor().instrument_app(app)
+logs.instrument_flask(app)
+# Consistency tokens for reads from replicas (see db.py)
+db.instrument_flask(app)
 RequestsInstrumentor().instrument()
 
 tracer = trace.get_tracer(__name__)
+logger = logging.getLogger(__name__)
 
-# Database configuration from environment variables
-DB_HOST = os.environ.get("DB_HOST")
-DB_PORT = os.environ.get("DB_PORT", "3306")  # Default MySQL port
-DB_NAME = os.environ.get("DB_NAME")
-DB_USER = os.environ.get("DB_USER")
-DB_PASSWORD = os.environ.get("DB_PASSWORD")
+# Per-process setup. gunicorn runs this in each worker after fork (see gunicorn.conf.py),
+# since the span exporter's background thread and DB connections do not survive a fork.
+def init_worker():
+    # Export sampled traces (TRACE_MODE, OTEL_EXPORTER_OTLP_TRACES_ENDPOINT)
+    tracing.start_export()
+    # Write logs from a background thread
+    logs.start()
 
-def get_db_connection():
-    conn = None
-    try:
-        conn = mysql.connector.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-    except mysql.connector.Error as error:
-        print("Error connecting to database:", error)
-    return conn
-
-# Create users table if it doesn't exist
-def create_table():
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                name VARCHAR(255) NOT NULL,
-                email VARCHAR(255) NOT NULL UNIQUE
-            )
-        ''')
-        conn.commit()
-        cursor.close()
-    except mysql.connector.Error as error:
-        print("Error creating table:", error)
-    finally:
-        if conn is not None and conn.is_connected():
-            conn.close()
+USER_INVALIDATION_RETENTION = int(os.environ.get("USER_INVALIDATION_RETENTION", "3600"))  # Seconds of feed history kept
+USER_INVALIDATION_BATCH = 1000
+USER_INVALIDATION_SETTLE = float(os.environ.get("USER_INVALIDATION_SETTLE", "1"))  # Seconds a gap in the sequence may be a running transaction
 
-create_table()
+# Record a changed user in the invalidation feed, inside the caller's transaction
+def publish_invalidation(cursor, user_id):
+    cursor.execute("INSERT INTO user_invalidations (user_id) VALUES (%s)", (user_id,))
+    cursor.execute("DELETE FROM user_invalidations WHERE created_at < NOW() - INTERVAL %s SECOND LIMIT 100",
+                   (USER_INVALIDATION_RETENTION,))
 
 @app.route('/users', methods=['POST'])
 def create_user():
     with tracer.start_as_current_span("create_user"):
+        data = request.json
+        if not data or 'name' not in data or 'email' not in data:
+            return jsonify({'message': 'Bad Request: name and email are required'}), 400
         conn = get_db_connection()
         if conn is not None:
             cursor = conn.cursor()
-            data = request.json
-            if not data or 'name' not in data or 'email' not in data:
-                return jsonify({'message': 'Bad Request: name and email are required'}), 400
             try:
                 cursor.execute("INSERT INTO users (name, email) VALUES (%s, %s)", (data['name'], data['email']))
                 conn.commit()
-                user_id = cursor.lastrowid
-                cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-                user = cursor.fetchone()
+                # The row holds exactly what was inserted, so it is not read back
                 user_data = {
-                    'id': user[0],
-                    'name': user[1],
-                    'email': user[2]
+                    'id': cursor.lastrowid,
+                    'name': data['name'],
+                    'email': data['email']
                 }
                 return jsonify({'message': 'User created successfully', 'user': user_data}), 201
+            except mysql.connector.IntegrityError as error:
+                conn.rollback()
+                if error.errno != errorcode.ER_DUP_ENTRY:
+                    logger.error("Error creating user: %s", error)
+                    return jsonify({'message': 'Failed to create user'}), 500
+                return jsonify({'message': 'Email already exists'}), 409
             except mysql.connector.Error as error:
-                print("Error creating user:", error)
+                logger.error("Error creating user: %s", error)
                 conn.rollback()
                 return jsonify({'message': 'Failed to create user'}), 500
             finally:
@@ -108,13 +94,127 @@ def create_user():
         else:
             return jsonify({'message': 'Database connection failed'}), 500
 
+USER_FIELD_MAX_LENGTH = 255
+
+# Check one record of a bulk import, returning an error message or None
+def validate_user(user):
+    if not isinstance(user, dict) or 'name' not in user or 'email' not in user:
+        return 'Bad Request: name and email are required'
+    return validate_user_fields({'name': user['name'], 'email': user['email']})
+
+# Check the name and email, or whichever of them an update sets
+def validate_user_fields(fields):
+    for field, value in fields.items():
+        if not isinstance(value, str) or not 0 < len(value) <= USER_FIELD_MAX_LENGTH:
+            return f'Bad Request: {field} must be a non-empty string of at most {USER_FIELD_MAX_LENGTH} characters'
+    return None
+
+def is_duplicate(error):
+    return error.errno == errorcode.ER_DUP_ENTRY
+
+# Insert the valid users of one chunk, returning the chunk's per-row results
+def insert_users(cursor, chunk):
+    results = []
+    rows = []
+    for index, user in chunk:
+        error = validate_user(user)
+        if error:
+            results.append({'index': index, 'status': 400, 'message': error})
+        else:
+            rows.append((index, user['name'], user['email']))
+    if not rows:
+        return results
+
+    # Emails that are already taken, or repeated within the chunk, are reported up front
+    # so the rest can still go in as a single multi-row insert
+    placeholders = ', '.join(['%s'] * len(rows))
+    cursor.execute(f"SELECT email FROM users WHERE email IN ({placeholders})", tuple(email for _, _, email in rows))
+    taken = {email.lower() for (email,) in cursor.fetchall()}
+    fresh = []
+    for row in rows:
+        email = row[2].lower()
+        if email in taken:
+            results.append({'index': row[0], 'status': 409, 'message': 'Email already exists'})
+        else:
+            taken.add(email)
+            fresh.append(row)
+    if not fresh:
+        return results
+
+    query = "INSERT INTO users (name, email) VALUES (%s, %s)"
+    try:
+        cursor.executemany(query, [(name, email) for _, name, email in fresh])
+        inserted = zip(fresh, inserted_ids(cursor, len(fresh)))
+    except mysql.connector.IntegrityError as error:
+        if not is_duplicate(error):
+            raise
+        # Another request took one of the emails in the meantime, or two only differ in ways
+        # the column's collation ignores; the failed insert left no rows, so go row by row
+        inserted = []
+        for row in fresh:
+            try:
+                cursor.execute(query, row[1:])
+            except mysql.connector.IntegrityError as error:
+                if not is_duplicate(error):
+                    raise
+                results.append({'index': row[0], 'status': 409, 'message': 'Email already exists'})
+            else:
+                inserted.append((row, cursor.lastrowid))
+    for (index, name, email), user_id in inserted:
+        results.append({'index': index, 'status': 201, 'user': {'id': user_id, 'name': name, 'email': email}})
+    return results
+
+# Create many users from a JSON array or an NDJSON stream, BULK_CHUNK_SIZE rows per
+# insert and commit, reporting each row's result by its position in the body
+@app.route('/users/bulk', methods=['POST'])
+def create_users_bulk():
+    with tracer.start_as_current_span("create_users_bulk"):
+        try:
+            records = request_records()
+        except ValueError as error:
+            return jsonify({'message': f'Bad Request: {error}'}), 400
+        conn = get_db_connection()
+        if conn is None:
+            return jsonify({'message': 'Database connection failed'}), 500
+        cursor = conn.cursor()
+        results = []
+        try:
+            for chunk in record_chunks(records):
+                with tracer.start_as_current_span("insert_users_chunk"):
+                    chunk_results = insert_users(cursor, chunk)
+                    conn.commit()
+                results.extend(sorted(chunk_results, key=lambda result: result['index']))
+        except mysql.connector.Error as error:
+            logger.error("Error importing users: %s", error)
+            conn.rollback()
+            # Earlier chunks stay committed; their results tell the client where to resume
+            created = sum(1 for result in results if result['status'] == 201)
+            return jsonify({'message': 'Failed to import users', 'created': created, 'results': results}), 500
+        finally:
+            cursor.close()
+            conn.close()
+        created = sum(1 for result in results if result['status'] == 201)
+        return jsonify({
+            'message': 'Bulk import processed',
+            'created': created,
+            'failed': len(results) - created,
+            'results': results
+        }), 200
+
 @app.route('/users', methods=['GET'])
 def get_users():
     with tracer.start_as_current_span("get_users"):
-        conn = get_db_connection()
+        conn = get_read_connection()
+        if conn is not None and wants_stream():
+            try:
+                chunks = query_row_chunks(conn, "SELECT id, name, email FROM users")
+            except mysql.connector.Error as error:
+                logger.error("Error fetching users: %s", error)
+                return jsonify({'message': 'Failed to fetch users'}), 500
+            return stream_records('users', chunks, lambda user: {'id': user[0], 'name': user[1], 'email': user[2]})
         if conn is not None:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users")
+            cursor.execute("SELECT id, name, email FROM users")
             users = cursor.fetchall()
             cursor.close()
             conn.close()
@@ -126,16 +226,22 @@ def get_users():
 @app.route('/users/<int:user_id>', methods=['GET'])
 def get_user(user_id):
     with tracer.start_as_current_span("get_user"):
+        # Read from the primary: the gateway and order-service check users exist here before
+        # placing an order, and cache a 404, so a replica that has not seen a new user yet
+        # would turn that user's orders away
         conn = get_db_connection()
         if conn is not None:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
+            cursor.execute("SELECT id, name, email, version FROM users WHERE id = %s", (user_id,))
             user = cursor.fetchone()
             cursor.close()
             conn.close()
             if user:
                 user_data = {'id': user[0], 'name': user[1], 'email': user[2]}
-                return jsonify({'user': user_data})
+                # Sent back as If-Match, the ETag makes an update conditional on this version
+                response = jsonify({'user': user_data})
+                response.set_etag(str(user[3]))
+                return response
             return jsonify({'message': 'User not found'}), 404
         else:
             return jsonify({'message': 'Database connection failed'}), 500
@@ -143,25 +249,38 @@ def get_user(user_id):
 @app.route('/users/<int:user_id>', methods=['PUT'])
 def update_user(user_id):
     with tracer.start_as_current_span("update_user"):
+        data = request.json
+        changed = updates.changes(data, ('name', 'email')) if isinstance(data, dict) else {}
+        if not changed:
+            return jsonify({'message': 'Bad Request: No data provided for update'}), 400
+        error = validate_user_fields(changed)
+        if error:
+            return jsonify({'message': error}), 400
+        try:
+            expected_version = updates.expected_version(data)
+        except ValueError as error:
+            return jsonify({'message': f'Bad Request: {error}'}), 400
         conn = get_db_connection()
         if conn is not None:
             cursor = conn.cursor()
-            data = request.json
             try:
-                cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-                user = cursor.fetchone()
-                if user:
-                    if not data:
-                        return jsonify({'message': 'Bad Request: No data provided for update'}), 400
-                    if 'name' in data:
-                        cursor.execute("UPDATE users SET name = %s WHERE id = %s", (data['name'], user_id))
-                    if 'email' in data:
-                        cursor.execute("UPDATE users SET email = %s WHERE id = %s", (data['email'], user_id))
-                    conn.commit()
-                    return jsonify({'message': 'User updated successfully'})
-                return jsonify({'message': 'User not found'}), 404
+                version = updates.update_row(cursor, 'users', user_id, changed, expected_version, noun='User')
+                publish_invalidation(cursor, user_id)
+                conn.commit()
+                response = jsonify({'message': 'User updated successfully', 'version': version})
+                response.set_etag(str(version))
+                return response
+            except updates.UpdateError as error:
+                conn.rollback()
+                return jsonify({'message': error.message}), error.status
+            except mysql.connector.IntegrityError as error:
+                conn.rollback()
+                if not is_duplicate(error):
+                    logger.error("Error updating user: %s", error)
+                    return jsonify({'message': 'Failed to update user'}), 500
+                return jsonify({'message': 'Email already exists'}), 409
             except mysql.connector.Error as error:
-                print("Error updating user:", error)
+                logger.error("Error updating user: %s", error)
                 conn.rollback()
                 return jsonify({'message': 'Failed to update user'}), 500
             finally:
@@ -181,11 +300,12 @@ def delete_user(user_id):
                 user = cursor.fetchone()
                 if user:
                     cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
+                    publish_invalidation(cursor, user_id)
                     conn.commit()
                     return jsonify({'message': 'User deleted successfully'})
                 return jsonify({'message': 'User not found'}), 404
             except mysql.connector.Error as error:
-                print("Error deleting user:", error)
+                logger.error("Error deleting user: %s", error)
                 conn.rollback()
                 return jsonify({'message': 'Failed to delete user'}), 500
             finally:
@@ -194,10 +314,50 @@ def delete_user(user_id):
         else:
             return jsonify({'message': 'Database connection failed'}), 500
 
+@app.route('/users/invalidations', methods=['GET'])
+def get_user_invalidations():
+    with tracer.start_as_current_span("get_user_invalidations"):
+        since = request.args.get('since', type=int)
+        conn = get_db_connection()
+        if conn is not None:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT MIN(seq), MAX(seq) FROM user_invalidations")
+                first_seq, last_seq = cursor.fetchone()
+                last_seq = last_seq or 0
+                if since is None:
+                    # New subscribers start from the current position of the feed
+                    return jsonify({'user_ids': [], 'last_seq': last_seq, 'reset': False})
+                # Entries after `since` were compacted away, so the subscriber must drop everything
+                reset = first_seq is not None and since < first_seq - 1
+                position = first_seq - 1 if reset else since
+                cursor.execute("SELECT seq, user_id, created_at > NOW(3) - INTERVAL %s SECOND FROM user_invalidations "
+                               "WHERE seq > %s ORDER BY seq LIMIT %s",
+                               (USER_INVALIDATION_SETTLE, position, USER_INVALIDATION_BATCH))
+                user_ids = []
+                for seq, user_id, recent in cursor.fetchall():
+                    # Sequence numbers are handed out before commit, so a recent gap may be an
+                    # invalidation that is still being committed. Stop short of it rather than
+                    # let the subscriber skip it for good.
+                    if seq != position + 1 and recent:
+                        break
+                    user_ids.append(user_id)
+                    position = seq
+                return jsonify({'user_ids': user_ids, 'last_seq': position, 'reset': reset})
+            except mysql.connector.Error as error:
+                logger.error("Error fetching user invalidations: %s", error)
+                return jsonify({'message': 'Failed to fetch user invalidations'}), 500
+            finally:
+                cursor.close()
+                conn.close()
+        else:
+            return jsonify({'message': 'Database connection failed'}), 500
+
 # Health check endpoint
 @app.route('/healthz', methods=['GET'])
 def health_check():
     return jsonify({'status': 'ok'}), 200
 
 if __name__ == '__main__':
+    init_worker()
     app.run(host='0.0.0.0', port=5002)
\ No newline at end of file
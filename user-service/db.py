@@ -0,0 +1,595 @@
+import contextvars
+import itertools
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+
+import mysql.connector
+from mysql.connector import errorcode
+from prometheus_client import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Database configuration from environment variables
+DB_HOST = os.environ.get("DB_HOST")
+DB_PORT = os.environ.get("DB_PORT", "3306")  # Default MySQL port
+DB_NAME = os.environ.get("DB_NAME")
+DB_USER = os.environ.get("DB_USER")
+DB_PASSWORD = os.environ.get("DB_PASSWORD")
+
+# Connection pool configuration
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "5"))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = float(os.environ.get("DB_POOL_RECYCLE", "1800"))  # Max connection age in seconds
+DB_POOL_PING_AFTER = float(os.environ.get("DB_POOL_PING_AFTER", "30"))  # Ping connections idle longer than this
+
+# Read replicas, as comma-separated host[:port], reached with the DB_NAME, DB_USER and
+# DB_PASSWORD of the primary. Handlers that only read use them, spread round-robin;
+# everything that writes stays on DB_HOST. Unset, every read goes to the primary.
+DB_REPLICAS = [replica.strip() for replica in os.environ.get("DB_REPLICAS", "").split(",") if replica.strip()]
+DB_REPLICA_POOL_SIZE = int(os.environ.get("DB_REPLICA_POOL_SIZE", str(DB_POOL_SIZE)))  # Per replica
+DB_REPLICA_EJECT_SECONDS = float(os.environ.get("DB_REPLICA_EJECT_SECONDS", "10"))  # How long a failing replica is skipped
+# With replicas, a request that commits returns a consistency token in CONSISTENCY_HEADER; sent
+# back, it keeps the client's reads off replicas that have not applied that write yet. The token
+# is the primary's executed GTID set, or the time of the write when GTIDs are off, in which case
+# reads go to the primary for DB_READ_YOUR_WRITES_WINDOW seconds after it.
+CONSISTENCY_HEADER = "X-Consistency-Token"
+DB_READ_YOUR_WRITES_WINDOW = float(os.environ.get("DB_READ_YOUR_WRITES_WINDOW", "5"))
+
+# Query metrics are labelled by statement fingerprint; this caps how many distinct labels one process creates
+DB_STATEMENT_LABELS_MAX = int(os.environ.get("DB_STATEMENT_LABELS_MAX", "200"))
+DB_STATEMENT_LABEL_LENGTH = 160
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Client errors meaning the server went away, rather than that a statement failed
+_SERVER_GONE = {errorcode.CR_CONNECTION_ERROR, errorcode.CR_CONN_HOST_ERROR, errorcode.CR_SERVER_GONE_ERROR,
+                errorcode.CR_SERVER_LOST}
+
+
+_fingerprints = {}  # statement -> label
+_labels = set()
+_fingerprint_lock = threading.Lock()
+
+
+# Normalise a statement into a metric label: collapse whitespace and IN lists, drop literals.
+# Statements are templates with %s placeholders, so this is a small, fixed set per service.
+def fingerprint(statement):
+    label = _fingerprints.get(statement)
+    if label is not None:
+        return label
+    label = re.sub(r"\s+", " ", statement).strip()
+    label = re.sub(r"%s(?:\s*,\s*%s)+", "%s, ...", label)
+    label = re.sub(r"'[^']*'|\b\d+\b", "?", label)[:DB_STATEMENT_LABEL_LENGTH]
+    with _fingerprint_lock:
+        if label not in _labels:
+            if len(_labels) >= DB_STATEMENT_LABELS_MAX:
+                label = "other"
+            else:
+                _labels.add(label)
+        if len(_fingerprints) < DB_STATEMENT_LABELS_MAX * 10:
+            _fingerprints[statement] = label
+    return label
+
+
+# Statements that take row locks, so their time includes waiting for those locks
+def _is_locking(label):
+    return label.startswith(("UPDATE", "DELETE", "INSERT")) or label.endswith("FOR UPDATE")
+
+
+class InstrumentedCursor:
+    """Cursor proxy that records per-statement execution time and row counts."""
+
+    def __init__(self, cursor, pool=None):
+        self._cursor = cursor
+        self._pool = pool
+        self._label = None
+        self._rows = 0
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._rows += 1
+            yield row
+
+    # Rows of a SELECT are counted as they are fetched and recorded once the result is done with
+    def _finish_result(self):
+        if self._label is not None:
+            _observe_rows(self._label, self._rows)
+            self._label = None
+
+    def _run(self, method, operation, args, kwargs):
+        self._finish_result()
+        label = fingerprint(operation)
+        start = time.perf_counter()
+        try:
+            return method(operation, *args, **kwargs)
+        except mysql.connector.Error as error:
+            if self._pool is not None and error.errno in _SERVER_GONE:
+                self._pool.failed(error)
+            raise
+        finally:
+            _observe_query(label, time.perf_counter() - start)
+            if self._cursor.description is not None:
+                self._label, self._rows = label, 0
+            else:
+                _observe_rows(label, max(self._cursor.rowcount, 0))
+
+    def execute(self, operation, *args, **kwargs):
+        return self._run(self._cursor.execute, operation, args, kwargs)
+
+    def executemany(self, operation, *args, **kwargs):
+        return self._run(self._cursor.executemany, operation, args, kwargs)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._rows += len(rows)
+        return rows
+
+    def close(self):
+        self._finish_result()
+        return self._cursor.close()
+
+
+class PooledConnection:
+    """Proxy around a MySQL connection that hands it back to the pool on close()."""
+
+    def __init__(self, pool, conn, created_at):
+        self._pool = pool
+        self._conn = conn
+        self._created_at = created_at
+        self._committed = False
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get("_conn")
+        if conn is None:
+            raise AttributeError(name)
+        return getattr(conn, name)
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs), self._pool)
+
+    def commit(self):
+        self._conn.commit()
+        self._committed = True
+
+    def close(self):
+        if self._conn is not None:
+            # Hand the request a consistency token for its writes, once per connection rather
+            # than per commit, since the token of the last write also covers the earlier ones
+            session = _session.get()
+            if self._committed and session is not None and DB_REPLICAS:
+                session[1] = _write_token(self)
+            conn, self._conn = self._conn, None
+            self._pool.release(conn, self._created_at)
+
+    def __del__(self):
+        # Safety net for handlers that return without closing their connection
+        if self.__dict__.get("_conn") is not None:
+            self.close()
+
+
+class ConnectionPool:
+    """Bounded pool of MySQL connections with checkout timeout, health checks and recycling.
+
+    With eject_seconds, a server that cannot be reached is marked unhealthy for
+    that long, so callers with somewhere else to go (replica reads) skip it.
+    """
+
+    def __init__(self, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, recycle=DB_POOL_RECYCLE,
+                 ping_after=DB_POOL_PING_AFTER, eject_seconds=0, **connect_args):
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self.eject_seconds = eject_seconds
+        self.connect_args = connect_args
+        self.ejected_until = 0
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = deque()  # (conn, created_at, released_at)
+        self._lock = threading.Lock()
+        self.in_use = 0
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    @property
+    def name(self):
+        return f"{self.connect_args.get('host')}:{self.connect_args.get('port')}"
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.ejected_until
+
+    # Take the server out of rotation after a failed connect or a lost connection
+    def failed(self, error):
+        if not self.eject_seconds or not self.healthy:
+            return
+        self.ejected_until = time.monotonic() + self.eject_seconds
+        logger.warning("Ejecting database %s for %ss: %s", self.name, self.eject_seconds, error)
+        _observe_ejection(self)
+        # Idle connections to a server that went away are most likely dead as well
+        self.close_all()
+
+    def _connect(self):
+        start = time.monotonic()
+        conn = mysql.connector.connect(**self.connect_args)
+        created_at = time.monotonic()
+        _observe_connect(created_at - start)
+        return conn, created_at
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except mysql.connector.Error:
+            pass
+
+    def _checkout_idle(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None, None
+                conn, created_at, released_at = self._idle.pop()
+            now = time.monotonic()
+            if now - created_at > self.recycle:
+                self._discard(conn)
+                continue
+            # is_connected() pings the server, so only pay for it on connections that sat idle
+            if now - released_at > self.ping_after and not conn.is_connected():
+                self._discard(conn)
+                continue
+            return conn, created_at
+
+    def acquire(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            _observe_timeout()
+            raise PoolTimeout(f"No database connection available after {self.timeout}s")
+        _observe_wait(time.monotonic() - start)
+        try:
+            conn, created_at = self._checkout_idle()
+            if conn is None:
+                conn, created_at = self._connect()
+        except Exception as error:
+            self._slots.release()
+            if isinstance(error, mysql.connector.Error):
+                self.failed(error)
+            raise
+        with self._lock:
+            self.in_use += 1
+        _observe_occupancy(self)
+        return PooledConnection(self, conn, created_at)
+
+    def release(self, conn, created_at):
+        try:
+            # Never hand a connection with an open transaction to the next request
+            if conn.in_transaction:
+                conn.rollback()
+            reusable = time.monotonic() - created_at <= self.recycle
+        except mysql.connector.Error:
+            reusable = False
+        with self._lock:
+            self.in_use -= 1
+            if reusable:
+                self._idle.append((conn, created_at, time.monotonic()))
+        if not reusable:
+            self._discard(conn)
+        self._slots.release()
+        _observe_occupancy(self)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool, _pool_pid
+    # Connections must not be shared across a fork, so each worker process builds its own pool
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ConnectionPool(
+                    host=DB_HOST,
+                    port=DB_PORT,
+                    database=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD
+                )
+                _pool_pid = os.getpid()
+                _observe_occupancy(_pool)
+    return _pool
+
+
+def get_db_connection():
+    try:
+        return get_pool().acquire()
+    except (mysql.connector.Error, PoolTimeout) as error:
+        logger.error("Error connecting to database: %s", error)
+        return None
+
+
+_replicas = []
+_replicas_pid = None
+_replica_turn = itertools.count()
+
+
+def get_replica_pools():
+    global _replicas, _replicas_pid
+    if _replicas_pid != os.getpid():
+        with _pool_lock:
+            if _replicas_pid != os.getpid():
+                _replicas = [
+                    ConnectionPool(
+                        size=DB_REPLICA_POOL_SIZE,
+                        eject_seconds=DB_REPLICA_EJECT_SECONDS,
+                        host=host,
+                        port=port or DB_PORT,
+                        database=DB_NAME,
+                        user=DB_USER,
+                        password=DB_PASSWORD
+                    )
+                    for host, _, port in (replica.partition(":") for replica in DB_REPLICAS)
+                ]
+                _replicas_pid = os.getpid()
+    return _replicas
+
+
+# Consistency tokens of the request being served: [token the client sent, token of its last commit].
+# None outside requests and in handlers marked without_consistency_token, whose writes issue no token.
+_session = contextvars.ContextVar("db_session", default=None)
+
+
+# Mark a Flask handler whose callers never read consistency tokens, e.g. internal ones,
+# so its commits skip the query for one
+def without_consistency_token(view):
+    view.without_consistency_token = True
+    return view
+
+
+# The token for a write just committed on `conn`: the primary's executed GTID set, which
+# includes the write, or the current time if the server does not assign GTIDs
+def _write_token(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT @@GLOBAL.gtid_executed")
+        executed = cursor.fetchone()[0]
+    except mysql.connector.Error as error:
+        logger.warning("Error reading executed GTIDs: %s", error)
+        executed = None
+    finally:
+        cursor.close()
+    if executed:
+        return "gtid:" + executed.replace("\n", "")
+    return f"time:{time.time():.3f}"
+
+
+def _has_applied(pool, conn, gtids):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT GTID_SUBSET(%s, @@GLOBAL.gtid_executed)", (gtids,))
+        return cursor.fetchone()[0] == 1
+    except mysql.connector.Error as error:
+        logger.warning("Error checking replica %s for a consistency token: %s", pool.name, error)
+        return False
+    finally:
+        cursor.close()
+
+
+# Whether the request's token requires reading from the primary, and the GTIDs a replica must
+# have applied otherwise. Tokens that cannot be understood are served from the primary.
+def _read_requirement():
+    session = _session.get()
+    token = session and (session[1] or session[0])
+    if not token:
+        return False, None
+    kind, _, value = token.partition(":")
+    if kind == "gtid" and value:
+        return False, value
+    if kind == "time":
+        try:
+            return time.time() - float(value) < DB_READ_YOUR_WRITES_WINDOW, None
+        except ValueError:
+            pass
+    return True, None
+
+
+# A connection for a handler that only reads: a healthy replica that has applied the client's
+# last write, or the primary when there is none
+def get_read_connection():
+    replicas = get_replica_pools() if DB_REPLICAS else []
+    if not replicas:
+        return get_db_connection()
+    pinned, gtids = _read_requirement()
+    if pinned:
+        _observe_read("primary_pinned")
+        return get_db_connection()
+    lagging = False
+    start = next(_replica_turn)
+    for offset in range(len(replicas)):
+        pool = replicas[(start + offset) % len(replicas)]
+        if not pool.healthy:
+            continue
+        try:
+            conn = pool.acquire()
+        except (mysql.connector.Error, PoolTimeout) as error:
+            logger.warning("Error connecting to database replica %s: %s", pool.name, error)
+            continue
+        if gtids is not None and not _has_applied(pool, conn, gtids):
+            conn.close()
+            lagging = True
+            continue
+        _observe_read("replica")
+        return conn
+    _observe_read("primary_lagging" if lagging else "primary_fallback")
+    return get_db_connection()
+
+
+# Carry consistency tokens through a Flask app's requests: the client's token decides where
+# get_read_connection() reads, and a request that committed answers with its own
+def instrument_flask(app):
+    from flask import g, request
+
+    @app.before_request
+    def _start_session():
+        view = app.view_functions.get(request.endpoint)
+        if getattr(view, 'without_consistency_token', False):
+            return
+        g.db_session_token = _session.set([request.headers.get(CONSISTENCY_HEADER), None])
+
+    @app.after_request
+    def _send_token(response):
+        session = _session.get()
+        if session is not None and session[1] is not None:
+            response.headers[CONSISTENCY_HEADER] = session[1]
+        return response
+
+    @app.teardown_request
+    def _end_session(error=None):
+        token = g.pop('db_session_token', None)
+        if token is not None:
+            _session.reset(token)
+
+
+# Ids of the rows added by the multi-row INSERT ... VALUES just run on the cursor
+# (executemany batches plain INSERTs into one); lastrowid is the first of them.
+# Working the rest out from it relies on two things, so callers must not pass
+# anything else:
+# - The statement is a "simple insert", one whose row count InnoDB knows up front,
+#   so it reserves the statement's values as one block. INSERT ... SELECT and
+#   LOAD DATA are bulk inserts and can get gaps under innodb_autoinc_lock_mode=2.
+# - auto_increment_increment is 1, the server default. Anything else (e.g. for
+#   multi-primary setups) is refused here rather than risk a wrong id.
+def inserted_ids(cursor, count):
+    first_id = cursor.lastrowid
+    cursor.execute("SELECT @@auto_increment_increment")
+    if cursor.fetchone()[0] != 1:
+        raise RuntimeError("inserted_ids requires auto_increment_increment = 1")
+    return list(range(first_id, first_id + count))
+
+
+# Pool metrics, registered on the service's metrics registry by bind_metrics().
+# Gauges are set explicitly rather than via set_function() so they also work
+# with prometheus_client's multiprocess mode under gunicorn.
+_size_gauge = None
+_in_use_gauge = None
+_idle_gauge = None
+_wait_histogram = None
+_timeout_counter = None
+_connect_histogram = None
+_query_histogram = None
+_locking_query_histogram = None
+_rows_histogram = None
+_read_counter = None
+_ejection_counter = None
+
+
+# The occupancy gauges describe the primary's pool only
+def _observe_occupancy(pool):
+    if _in_use_gauge is not None and pool not in _replicas:
+        _size_gauge.set(pool.size)
+        _in_use_gauge.set(pool.in_use)
+        _idle_gauge.set(pool.idle)
+
+
+def _observe_wait(seconds):
+    if _wait_histogram is not None:
+        _wait_histogram.observe(seconds)
+
+
+def _observe_timeout():
+    if _timeout_counter is not None:
+        _timeout_counter.inc()
+
+
+def _observe_connect(seconds):
+    if _connect_histogram is not None:
+        _connect_histogram.observe(seconds)
+
+
+def _observe_query(label, seconds):
+    if _query_histogram is not None:
+        _query_histogram.labels(statement=label).observe(seconds)
+        if _is_locking(label):
+            _locking_query_histogram.labels(statement=label).observe(seconds)
+
+
+def _observe_rows(label, rows):
+    if _rows_histogram is not None:
+        _rows_histogram.labels(statement=label).observe(rows)
+
+
+def _observe_read(route):
+    if _read_counter is not None:
+        _read_counter.labels(route=route).inc()
+
+
+def _observe_ejection(pool):
+    if _ejection_counter is not None:
+        _ejection_counter.labels(replica=pool.name).inc()
+
+
+def bind_metrics(registry):
+    global _size_gauge, _in_use_gauge, _idle_gauge, _wait_histogram, _timeout_counter
+    global _connect_histogram, _query_histogram, _locking_query_histogram, _rows_histogram
+    global _read_counter, _ejection_counter
+    _size_gauge = Gauge('db_pool_size', 'Maximum number of pooled database connections',
+                        registry=registry, multiprocess_mode='livesum')
+    _in_use_gauge = Gauge('db_pool_connections_in_use', 'Database connections currently checked out',
+                          registry=registry, multiprocess_mode='livesum')
+    _idle_gauge = Gauge('db_pool_connections_idle', 'Open database connections waiting in the pool',
+                        registry=registry, multiprocess_mode='livesum')
+    _wait_histogram = Histogram('db_pool_wait_seconds', 'Time spent waiting to check out a database connection',
+                                buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+                                registry=registry)
+    _timeout_counter = Counter('db_pool_timeouts', 'Connection checkouts that timed out waiting for the pool',
+                               registry=registry)
+    _connect_histogram = Histogram('db_connect_seconds', 'Time to open a new database connection',
+                                   buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+                                   registry=registry)
+    _query_histogram = Histogram('db_query_seconds', 'Statement execution time by statement fingerprint',
+                                 ['statement'], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                                                         0.25, 0.5, 1, 2.5, 5),
+                                 registry=registry)
+    # MySQL does not report row-lock waits per statement, so statements that take row locks are
+    # also recorded here; a p99 that grows with concurrency while other statements stay flat is lock wait
+    _locking_query_histogram = Histogram('db_locking_query_seconds',
+                                         'Execution time, including row-lock waits, of statements that lock rows',
+                                         ['statement'], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                                                                 0.1, 0.25, 0.5, 1, 2.5, 5),
+                                         registry=registry)
+    _rows_histogram = Histogram('db_query_rows', 'Rows returned or affected by statement fingerprint',
+                                ['statement'], buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000),
+                                registry=registry)
+    # Where reads went with replicas configured: a replica, or the primary because the client's
+    # token pinned it there, no replica had applied its write yet, or no replica was available
+    _read_counter = Counter('db_read_routes', 'Read-only connections by where they were served from',
+                            ['route'], registry=registry)
+    _ejection_counter = Counter('db_replica_ejections', 'Times a read replica was taken out of rotation',
+                                ['replica'], registry=registry)
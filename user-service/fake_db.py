@@ -0,0 +1,76 @@
+# In-memory stand-ins for mysql.connector connections and cursors, for this service's unit
+# tests. The same file is shared by every service, like db.py.
+
+
+class FakeCursor:
+    """Records every statement and answers it with respond(query, params), which returns
+    the result rows (or raises). Tests that need another rowcount or lastrowid for a
+    statement set them on the cursor from respond."""
+
+    def __init__(self, respond=None, rowcount=1, lastrowid=None):
+        self.respond = respond or (lambda query, params: [])
+        self.rowcount = rowcount
+        self.lastrowid = lastrowid
+        self.description = None
+        self.statements = []
+        self.rows = []
+        self.closed = False
+
+    def execute(self, query, params=()):
+        self.statements.append((query, params))
+        self.rows = list(self.respond(query, params) or [])
+
+    # Like mysql.connector, which sends a batch of plain INSERTs as one statement
+    def executemany(self, query, seq_params):
+        seq_params = list(seq_params)
+        self.statements.extend((query, params) for params in seq_params)
+        self.rowcount = len(seq_params)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, size=1):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        self.closed = True
+
+    def executed(self, prefix):
+        """The parameters of every statement run so far that starts with prefix."""
+        return [params for query, params in self.statements if query.startswith(prefix)]
+
+
+class FakeConnection:
+    """Hands out one FakeCursor and records transaction control as `events`."""
+
+    def __init__(self, cursor=None):
+        self.fake_cursor = cursor or FakeCursor()
+        self.events = []
+        self.in_transaction = False
+        self.connected = True
+
+    def cursor(self, *args, **kwargs):
+        return self.fake_cursor
+
+    def start_transaction(self, *args, **kwargs):
+        self.in_transaction = True
+        self.events.append("start_transaction")
+
+    def commit(self):
+        self.in_transaction = False
+        self.events.append("commit")
+
+    def rollback(self):
+        self.in_transaction = False
+        self.events.append("rollback")
+
+    def is_connected(self):
+        return self.connected
+
+    def close(self):
+        self.events.append("close")
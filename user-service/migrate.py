@@ -0,0 +1,30 @@
+# Apply user-service's schema migrations. Runs once per deployment, before the pods start:
+#   DB_HOST=... DB_NAME=... DB_USER=... DB_PASSWORD=... python migrate.py [--status] [--to VERSION]
+from migrations import Migration, add_column, main
+
+SERVICE = "user-service"
+
+MIGRATIONS = [
+    Migration(1, "Create users and the user invalidation feed", '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            email VARCHAR(255) NOT NULL UNIQUE
+        )
+    ''', '''
+        CREATE TABLE IF NOT EXISTS user_invalidations (
+            seq BIGINT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            INDEX (created_at)
+        )
+    '''),
+    Migration(2, "Version users for optimistic concurrency", add_column("users", "version", "INT NOT NULL DEFAULT 1")),
+    # The feed tells a gap that may still commit from one that never will by how old it is
+    Migration(3, "Time user invalidations to the millisecond", '''
+        ALTER TABLE user_invalidations MODIFY created_at TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3)
+    '''),
+]
+
+if __name__ == '__main__':
+    main(SERVICE, MIGRATIONS)
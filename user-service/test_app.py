@@ -0,0 +1,127 @@
+import json
+import unittest
+from unittest.mock import patch
+
+import mysql.connector
+from mysql.connector import errorcode
+
+import app as user_app
+import streaming
+from fake_db import FakeConnection, FakeCursor
+
+
+class TestCreateUsersBulk(unittest.TestCase):
+    def setUp(self):
+        self.client = user_app.app.test_client()
+        self.taken = {'taken@example.com'}
+        self.conn = FakeConnection(FakeCursor(self.respond, lastrowid=41))
+        get_db_connection = patch('app.get_db_connection', return_value=self.conn)
+        get_db_connection.start()
+        self.addCleanup(get_db_connection.stop)
+
+    def respond(self, query, params):
+        if query.startswith("SELECT email FROM users"):
+            return [(email,) for email in params if email in self.taken]
+        if query.startswith("SELECT @@auto_increment_increment"):
+            return [(1,)]
+        return []
+
+    def statuses(self, response):
+        return [result['status'] for result in response.get_json()['results']]
+
+    def test_each_row_gets_its_own_result(self):
+        response = self.client.post('/users/bulk', json=[
+            {'name': 'a', 'email': 'a@example.com'},
+            {'name': 'b'},
+            {'name': 'c', 'email': 'taken@example.com'},
+            {'name': 'd', 'email': 'A@example.com'},
+            {'name': 'e', 'email': 'e@example.com'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.statuses(response), [201, 400, 409, 409, 201])
+        results = response.get_json()['results']
+        self.assertEqual((results[0]['user']['id'], results[4]['user']['id']), (41, 42))
+        self.assertEqual(self.conn.fake_cursor.executed("INSERT INTO users"),
+                         [('a', 'a@example.com'), ('e', 'e@example.com')])
+        self.assertEqual(self.conn.events, ["commit", "close"])
+
+    def test_ndjson_rows_are_committed_a_chunk_at_a_time(self):
+        body = '\n'.join(json.dumps({'name': name, 'email': f'{name}@example.com'}) for name in 'abc')
+        with patch('app.record_chunks', lambda records: streaming.record_chunks(records, 2)):
+            response = self.client.post('/users/bulk', data=body, content_type=streaming.NDJSON_MIMETYPE)
+        self.assertEqual(self.statuses(response), [201, 201, 201])
+        self.assertEqual(self.conn.events, ["commit", "commit", "close"])
+
+    def test_a_failed_chunk_reports_the_committed_ones(self):
+        def respond(query, params):
+            if query.startswith("SELECT email FROM users") and 'c@example.com' in params:
+                raise mysql.connector.OperationalError("lost connection")
+            return self.respond(query, params)
+
+        self.conn.fake_cursor.respond = respond
+        with patch('app.record_chunks', lambda records: streaming.record_chunks(records, 2)), \
+                self.assertLogs('app', level='ERROR'):
+            response = self.client.post('/users/bulk', json=[{'name': name, 'email': f'{name}@example.com'}
+                                                             for name in 'abc'])
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual((response.get_json()['created'], self.statuses(response)), (2, [201, 201]))
+        self.assertEqual(self.conn.events, ["commit", "rollback", "close"])
+
+    def test_a_lost_email_race_falls_back_to_row_by_row_inserts(self):
+        def respond(query, params):
+            if query.startswith("INSERT INTO users"):
+                if params[1] == 'b@example.com':
+                    raise mysql.connector.IntegrityError(errno=errorcode.ER_DUP_ENTRY)
+                self.conn.fake_cursor.lastrowid += 1
+            return self.respond(query, params)
+
+        def executemany(query, seq_params):
+            raise mysql.connector.IntegrityError(errno=errorcode.ER_DUP_ENTRY)
+
+        self.conn.fake_cursor.respond = respond
+        self.conn.fake_cursor.executemany = executemany
+        response = self.client.post('/users/bulk', json=[{'name': 'a', 'email': 'a@example.com'},
+                                                         {'name': 'b', 'email': 'b@example.com'}])
+        self.assertEqual(self.statuses(response), [201, 409])
+        self.assertEqual(response.get_json()['results'][0]['user']['id'], 42)
+
+    def test_a_body_that_is_not_a_list_is_refused(self):
+        response = self.client.post('/users/bulk', json={'name': 'a', 'email': 'a@example.com'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.conn.events, [])
+
+
+class TestUpdateUser(unittest.TestCase):
+    def setUp(self):
+        self.client = user_app.app.test_client()
+        self.conn = FakeConnection(FakeCursor(lastrowid=4))
+        get_db_connection = patch('app.get_db_connection', return_value=self.conn)
+        get_db_connection.start()
+        self.addCleanup(get_db_connection.stop)
+
+    def test_answers_with_the_new_version_as_etag(self):
+        response = self.client.put('/users/7', json={'name': 'a'}, headers={'If-Match': '"3"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.get_json()['version'], response.headers['ETag']), (4, '"4"'))
+        self.assertEqual(self.conn.fake_cursor.statements[0],
+                         ("UPDATE users SET name = %s, version = LAST_INSERT_ID(version + 1) WHERE id = %s AND version = %s",
+                          ('a', 7, 3)))
+        self.assertEqual(self.conn.fake_cursor.executed("INSERT INTO user_invalidations"), [(7,)])
+        self.assertEqual(self.conn.events, ["commit", "close"])
+
+    def test_stale_version_is_refused_without_writing(self):
+        self.conn.fake_cursor.rowcount = 0
+        self.conn.fake_cursor.respond = lambda query, params: [(5,)] if query.startswith("SELECT version") else []
+        response = self.client.put('/users/7', json={'name': 'a', 'version': 3})
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(self.conn.fake_cursor.executed("INSERT INTO user_invalidations"), [])
+        self.assertEqual(self.conn.events, ["rollback", "close"])
+
+    def test_invalid_fields_are_refused_before_connecting(self):
+        response = self.client.put('/users/7', json={'name': ''})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.conn.events, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+import itertools
+import time
+import unittest
+from unittest.mock import patch
+
+import mysql.connector
+from flask import Flask
+
+import db
+from fake_db import FakeConnection, FakeCursor
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.connections = []
+        connect = patch('db.mysql.connector.connect', side_effect=self.connect)
+        connect.start()
+        self.addCleanup(connect.stop)
+
+    def connect(self, **connect_args):
+        conn = FakeConnection()
+        self.connections.append(conn)
+        return conn
+
+    def test_returned_connections_are_reused(self):
+        pool = db.ConnectionPool(size=2)
+        pool.acquire().close()
+        pool.acquire().close()
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual((pool.in_use, pool.idle), (0, 1))
+
+    def test_open_transaction_is_rolled_back_on_return(self):
+        pool = db.ConnectionPool(size=1)
+        conn = pool.acquire()
+        conn.start_transaction()
+        conn.close()
+        self.assertEqual(self.connections[0].events, ["start_transaction", "rollback"])
+
+    def test_checkout_waits_at_most_the_timeout_when_the_pool_is_exhausted(self):
+        pool = db.ConnectionPool(size=1, timeout=0.01)
+        held = pool.acquire()
+        with self.assertRaises(db.PoolTimeout):
+            pool.acquire()
+        held.close()
+        pool.acquire().close()
+
+    def test_connections_past_their_age_are_replaced(self):
+        pool = db.ConnectionPool(size=1, recycle=0)
+        pool.acquire().close()
+        pool.acquire().close()
+        self.assertEqual(len(self.connections), 2)
+        self.assertIn("close", self.connections[0].events)
+
+    def test_idle_connections_that_fail_the_ping_are_replaced(self):
+        pool = db.ConnectionPool(size=1, ping_after=0)
+        pool.acquire().close()
+        self.connections[0].connected = False
+        pool.acquire().close()
+        self.assertEqual(len(self.connections), 2)
+
+    def test_failed_connect_gives_the_slot_back_and_ejects_the_server(self):
+        pool = db.ConnectionPool(size=1, timeout=0.01, eject_seconds=60)
+        with patch('db.mysql.connector.connect', side_effect=mysql.connector.InterfaceError("unreachable")), \
+                self.assertLogs('db', level='WARNING'), self.assertRaises(mysql.connector.Error):
+            pool.acquire()
+        self.assertFalse(pool.healthy)
+        pool.acquire().close()
+
+    def test_get_db_connection_returns_none_when_the_pool_is_exhausted(self):
+        pool = db.ConnectionPool(size=1, timeout=0.01)
+        held = pool.acquire()
+        with patch('db.get_pool', return_value=pool), self.assertLogs('db', level='ERROR'):
+            self.assertIsNone(db.get_db_connection())
+        held.close()
+
+
+class TestFingerprint(unittest.TestCase):
+    def test_collapses_whitespace_in_lists_and_literals(self):
+        label = db.fingerprint("SELECT id\n   FROM users WHERE id IN (%s, %s,%s) AND status = 'x' LIMIT 10")
+        self.assertEqual(label, "SELECT id FROM users WHERE id IN (%s, ...) AND status = ? LIMIT ?")
+
+    def test_same_statement_same_label(self):
+        statement = "UPDATE users SET name = %s WHERE id = %s"
+        self.assertEqual(db.fingerprint(statement), db.fingerprint(statement))
+
+    def test_labels_past_the_cap_are_pooled_as_other(self):
+        with patch('db.DB_STATEMENT_LABELS_MAX', 1), patch('db._labels', set()), patch('db._fingerprints', {}):
+            self.assertEqual(db.fingerprint("SELECT id FROM users"), "SELECT id FROM users")
+            self.assertEqual(db.fingerprint("SELECT id FROM items"), "other")
+
+
+class TestInsertedIds(unittest.TestCase):
+    def cursor(self, increment):
+        return FakeCursor(lambda query, params: [(increment,)], lastrowid=41)
+
+    def test_counts_up_from_lastrowid(self):
+        self.assertEqual(db.inserted_ids(self.cursor(1), 3), [41, 42, 43])
+
+    def test_refuses_another_increment(self):
+        with self.assertRaises(RuntimeError):
+            db.inserted_ids(self.cursor(2), 3)
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """A primary and replicas r1 and r2 of fake connections. `applied` holds whether each replica has
+    applied the GTIDs it is asked about, and `executed` the primary's executed GTID set."""
+
+    def setUp(self):
+        self.applied = {'r1': True, 'r2': True}
+        self.executed = "3e11fa47-71ca-11e1-9e33-c80aa9429562:1-5"
+        self.primary = db.ConnectionPool(host='primary', port=3306)
+        self.replicas = [db.ConnectionPool(host=host, port=3306, eject_seconds=60) for host in ('r1', 'r2')]
+        for patcher in (patch('db.mysql.connector.connect', side_effect=self.connect),
+                        patch('db.DB_REPLICAS', ['r1', 'r2']),
+                        patch('db.get_pool', return_value=self.primary),
+                        patch('db.get_replica_pools', return_value=self.replicas),
+                        patch('db._replica_turn', itertools.count())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def connect(self, host, **connect_args):
+        def respond(query, params):
+            if query.startswith("SELECT GTID_SUBSET"):
+                return [(1 if self.applied[host] else 0,)]
+            if query.startswith("SELECT @@GLOBAL.gtid_executed"):
+                return [(self.executed,)]
+            return []
+
+        conn = FakeConnection(FakeCursor(respond))
+        conn.host = host
+        return conn
+
+
+class TestReadRouting(ReplicaTestCase):
+    def read_host(self, token=None):
+        session = db._session.set([token, None])
+        try:
+            conn = db.get_read_connection()
+            host = conn.host
+            conn.close()
+            return host
+        finally:
+            db._session.reset(session)
+
+    def test_reads_without_a_token_go_to_the_replicas_in_turn(self):
+        self.assertEqual([self.read_host(), self.read_host()], ['r1', 'r2'])
+
+    def test_a_recent_time_token_pins_reads_to_the_primary(self):
+        self.assertEqual(self.read_host(f"time:{time.time():.3f}"), 'primary')
+        self.assertEqual(self.read_host(f"time:{time.time() - db.DB_READ_YOUR_WRITES_WINDOW - 1:.3f}"), 'r1')
+
+    def test_a_gtid_token_skips_replicas_that_have_not_applied_it(self):
+        self.applied['r1'] = False
+        self.assertEqual(self.read_host("gtid:" + self.executed), 'r2')
+        self.applied['r2'] = False
+        self.assertEqual(self.read_host("gtid:" + self.executed), 'primary')
+
+    def test_ejected_replicas_are_skipped(self):
+        self.replicas[0].ejected_until = time.monotonic() + 60
+        self.assertEqual([self.read_host(), self.read_host()], ['r2', 'r2'])
+
+    def test_a_token_that_cannot_be_understood_reads_from_the_primary(self):
+        self.assertEqual(self.read_host("garbled"), 'primary')
+
+
+class TestConsistencyTokens(ReplicaTestCase):
+    def setUp(self):
+        super().setUp()
+        app = Flask(__name__)
+        db.instrument_flask(app)
+
+        def write():
+            conn = db.get_db_connection()
+            conn.commit()
+            conn.close()
+            return "written"
+
+        app.add_url_rule('/write', 'write', write, methods=['POST'])
+        app.add_url_rule('/internal', 'internal', db.without_consistency_token(lambda: write()), methods=['POST'])
+        app.add_url_rule('/read', 'read', lambda: db.get_read_connection().host)
+        self.client = app.test_client()
+
+    def test_a_request_that_commits_answers_with_a_token(self):
+        response = self.client.post('/write')
+        self.assertEqual(response.headers[db.CONSISTENCY_HEADER], "gtid:" + self.executed)
+
+    def test_reads_only_answer_without_a_token(self):
+        self.assertNotIn(db.CONSISTENCY_HEADER, self.client.get('/read').headers)
+
+    def test_handlers_marked_without_tokens_skip_the_query(self):
+        response = self.client.post('/internal')
+        self.assertNotIn(db.CONSISTENCY_HEADER, response.headers)
+        self.assertEqual(self.primary._idle[0][0].fake_cursor.executed("SELECT @@GLOBAL.gtid_executed"), [])
+
+    def test_the_client_token_decides_where_reads_go(self):
+        self.applied['r1'] = False
+        token = self.client.post('/write').headers[db.CONSISTENCY_HEADER]
+        self.assertEqual(self.client.get('/read', headers={db.CONSISTENCY_HEADER: token}).get_data(as_text=True), 'r2')
+
+
+if __name__ == '__main__':
+    unittest.main()
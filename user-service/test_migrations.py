@@ -0,0 +1,94 @@
+import contextlib
+import io
+import unittest
+
+import mysql.connector
+
+import migrations
+from fake_db import FakeConnection, FakeCursor
+from migrations import Migration
+
+
+class FakeSchema:
+    """Answers the statements migrate() runs, with the lock free and `applied` already recorded."""
+
+    def __init__(self, applied=(), lock=1):
+        self.applied = list(applied)
+        self.lock = lock
+
+    def respond(self, query, params):
+        if query.startswith("SELECT GET_LOCK"):
+            return [(self.lock,)]
+        if query.startswith("SELECT version FROM schema_migrations"):
+            return [(version,) for version in self.applied]
+        if query.startswith("SELECT RELEASE_LOCK"):
+            return [(1,)]
+        if query.startswith("CREATE TABLE broken"):
+            raise mysql.connector.ProgrammingError("syntax error")
+        return []
+
+
+class TestMigrate(unittest.TestCase):
+    migrations = [
+        Migration(3, "third", "CREATE TABLE c (id INT)"),
+        Migration(1, "first", "CREATE TABLE a (id INT)"),
+        Migration(2, "second", "CREATE TABLE b (id INT)"),
+    ]
+
+    def migrate(self, schema, migration_list=None, target=None):
+        self.conn = FakeConnection(FakeCursor(schema.respond))
+        with contextlib.redirect_stdout(io.StringIO()):
+            return migrations.migrate(self.conn, "user-service", migration_list or self.migrations, target)
+
+    def test_applies_pending_versions_in_order_and_skips_applied_ones(self):
+        self.assertEqual(self.migrate(FakeSchema(applied=[1])), [2, 3])
+        cursor = self.conn.fake_cursor
+        self.assertEqual([query for query, params in cursor.statements if query.startswith("CREATE TABLE ")],
+                         ["CREATE TABLE b (id INT)", "CREATE TABLE c (id INT)"])
+        self.assertEqual(cursor.executed("INSERT INTO schema_migrations"),
+                         [("user-service", 2, "second"), ("user-service", 3, "third")])
+        self.assertEqual(self.conn.events, ["commit", "commit"])
+        self.assertEqual(cursor.statements[-1], ("SELECT RELEASE_LOCK(%s)", (migrations.MIGRATIONS_LOCK,)))
+
+    def test_stops_after_the_target_version(self):
+        self.assertEqual(self.migrate(FakeSchema(), target=2), [1, 2])
+
+    def test_a_failed_step_is_not_recorded_and_the_lock_is_released(self):
+        schema = FakeSchema()
+        with self.assertRaises(mysql.connector.Error):
+            self.migrate(schema, [Migration(1, "first", "CREATE TABLE a (id INT)"),
+                                  Migration(2, "broken", "CREATE TABLE broken (")])
+        cursor = self.conn.fake_cursor
+        self.assertEqual(cursor.executed("INSERT INTO schema_migrations"), [("user-service", 1, "first")])
+        self.assertEqual(cursor.statements[-1][0], "SELECT RELEASE_LOCK(%s)")
+
+    def test_refuses_to_run_without_the_lock(self):
+        with self.assertRaises(RuntimeError):
+            self.migrate(FakeSchema(lock=0))
+        self.assertEqual(len(self.conn.fake_cursor.statements), 1)
+
+
+class TestIdempotentSteps(unittest.TestCase):
+    def test_add_column_skips_an_existing_column(self):
+        cursor = FakeCursor(lambda query, params: [(1,)])
+        migrations.add_column("users", "version", "INT NOT NULL DEFAULT 1")(cursor)
+        self.assertEqual(cursor.executed("ALTER TABLE"), [])
+
+    def test_add_column_adds_a_missing_column(self):
+        cursor = FakeCursor(lambda query, params: [(0,)])
+        migrations.add_column("users", "version", "INT NOT NULL DEFAULT 1")(cursor)
+        self.assertEqual(cursor.statements[-1], ("ALTER TABLE users ADD COLUMN version INT NOT NULL DEFAULT 1", ()))
+
+    def test_add_index_skips_an_index_with_the_same_leading_columns(self):
+        cursor = FakeCursor(lambda query, params: [("idx", "user_id"), ("idx", "id")])
+        migrations.add_index("orders", "user_id")(cursor)
+        self.assertEqual(cursor.executed("CREATE INDEX"), [])
+
+    def test_add_index_creates_a_missing_index(self):
+        cursor = FakeCursor(lambda query, params: [("PRIMARY", "id"), ("idx", "created_at"), ("idx", "user_id")])
+        migrations.add_index("orders", "user_id")(cursor)
+        self.assertEqual(cursor.statements[-1], ("CREATE INDEX idx_orders_user_id ON orders (user_id)", ()))
+
+
+if __name__ == '__main__':
+    unittest.main()
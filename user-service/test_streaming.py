@@ -0,0 +1,66 @@
+import json
+import unittest
+from unittest.mock import patch
+
+import mysql.connector
+
+import app as user_app
+import streaming
+from fake_db import FakeConnection, FakeCursor
+
+USERS = [(1, 'a', 'a@example.com'), (2, 'b', 'b@example.com'), (3, 'c', 'c@example.com')]
+
+
+class TestQueryRowChunks(unittest.TestCase):
+    def test_yields_chunks_and_closes_once_exhausted(self):
+        conn = FakeConnection(FakeCursor(lambda query, params: USERS))
+        chunks = streaming.query_row_chunks(conn, "SELECT id, name, email FROM users", chunk_size=2)
+        self.assertEqual(list(chunks), [USERS[:2], USERS[2:]])
+        self.assertTrue(conn.fake_cursor.closed)
+        self.assertEqual(conn.events, ["close"])
+
+    def test_query_errors_surface_before_streaming_and_close_the_connection(self):
+        def respond(query, params):
+            raise mysql.connector.ProgrammingError("no such table")
+
+        conn = FakeConnection(FakeCursor(respond))
+        with self.assertRaises(mysql.connector.Error):
+            streaming.query_row_chunks(conn, "SELECT id FROM users")
+        self.assertEqual(conn.events, ["close"])
+
+
+class TestStreamedList(unittest.TestCase):
+    def setUp(self):
+        self.client = user_app.app.test_client()
+        self.conn = FakeConnection(FakeCursor(lambda query, params: USERS))
+        get_read_connection = patch('app.get_read_connection', return_value=self.conn)
+        get_read_connection.start()
+        self.addCleanup(get_read_connection.stop)
+
+    def test_json_array_in_chunks(self):
+        with patch('streaming.STREAM_CHUNK_SIZE', 2):
+            response = self.client.get('/users?stream=1')
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual([user['id'] for user in response.get_json()['users']], [1, 2, 3])
+        self.assertIn("close", self.conn.events)
+
+    def test_ndjson_when_asked_for(self):
+        response = self.client.get('/users', headers={'Accept': streaming.NDJSON_MIMETYPE})
+        self.assertEqual(response.mimetype, streaming.NDJSON_MIMETYPE)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line)['email'] for line in lines], [user[2] for user in USERS])
+
+    def test_error_mid_stream_truncates_the_body(self):
+        def chunks():
+            yield USERS[:1]
+            raise mysql.connector.OperationalError("lost connection")
+
+        with user_app.app.test_request_context('/users?stream=1'):
+            response = streaming.stream_records('users', chunks(), lambda user: {'id': user[0]})
+            with self.assertLogs('streaming', level='ERROR'):
+                body = ''.join(chunk.decode() if isinstance(chunk, bytes) else chunk for chunk in response.response)
+        self.assertEqual(body, '{"users": [{"id": 1}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+
+from flask import Flask
+
+import updates
+from fake_db import FakeCursor
+from updates import UpdateError
+
+
+class TestBuildUpdate(unittest.TestCase):
+    def test_sets_changed_columns_and_bumps_the_version(self):
+        query, params = updates.build_update("users", 7, {'name': 'a', 'email': 'a@example.com'})
+        self.assertEqual(query, "UPDATE users SET name = %s, email = %s, version = LAST_INSERT_ID(version + 1) "
+                                "WHERE id = %s")
+        self.assertEqual(params, ('a', 'a@example.com', 7))
+
+    def test_expected_version_is_part_of_the_match(self):
+        query, params = updates.build_update("users", 7, {'name': 'a'}, expected_version=3)
+        self.assertTrue(query.endswith("WHERE id = %s AND version = %s"))
+        self.assertEqual(params, ('a', 7, 3))
+
+    def test_changes_keeps_only_the_given_columns(self):
+        self.assertEqual(updates.changes({'name': 'a', 'id': 1}, ('name', 'email')), {'name': 'a'})
+
+
+class TestUpdateRow(unittest.TestCase):
+    def test_returns_the_new_version(self):
+        cursor = FakeCursor(rowcount=1, lastrowid=4)
+        self.assertEqual(updates.update_row(cursor, "users", 7, {'name': 'a'}), 4)
+        self.assertEqual(len(cursor.statements), 1)
+
+    def test_missing_row(self):
+        with self.assertRaises(UpdateError) as raised:
+            updates.update_row(FakeCursor(rowcount=0), "users", 7, {'name': 'a'}, expected_version=3, noun="User")
+        self.assertEqual((raised.exception.status, raised.exception.message), (404, 'User not found'))
+
+    def test_row_at_another_version(self):
+        cursor = FakeCursor(lambda query, params: [(5,)] if query.startswith("SELECT") else [], rowcount=0)
+        with self.assertRaises(UpdateError) as raised:
+            updates.update_row(cursor, "users", 7, {'name': 'a'}, expected_version=3)
+        self.assertEqual(raised.exception.status, 412)
+
+
+class TestExpectedVersion(unittest.TestCase):
+    app = Flask(__name__)
+
+    def expected_version(self, data, headers=None):
+        with self.app.test_request_context('/', method='PUT', headers=headers or {}):
+            return updates.expected_version(data)
+
+    def test_if_match_wins_over_the_body(self):
+        self.assertEqual(self.expected_version({'version': 2}, {'If-Match': '"5"'}), 5)
+
+    def test_body_version_or_none(self):
+        self.assertEqual(self.expected_version({'version': 2}), 2)
+        self.assertIsNone(self.expected_version({}))
+        self.assertIsNone(self.expected_version({'version': 2}, {'If-Match': '*'}))
+
+    def test_refuses_what_is_not_a_version(self):
+        with self.assertRaises(ValueError):
+            self.expected_version({'version': 'x'})
+        with self.assertRaises(ValueError):
+            self.expected_version({}, {'If-Match': '"1", "2"'})
+
+
+if __name__ == '__main__':
+    unittest.main()
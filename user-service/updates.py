@@ -0,0 +1,67 @@
+from flask import request
+
+# Partial updates as one UPDATE of just the fields a request sets. Every update also
+# bumps the row's version column, so a matched row always counts as changed (MySQL
+# otherwise only counts rows whose values differ) and the affected-row count alone
+# tells whether it exists. Clients that send the version back, as If-Match or a
+# "version" field, only update the row if nobody else has since.
+VERSION_COLUMN = "version"
+
+
+class UpdateError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+# The subset of data that updates the given columns
+def changes(data, columns):
+    return {column: data[column] for column in columns if column in data}
+
+
+# One UPDATE setting the changed columns and the next version. LAST_INSERT_ID(expr)
+# hands the new version back as the cursor's lastrowid, so it is never read back.
+def build_update(table, row_id, changed, expected_version=None):
+    assignments = [f"{column} = %s" for column in changed]
+    assignments.append(f"{VERSION_COLUMN} = LAST_INSERT_ID({VERSION_COLUMN} + 1)")
+    query = f"UPDATE {table} SET {', '.join(assignments)} WHERE id = %s"
+    params = list(changed.values()) + [row_id]
+    if expected_version is not None:
+        query += f" AND {VERSION_COLUMN} = %s"
+        params.append(expected_version)
+    return query, tuple(params)
+
+
+# Apply a partial update and return the row's new version. Raises UpdateError with
+# 404 for a missing row or 412 when the row is no longer at expected_version.
+def update_row(cursor, table, row_id, changed, expected_version=None, noun="Row"):
+    cursor.execute(*build_update(table, row_id, changed, expected_version))
+    if cursor.rowcount == 1:
+        return cursor.lastrowid
+    if expected_version is not None:
+        # Only a failed conditional update needs to tell the two cases apart
+        cursor.execute(f"SELECT {VERSION_COLUMN} FROM {table} WHERE id = %s", (row_id,))
+        if cursor.fetchone() is not None:
+            raise UpdateError(412, f'{noun} was modified by another request')
+    raise UpdateError(404, f'{noun} not found')
+
+
+# The version the client last saw, from If-Match or the body's "version", or None for
+# an unconditional update. Raises ValueError when it is not a version of this row.
+def expected_version(data):
+    if request.if_match:
+        if request.if_match.star_tag:
+            return None
+        tags = request.if_match.as_set(include_weak=True)
+        if len(tags) != 1:
+            raise ValueError("If-Match must hold the single ETag returned for this resource")
+        value = next(iter(tags))
+    else:
+        value = data.get('version')
+        if value is None:
+            return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError("the expected version must be an integer") from None